@@ -22,12 +22,25 @@ import inspect
 import io
 import gzip
 import re
+import sys
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 from . import opentsdbquery
 from . import templates
 from .opentsdberrors import checkErrors, OpenTSDBError
+from .opentsdbsingleflight import OpenTSDBSingleFlight
+from .opentsdbbatch import OpenTSDBQueryBatcher
+from .opentsdbexpression import OpenTSDBExpressionEngine
+from .opentsdbcost import OpenTSDBCostEstimator
 from .opentsdbobjects import OpenTSDBAnnotation, OpenTSDBTSMeta, OpenTSDBTimeSeries, OpenTSDBMeasurement, OpenTSDBTreeDefinition, OpenTSDBRule
+if sys.version_info>=(3,5):
+    # async_query
+    from .opentsdbasync import OpenTSDBAsyncClient
+else:
+    class OpenTSDBAsyncClient:
+        pass
 
 relativeTime = re.compile("^(\d+)(ms|s|m|h|d|w|n|y)-ago\Z")
 absoluteTime = re.compile("^(\d{4})/(\d{2})/(\d{2})(( |- )(\d{2}):(\d{2})(:(\d{2}))?)?\Z")
@@ -103,11 +116,25 @@ def process_response(response, allow=[200,204,301]):
     else:
         return None
 
-class RESTOpenTSDBClient:
+class RESTOpenTSDBClient(OpenTSDBAsyncClient):
 
-    def __init__(self,host,port,ver=None):
+    def __init__(self,host,port,ver=None,coalesce=False,expressions="auto",planner=None,costPolicy=None,recentWrites=None,cache=None):
         self.host = host
         self.port = port
+        # identical queries in flight at the same time share a single HTTP request
+        self.inflight = OpenTSDBSingleFlight() if coalesce else None
+        # where expression queries are evaluated: "server", "local" or "auto" (local before 2.3)
+        if expressions not in ["auto", "server", "local"]:
+            raise ValueError("expressions must be one of auto, server, local.")
+        self.expressions = expressions
+        # optional OpenTSDBQueryPlanner rewriting metric sub queries into TSUID sub queries
+        self.planner = planner
+        # optional OpenTSDBCostEstimator guarding the TSD against huge reads
+        self.costPolicy = costPolicy
+        # optional OpenTSDBRecentWrites buffer, so that points written by this client can be read back at once
+        self.recentWrites = recentWrites
+        # optional query result cache, with get(key) and put(key, value) methods
+        self.cache = cache
         if ver is None: ver = self.get_version()["version"]
         version = re.match("(\d)\.(\d)\.(\d)(-(.*))?",ver)
         if version is not None:
@@ -158,7 +185,10 @@ class RESTOpenTSDBClient:
             req = requests.post(templates.PUT_TEMPL % {'host': self.host,'port': self.port,'options': options },
                                 data=rawData )
         #handle the response
-        return process_response(req, allow=[200,204,301,400])
+        response = process_response(req, allow=[200,204,301,400])
+        if self.recentWrites is not None and req.status_code in [200,204] and not (isinstance(response,dict) and response.get("failed",0)>0):
+            self.recentWrites.record(measurements)
+        return response
 
     def get_aggregators(self):
         """Used to get the list of default aggregation functions."""
@@ -208,17 +238,44 @@ class RESTOpenTSDBClient:
                               data = json.dumps(params))
         return process_response(req)
 
-    def delete_annotations(self, startTime, endTime=None, tsuid=[], considerGlobal=False):
-        """Used to delete all annotations in a time range for given tsuids and/or globally."""
+    def set_annotations(self, annotations, chunkSize=100):
+        """Used to create or update many annotations with the bulk endpoint, chunkSize annotations per request.
+           Returns the list of annotations as stored by the TSD."""
 
-        checkArguments(inspect.currentframe(), {'startTime':(int,str), 'endTime':(int,str), 'tsuid':list}, 
-                                               {'startTime':checkTime, 'endTime':checkTime,'tsuid':lambda x: sum([ int(tsuid,16) for tsuid in x ]) } )
+        checkArguments(inspect.currentframe(), {'annotations':list, 'chunkSize':int},
+                                               {'annotations':lambda l: all([isinstance(a,OpenTSDBAnnotation) for a in l]),
+                                                'chunkSize':lambda x:x>0})
 
-        params = { "startTime":startTime, "endTime":endTime, "tsuids":tsuids, "global":considerGlobal  }
-        params = { k:v for k,v in list(params.items()) if v is not None }
-        req = requests.delete(templates.ANNOTBULK_TEMPL % {'host': self.host,'port': self.port},
-                              data = json.dumps(params))
-        return process_response(req)
+        output = []
+        for i in range(0, len(annotations), chunkSize):
+            req = requests.post(templates.ANNOTBULK_TEMPL % {'host': self.host,'port': self.port},
+                                data = json.dumps([a.getMap() for a in annotations[i:i+chunkSize]]))
+            output += [OpenTSDBAnnotation(**a) for a in process_response(req) or []]
+        return output
+
+    def delete_annotations(self, startTime, endTime=None, tsuid=[], considerGlobal=False, chunkSize=1000):
+        """Used to delete all annotations in a time range for given tsuids and/or globally.
+           The tsuids are sent in chunks of chunkSize. Returns the answer of the TSD, with the total number of deleted annotations."""
+
+        checkArguments(inspect.currentframe(), {'startTime':(int,str), 'endTime':(int,str), 'tsuid':list, 'considerGlobal':bool, 'chunkSize':int},
+                                               {'startTime':checkTime, 'endTime':checkTime,'tsuid':lambda x: all([ int(t,16)>=0 for t in x ]),
+                                                'chunkSize':lambda x:x>0} )
+
+        chunks = [tsuid[i:i+chunkSize] for i in range(0, len(tsuid), chunkSize)] or [[]]
+        response = None
+        total = 0
+        for i,chunk in enumerate(chunks):
+            # global notes are deleted once
+            params = { "startTime":startTime, "endTime":endTime, "tsuids":chunk, "global":considerGlobal and i==0 }
+            params = { k:v for k,v in list(params.items()) if v is not None }
+            req = requests.delete(templates.ANNOTBULK_TEMPL % {'host': self.host,'port': self.port},
+                                  data = json.dumps(params))
+            response = process_response(req)
+            if response is not None:
+                total += response.get("totalDeleted",0)
+        if response is not None:
+            response = dict(response, tsuids=tsuid, totalDeleted=total)
+        return response
 
     def get_configuration(self):
         """This endpoint returns information about the running configuration of the TSD. 
@@ -268,7 +325,62 @@ class RESTOpenTSDBClient:
     def query(self, openTSDBQuery):
         """enables extracting data from the storage system in various formats determined by the serializer selected"""
 
+        if isinstance(openTSDBQuery,opentsdbquery.OpenTSDBExpQuery) and self._localExpressions():
+            return OpenTSDBExpressionEngine(self).evaluate(openTSDBQuery)
+        if self.recentWrites is not None and isinstance(openTSDBQuery,(opentsdbquery.OpenTSDBQuery,opentsdbquery.OpenTSDBQueryLast,opentsdbquery.OpenTSDBPreparedQuery)):
+            openTSDBQuery.check()
+            original = RESTOpenTSDBClient._original(openTSDBQuery)
+            results = self.recentWrites.answer(original)
+            if results is None:
+                results = self.recentWrites.merge(original, self._costed_query(openTSDBQuery))
+            return results
+        return self._costed_query(openTSDBQuery)
+
+    @staticmethod
+    def _original(openTSDBQuery):
+        """the OpenTSDBQuery behind a prepared query, or the query itself"""
+        if isinstance(openTSDBQuery,opentsdbquery.OpenTSDBPreparedQuery):
+            return openTSDBQuery.original()
+        return openTSDBQuery
+
+    def _costed_query(self, openTSDBQuery):
+        if self.costPolicy is not None and isinstance(openTSDBQuery,(opentsdbquery.OpenTSDBQuery,opentsdbquery.OpenTSDBPreparedQuery)):
+            openTSDBQuery.check()
+            original = RESTOpenTSDBClient._original(openTSDBQuery)
+            queries = self.costPolicy.apply(original)
+            if len(queries)>1:
+                return OpenTSDBCostEstimator.merge([self._query(q) for q in queries], original)
+            if queries[0] is not original:
+                openTSDBQuery = queries[0]
+        return self._query(openTSDBQuery)
+
+    def _query(self, openTSDBQuery):
+        endpoint, data = self._prepare_query(openTSDBQuery)
+        if not self._coalescable(openTSDBQuery):
+            return self._post_query(endpoint, data)
+        if self.inflight is None:
+            return self._cached_query(endpoint, data)
+        return self.inflight.do(endpoint+data, self._cached_query, endpoint, data)
+
+    def batch(self, maxBatch=50, **options):
+        """returns a batcher that merges sub queries sharing a time range into single queries.
+           Typical use:
+               with client.batch() as batch:
+                   cpu = batch.add(OpenTSDBMetricSubQuery("sum","sys.cpu.user"), "1h-ago")
+                   mem = batch.add(OpenTSDBMetricSubQuery("sum","sys.mem.free"), "1h-ago")
+               cpu.result(), mem.result()"""
+
+        return OpenTSDBQueryBatcher(self, maxBatch, **options)
+
+    def _prepare_query(self, openTSDBQuery):
+        """checks the query and returns the endpoint and the canonical serialization of the query."""
+
         openTSDBQuery.check()
+        if self.planner is not None:
+            openTSDBQuery = self.planner.plan(openTSDBQuery)
+        if isinstance(openTSDBQuery,opentsdbquery.OpenTSDBPreparedQuery):
+            # the static part is already validated and serialized
+            return templates.QUERY_TEMPL, openTSDBQuery.json()
         params = openTSDBQuery.getMap()
         if isinstance(openTSDBQuery,opentsdbquery.OpenTSDBQuery):
             endpoint = templates.QUERY_TEMPL
@@ -279,8 +391,29 @@ class RESTOpenTSDBClient:
             endpoint = templates.QUERYLST_TEMPL
         else:
             raise TypeError("Not a known query type. Should be OpenTSDBQuery or OpenTSDBExpQuery.")
+        return endpoint, json.dumps(params, sort_keys=True)
+
+    def _localExpressions(self):
+        """expressions are evaluated by the client if requested or if the server is older than 2.3."""
+        return self.expressions=="local" or (self.expressions=="auto" and self.version[:2]<(2,3))
+
+    def _coalescable(self, openTSDBQuery):
+        """queries that delete data are never shared nor cached."""
+        return not getattr(openTSDBQuery, "delete", False)
+
+    def _cached_query(self, endpoint, data):
+        if self.cache is None:
+            return self._post_query(endpoint, data)
+        key = (endpoint % {'host': self.host,'port': self.port}) + data
+        results = self.cache.get(key)
+        if results is None:
+            results = self._post_query(endpoint, data)
+            self.cache.put(key, results)
+        return results
+
+    def _post_query(self, endpoint, data):
         req = requests.post(endpoint % {'host': self.host,'port': self.port},
-                            data = json.dumps(params))
+                            data = data)
         return process_response(req)
 
     def search(self, mode, query="", metric="*", tags={}, limit=25, startindex=0, useMeta=False):
@@ -327,6 +460,44 @@ class RESTOpenTSDBClient:
                             data = json.dumps(theData))
         return process_response(req)
 
+    def search_iter(self, mode, query="", metric="*", tags={}, pageSize=100, maxPageSize=10000, targetTime=1., useMeta=False):
+        """Iterates over all the results of a search, page after page, until totalResults is reached.
+           The next page is fetched in the background while the current one is consumed.
+           The page size starts at pageSize and adapts so that each request takes about targetTime seconds,
+           within [pageSize, maxPageSize].
+           LOOKUP is not paginated by the TSD: its results come from a single call."""
+
+        checkArguments(inspect.currentframe(), {'mode':str, 'query':str, 'metric':str, 'tags':dict, 'pageSize':int, 'maxPageSize':int,
+                                                'targetTime':(int,float), 'useMeta':bool},
+                                               {'pageSize':lambda x:x>0, 'maxPageSize':lambda x:x>0, 'targetTime':lambda x:x>0})
+
+        if mode.upper()=="LOOKUP":
+            for result in self.search(mode, query, metric, tags, useMeta=useMeta).get("results") or []:
+                yield result
+            return
+
+        def fetch(startindex, limit):
+            start = time.time()
+            return self.search(mode, query, limit=limit, startindex=startindex), time.time()-start
+
+        limit = pageSize
+        startindex = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(fetch, startindex, limit)
+            while future is not None:
+                response, elapsed = future.result()
+                page = response.get("results") or []
+                startindex += len(page)
+                future = None
+                if len(page)>0 and startindex<response.get("totalResults",0):
+                    if elapsed<targetTime/2.:
+                        limit = min(limit*2, maxPageSize)
+                    elif elapsed>targetTime:
+                        limit = max(limit//2, min(pageSize, maxPageSize))
+                    future = executor.submit(fetch, startindex, limit)
+                for result in page:
+                    yield result
+
     def get_version(self):
         """Used to check OpenTSDB version.
         That might be needed in case of unknown bugs - this code is written
@@ -0,0 +1,230 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import random
+import threading
+from .opentsdbobjects import OpenTSDBAnnotation
+
+class _Node:
+    __slots__ = ["key", "end", "value", "maxEnd", "priority", "left", "right"]
+
+    def __init__(self, key, end, value):
+        self.key = key
+        self.end = end
+        self.value = value
+        self.maxEnd = end
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+
+    def update(self):
+        self.maxEnd = max(self.end, self.left.maxEnd if self.left else self.end, self.right.maxEnd if self.right else self.end)
+
+
+class OpenTSDBIntervalTree:
+    """Intervals [start, end] with a value, in a treap ordered by (start, id) where each node knows
+       the largest end of its subtree. Insertion and removal take O(log n) and overlap queries
+       O(log n + k) on average, k being the number of results."""
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _rotateRight(node):
+        left = node.left
+        node.left = left.right
+        left.right = node
+        node.update()
+        left.update()
+        return left
+
+    @staticmethod
+    def _rotateLeft(node):
+        right = node.right
+        node.right = right.left
+        right.left = node
+        node.update()
+        right.update()
+        return right
+
+    def _insert(self, node, new):
+        if node is None:
+            self._size += 1
+            return new
+        if new.key==node.key:
+            new.left, new.right, new.priority = node.left, node.right, node.priority
+            new.update()
+            return new
+        if new.key<node.key:
+            node.left = self._insert(node.left, new)
+            if node.left.priority>node.priority:
+                return OpenTSDBIntervalTree._rotateRight(node)
+        else:
+            node.right = self._insert(node.right, new)
+            if node.right.priority>node.priority:
+                return OpenTSDBIntervalTree._rotateLeft(node)
+        node.update()
+        return node
+
+    def _remove(self, node, key):
+        if node is None:
+            return None
+        if key<node.key:
+            node.left = self._remove(node.left, key)
+        elif key>node.key:
+            node.right = self._remove(node.right, key)
+        else:
+            if node.left is None or node.right is None:
+                self._size -= 1
+                return node.left or node.right
+            if node.left.priority>node.right.priority:
+                node = OpenTSDBIntervalTree._rotateRight(node)
+                node.right = self._remove(node.right, key)
+            else:
+                node = OpenTSDBIntervalTree._rotateLeft(node)
+                node.left = self._remove(node.left, key)
+        node.update()
+        return node
+
+    def add(self, start, end, ident, value):
+        """adds an interval, replacing the one with the same start and ident"""
+        if end<start:
+            raise ValueError("Invalid interval: %s > %s"%(start,end))
+        self._root = self._insert(self._root, _Node((start, ident), end, value))
+
+    def remove(self, start, ident):
+        self._root = self._remove(self._root, (start, ident))
+
+    def overlap(self, start, end):
+        """the values of the intervals overlapping [start, end], ordered by start"""
+        output = []
+        stack = []
+        node = self._root
+        # in order traversal, skipping the subtrees that cannot overlap
+        while stack or node is not None:
+            if node is not None:
+                if node.maxEnd<start:
+                    node = None
+                    continue
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                if node.key[0]>end:
+                    break
+                if node.end>=start:
+                    output.append(node.value)
+                node = node.right
+        return output
+
+    def __iter__(self):
+        return iter(self.overlap(float("-inf"), float("inf")))
+
+
+class OpenTSDBAnnotationIndex:
+    """Local store of annotations, for dashboards showing the annotations of the visible time range.
+
+       Annotations are identified by their TSUID and start time, as on the TSD. They are indexed by interval
+       trees on [startTime, endTime] (endTime defaults to startTime): one for each TSUID and one for all
+       the series, the global notes being kept in a separate tree.
+
+           index = OpenTSDBAnnotationIndex()
+           index.load(client, "*")
+           index.overlap(start, end, tsuids=["000001000001000001"])
+
+       load fills it in bulk from search ANNOTATION, add and remove update it incrementally, and save and
+       delete do the same on the TSD and in the index. Times are in the unit of the annotations."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._global = OpenTSDBIntervalTree()
+        self._local = OpenTSDBIntervalTree()
+        self._bySeries = {}
+
+    @staticmethod
+    def _annotation(annotation):
+        return annotation if isinstance(annotation,OpenTSDBAnnotation) else OpenTSDBAnnotation(**annotation)
+
+    def add(self, annotations):
+        """adds or replaces annotations, given as OpenTSDBAnnotation or as maps"""
+        if isinstance(annotations,(OpenTSDBAnnotation,dict)):
+            annotations = [annotations]
+        annotations = [OpenTSDBAnnotationIndex._annotation(a) for a in annotations]
+        with self._lock:
+            for a in annotations:
+                end = a.startTime if a.endTime is None else a.endTime
+                if a.tsuid is None:
+                    self._global.add(a.startTime, end, "", a)
+                else:
+                    self._local.add(a.startTime, end, a.tsuid, a)
+                    self._bySeries.setdefault(a.tsuid, OpenTSDBIntervalTree()).add(a.startTime, end, a.tsuid, a)
+
+    def remove(self, startTime, tsuid=None):
+        """removes the annotation of a TSUID (a global note if None) starting at startTime"""
+        with self._lock:
+            if tsuid is None:
+                self._global.remove(startTime, "")
+                return
+            self._local.remove(startTime, tsuid)
+            tree = self._bySeries.get(tsuid)
+            if tree is not None:
+                tree.remove(startTime, tsuid)
+                if len(tree)==0:
+                    del self._bySeries[tsuid]
+
+    def overlap(self, start, end=None, tsuids=None, includeGlobal=True):
+        """the annotations overlapping [start, end], for the given TSUIDs (all if None) and the global notes"""
+        if end is None: end = start
+        with self._lock:
+            if tsuids is None:
+                output = self._local.overlap(start, end)
+            else:
+                output = []
+                for tsuid in set(tsuids):
+                    tree = self._bySeries.get(tsuid)
+                    if tree is not None:
+                        output += tree.overlap(start, end)
+            if includeGlobal:
+                output += self._global.overlap(start, end)
+        return sorted(output, key=lambda a: (a.startTime, a.tsuid or ""))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._local)+len(self._global)
+
+    def load(self, client, query="*", pageSize=1000):
+        """adds the annotations returned by search ANNOTATION (requires a search plugin). Returns their number."""
+        annotations = [OpenTSDBAnnotationIndex._annotation(r) for r in client.search_iter("ANNOTATION", query=query, pageSize=pageSize)]
+        self.add(annotations)
+        return len(annotations)
+
+    def save(self, client, annotations):
+        """stores annotations on the TSD with the bulk endpoint, and in the index"""
+        saved = client.set_annotations([OpenTSDBAnnotationIndex._annotation(a) for a in annotations])
+        self.add(saved)
+        return saved
+
+    def delete(self, client, startTime, endTime=None, tsuids=[], considerGlobal=False):
+        """deletes the annotations starting in [startTime, endTime] on the TSD, and from the index"""
+        response = client.delete_annotations(startTime, endTime, tsuids, considerGlobal)
+        if endTime is None: endTime = float("inf")
+        for a in self.overlap(startTime, endTime, tsuids, considerGlobal):
+            if startTime<=a.startTime<=endTime:
+                self.remove(a.startTime, a.tsuid)
+        return response
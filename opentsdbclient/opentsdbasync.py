@@ -0,0 +1,70 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# asyncio entry points. This module uses the async/await syntax: it is only imported with python 3.5 or higher.
+
+import asyncio
+
+from . import opentsdbquery
+from .opentsdbcost import OpenTSDBCostEstimator
+
+class OpenTSDBAsyncSingleFlight:
+    """asyncio methods of OpenTSDBSingleFlight"""
+
+    async def async_do(self, key, fn, *args, executor=None):
+        """asyncio flavour of do. The leader runs fn(*args) in the executor (default if None)."""
+        future, leader = self._join(key)
+        if leader:
+            asyncio.get_event_loop().run_in_executor(executor, self._run, key, future, fn, args)
+        return await asyncio.wrap_future(future)
+
+
+class OpenTSDBAsyncClient:
+    """asyncio methods of RESTOpenTSDBClient"""
+
+    async def async_query(self, openTSDBQuery, executor=None):
+        """asyncio flavour of query. The HTTP request is performed in the executor (default if None).
+           Identical queries from threads and coroutines are coalesced if the client was created with coalesce=True."""
+
+        if isinstance(openTSDBQuery,opentsdbquery.OpenTSDBExpQuery) and self._localExpressions():
+            return await asyncio.get_event_loop().run_in_executor(executor, self.query, openTSDBQuery)
+        if self.recentWrites is not None and isinstance(openTSDBQuery,(opentsdbquery.OpenTSDBQuery,opentsdbquery.OpenTSDBQueryLast,opentsdbquery.OpenTSDBPreparedQuery)):
+            openTSDBQuery.check()
+            original = self._original(openTSDBQuery)
+            results = self.recentWrites.answer(original)
+            if results is None:
+                results = self.recentWrites.merge(original, await self._async_costed_query(openTSDBQuery, executor))
+            return results
+        return await self._async_costed_query(openTSDBQuery, executor)
+
+    async def _async_costed_query(self, openTSDBQuery, executor):
+        if self.costPolicy is not None and isinstance(openTSDBQuery,(opentsdbquery.OpenTSDBQuery,opentsdbquery.OpenTSDBPreparedQuery)):
+            openTSDBQuery.check()
+            original = self._original(openTSDBQuery)
+            queries = self.costPolicy.apply(original)
+            if len(queries)>1:
+                results = [await self._async_query(q, executor) for q in queries]
+                return OpenTSDBCostEstimator.merge(results, original)
+            if queries[0] is not original:
+                openTSDBQuery = queries[0]
+        return await self._async_query(openTSDBQuery, executor)
+
+    async def _async_query(self, openTSDBQuery, executor):
+        endpoint, data = self._prepare_query(openTSDBQuery)
+        if not self._coalescable(openTSDBQuery):
+            return await asyncio.get_event_loop().run_in_executor(executor, self._post_query, endpoint, data)
+        if self.inflight is None:
+            return await asyncio.get_event_loop().run_in_executor(executor, self._cached_query, endpoint, data)
+        return await self.inflight.async_do(endpoint+data, self._cached_query, endpoint, data, executor=executor)
@@ -0,0 +1,112 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+from concurrent.futures import Future
+from .opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBtsuidSubQuery
+
+class OpenTSDBQueryBatcher:
+    """Gathers metric and tsuid sub queries sharing a time range and sends them as a single /api/query call.
+       Each call to add returns a future that receives the list of series produced by that sub query.
+       Series are routed back using the index of the sub query, echoed by the server thanks to showQuery.
+
+       Pending sub queries are sent when flush is called, when leaving the context manager
+       or as soon as maxBatch sub queries are waiting for the same time range.
+       Other OpenTSDBQuery options (msResolution, noAnnotations, ...) can be given as keyword arguments
+       and apply to all the batches."""
+
+    def __init__(self, client, maxBatch=50, **options):
+        if not isinstance(maxBatch,int) or maxBatch<1:
+            raise ValueError("maxBatch must be a strictly positive integer")
+        options.pop("showQuery",None)
+        self.client = client
+        self.maxBatch = maxBatch
+        self.options = options
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def add(self, subquery, start, end=None):
+        """queues a sub query and returns a future for its results"""
+        if not isinstance(subquery,(OpenTSDBMetricSubQuery,OpenTSDBtsuidSubQuery)):
+            raise TypeError("Subqueries must be either OpenTSDBMetricSubQuery or OpenTSDBtsuidSubQuery.")
+        subquery.check()
+        future = Future()
+        with self._lock:
+            batch = self._pending.setdefault((start,end),[])
+            batch.append((subquery,future))
+            if len(batch)>=self.maxBatch:
+                del self._pending[(start,end)]
+            else:
+                batch = None
+        if batch is not None:
+            self._send(start, end, batch)
+        return future
+
+    def flush(self):
+        """sends all the pending sub queries, one request per time range"""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        for (start,end),batch in list(pending.items()):
+            self._send(start, end, batch)
+
+    def pending(self):
+        """number of sub queries waiting to be sent"""
+        with self._lock:
+            return sum(len(b) for b in self._pending.values())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def _send(self, start, end, batch):
+        subqueries = [q for q,_ in batch]
+        query = OpenTSDBQuery(subqueries, start, end, showQuery=True, **self.options)
+        try:
+            results = self.client.query(query)
+            demux = OpenTSDBQueryBatcher.demultiplex(results, subqueries)
+        except Exception as e:
+            for _,future in batch:
+                future.set_exception(e)
+            return
+        for (_,future),series in zip(batch,demux):
+            future.set_result(series)
+
+    @staticmethod
+    def demultiplex(results, subqueries):
+        """splits the results of a query run with showQuery into one list of series per sub query.
+           The index echoed by the server is used. Older servers that do not provide it are handled
+           by matching the echoed metric or tsuids and aggregator."""
+        output = [[] for q in subqueries]
+        maps = [q.getMap() for q in subqueries]
+        for series in results or []:
+            echo = series.get("query")
+            if echo is None:
+                raise ValueError("Cannot demultiplex results without the query echoed by the server.")
+            index = echo.get("index")
+            if index is None:
+                index = OpenTSDBQueryBatcher._match(echo, maps)
+            output[index].append(series)
+        return output
+
+    @staticmethod
+    def _match(echo, maps):
+        for i,m in enumerate(maps):
+            if m["aggregator"]!=echo.get("aggregator"): continue
+            if "metric" in m and m["metric"]==echo.get("metric"): return i
+            if "tsuids" in m and m["tsuids"]==echo.get("tsuids"): return i
+        raise ValueError("Cannot match series to a subquery: %s"%str(echo))
@@ -0,0 +1,179 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sqlite3
+import threading
+from .opentsdbobjects import OpenTSDBTimeSeries
+
+class OpenTSDBCatalog:
+    """Local catalog of the series of a TSD (metric, tags and TSUID), stored in SQLite with indexes on the tags.
+
+       sync fills it from the TSMeta records returned by search TSMETA (this requires a search plugin).
+       The first call loads everything, the next ones only ask for the records created or updated since
+       the previous sync, using created and lastReceived:
+
+           catalog = OpenTSDBCatalog("/var/lib/dashboards/catalog.db")
+           catalog.sync(client)
+           catalog.series("sys.cpu.user", {"host":"web01"})
+
+       Lookups and counts are then answered offline. The catalog also implements get and lookup as
+       OpenTSDBLookupCache does, and can be given to OpenTSDBQueryPlanner instead of it.
+       Deleted series are only removed by a full sync (full=True).
+
+       The search queries are written for the Elasticsearch plugin and can be changed with fullQuery
+       and incrementalQuery, where %(since)d is replaced by the time of the previous sync minus overlap seconds."""
+
+    def __init__(self, path=":memory:", fullQuery="*",
+                 incrementalQuery="created:[%(since)d TO *] OR lastReceived:[%(since)d TO *]", overlap=60):
+        self.path = path
+        self.fullQuery = fullQuery
+        self.incrementalQuery = incrementalQuery
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS series (tsuid TEXT PRIMARY KEY, metric TEXT NOT NULL, created INTEGER, lastReceived INTEGER)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS tags (tsuid TEXT NOT NULL, tagk TEXT NOT NULL, tagv TEXT NOT NULL, PRIMARY KEY (tsuid, tagk))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS series_metric ON series (metric)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS tags_value ON tags (tagk, tagv)")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _insert(self, tsuid, metric, tags, created=0, lastReceived=0):
+        self._db.execute("INSERT OR REPLACE INTO series VALUES (?,?,?,?)", (tsuid, metric, created, lastReceived))
+        self._db.execute("DELETE FROM tags WHERE tsuid=?", (tsuid,))
+        self._db.executemany("INSERT INTO tags VALUES (?,?,?)", [(tsuid, k, v) for k,v in list(tags.items())])
+
+    def add(self, tsuid, metric, tags, created=0, lastReceived=0):
+        """adds or updates a series"""
+        int(tsuid,16)
+        with self._lock, self._db:
+            self._insert(tsuid, metric, tags, created, lastReceived)
+
+    def addMeta(self, records):
+        """adds or updates the series of a list of TSMeta records. Returns the latest created or lastReceived time."""
+        with self._lock, self._db:
+            return self._addMeta(records)
+
+    def _addMeta(self, records):
+        latest = 0
+        for meta in records:
+            created = meta.get("created") or 0
+            lastReceived = meta.get("lastReceived") or 0
+            self._insert(meta["tsuid"], meta["metric"]["name"], OpenTSDBTimeSeries.metaTags(meta), created, lastReceived)
+            latest = max(latest, created, lastReceived)
+        return latest
+
+    def remove(self, tsuid):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM series WHERE tsuid=?", (tsuid,))
+            self._db.execute("DELETE FROM tags WHERE tsuid=?", (tsuid,))
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM series")
+            self._db.execute("DELETE FROM tags")
+            self._db.execute("DELETE FROM state")
+
+    def lastSync(self):
+        """the time of the most recent record seen by sync, or None if never synced"""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM state WHERE key='lastSync'").fetchone()
+        return None if row is None else row[0]
+
+    def sync(self, client, full=False, pageSize=1000):
+        """loads the series created or updated since the last sync, or all of them the first time or if full.
+           Returns the number of TSMeta records received."""
+        since = self.lastSync()
+        if full or since is None:
+            query = self.fullQuery
+            full = True
+        else:
+            query = self.incrementalQuery%{ "since":max(since-self.overlap,0) }
+        records = list(client.search_iter("TSMETA", query=query, pageSize=pageSize))
+        # a single transaction: readers never see a partially loaded catalog
+        with self._lock, self._db:
+            if full:
+                self._db.execute("DELETE FROM series")
+                self._db.execute("DELETE FROM tags")
+            latest = self._addMeta(records)
+            self._db.execute("INSERT OR REPLACE INTO state VALUES ('lastSync',?)", (max(latest, since or 0),))
+        return len(records)
+
+    def _select(self, columns, metric, tags):
+        """the SQL query selecting the series of a metric (any if None or *) carrying tags (any value for *)"""
+        sql = ["SELECT %s FROM series s"%columns]
+        where = []
+        params = []
+        for i,(k,v) in enumerate(sorted(tags.items())):
+            sql.append("JOIN tags t%d ON t%d.tsuid=s.tsuid AND t%d.tagk=?"%(i,i,i))
+            params.append(k)
+            if v!="*":
+                sql[-1] += " AND t%d.tagv=?"%i
+                params.append(v)
+        if metric is not None and metric!="*":
+            where.append("s.metric=?")
+            params.append(metric)
+        if where:
+            sql.append("WHERE "+" AND ".join(where))
+        return " ".join(sql), params
+
+    def series(self, metric=None, tags={}):
+        """the series as returned by search LOOKUP: a list of { tsuid, metric, tags }"""
+        sql, params = self._select("s.tsuid, s.metric", metric, tags)
+        with self._lock:
+            rows = self._db.execute(sql+" ORDER BY s.tsuid", params).fetchall()
+            output = []
+            for tsuid,name in rows:
+                theTags = dict(self._db.execute("SELECT tagk, tagv FROM tags WHERE tsuid=?", (tsuid,)).fetchall())
+                output.append({ "tsuid":tsuid, "metric":name, "tags":theTags })
+        return output
+
+    def get(self, metric, tags):
+        """the sorted TSUIDs of the series of a metric carrying the tags"""
+        sql, params = self._select("s.tsuid", metric, tags)
+        with self._lock:
+            return [r[0] for r in self._db.execute(sql+" ORDER BY s.tsuid", params).fetchall()]
+
+    def lookup(self, metric, tags):
+        return self.get(metric, tags)
+
+    def cardinality(self, metric=None, tags={}):
+        """the number of series of a metric carrying the tags"""
+        sql, params = self._select("COUNT(*)", metric, tags)
+        with self._lock:
+            return self._db.execute(sql, params).fetchone()[0]
+
+    def tagValues(self, tagk, metric=None, tags={}):
+        """the values of a tag key among the selected series, with their number of series"""
+        sql, params = self._select("v.tagv, COUNT(*)", metric, tags)
+        sql = sql.replace("FROM series s", "FROM series s JOIN tags v ON v.tsuid=s.tsuid AND v.tagk=?", 1)
+        with self._lock:
+            return dict(self._db.execute(sql+" GROUP BY v.tagv", [tagk]+params).fetchall())
+
+    def tagKeys(self):
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT DISTINCT tagk FROM tags ORDER BY tagk").fetchall()]
+
+    def metrics(self):
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT DISTINCT metric FROM series ORDER BY metric").fetchall()]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM series").fetchone()[0]
@@ -0,0 +1,241 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import binascii
+import struct
+
+# delta of delta encoding of the timestamps (in ms): (prefix, prefix length, value bits).
+# The last bucket stores any 64 bits value.
+timestampBuckets = [ (0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b11110, 5, 32), (0b11111, 5, 64) ]
+
+def _floatBits(value):
+    return struct.unpack(">Q", struct.pack(">d", value))[0]
+
+def _bitsFloat(bits):
+    return struct.unpack(">d", struct.pack(">Q", bits))[0]
+
+def _leadingZeros(bits):
+    return 64 - bits.bit_length()
+
+def _trailingZeros(bits):
+    return (bits & -bits).bit_length() - 1
+
+
+class _BitWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0
+        self.accBits = 0
+
+    def write(self, value, nbits):
+        self.acc = (self.acc << nbits) | (value & ((1 << nbits) - 1))
+        self.accBits += nbits
+        while self.accBits >= 8:
+            self.accBits -= 8
+            self.data.append((self.acc >> self.accBits) & 0xFF)
+        self.acc &= (1 << self.accBits) - 1
+
+    def bytes(self):
+        """the content, padded with zeros to a whole number of bytes"""
+        data = bytearray(self.data)
+        if self.accBits != 0:
+            data.append((self.acc << (8 - self.accBits)) & 0xFF)
+        return bytes(data)
+
+
+class _BitReader:
+    def __init__(self, data):
+        # indexing a bytearray gives integers with python 2 as well
+        self.data = bytearray(data)
+        self.pos = 0
+
+    def read(self, nbits):
+        first = self.pos >> 3
+        last = (self.pos + nbits + 7) >> 3
+        chunk = int(binascii.hexlify(self.data[first:last]), 16)
+        shift = (last << 3) - self.pos - nbits
+        self.pos += nbits
+        return (chunk >> shift) & ((1 << nbits) - 1)
+
+    def bit(self):
+        value = (self.data[self.pos >> 3] >> (7 - (self.pos & 7))) & 1
+        self.pos += 1
+        return value
+
+
+class OpenTSDBCompressedSeries:
+    """A time series stored in memory with the compression scheme of Facebook's Gorilla.
+
+       Timestamps (in ms) are encoded as delta of delta, so that regular series cost one bit per point.
+       Values are stored as the XOR with the previous value, with only the meaningful bits kept.
+       Typical monitoring data takes a few bytes per point instead of about 100 for a dict entry.
+
+       Points must be appended in increasing time order. Reading decodes the stream sequentially:
+       range scans stop as soon as the end of the range is reached.
+       Missing values (None) are stored as NaN. If only integers are appended, integers are returned."""
+
+    def __init__(self, metric=None, tags=None, aggregateTags=None):
+        self.metric = metric
+        self.tags = tags if tags is not None else {}
+        self.aggregateTags = aggregateTags if aggregateTags is not None else []
+        self.integers = True
+        self._writer = _BitWriter()
+        self._count = 0
+        self._first = None
+        self._last = None
+        self._delta = 0
+        self._value = 0
+        self._leading = 65
+        self._trailing = 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return self.range()
+
+    def nbytes(self):
+        """size of the compressed stream in bytes"""
+        return len(self._writer.data) + (1 if self._writer.accBits else 0)
+
+    def first(self):
+        return self._first
+
+    def last(self):
+        return self._last
+
+    def append(self, timestamp, value):
+        if value is None:
+            value = float("nan")
+        if self.integers and not (isinstance(value,int) and not isinstance(value,bool) and abs(value) < 2**53):
+            self.integers = False
+        bits = _floatBits(float(value))
+        writer = self._writer
+        if self._count == 0:
+            writer.write(timestamp, 64)
+            writer.write(bits, 64)
+            self._first = timestamp
+        else:
+            if timestamp <= self._last:
+                raise ValueError("Points must be appended in increasing time order.")
+            delta = timestamp - self._last
+            self._writeTimestamp(delta - self._delta)
+            self._delta = delta
+            self._writeValue(bits)
+        self._last = timestamp
+        self._value = bits
+        self._count += 1
+
+    def extend(self, points):
+        """appends (timestamp, value) pairs"""
+        for timestamp,value in points:
+            self.append(timestamp, value)
+
+    def _writeTimestamp(self, dod):
+        writer = self._writer
+        if dod == 0:
+            writer.write(0, 1)
+            return
+        for prefix,length,nbits in timestampBuckets:
+            if nbits == 64 or -(1 << (nbits - 1)) < dod <= (1 << (nbits - 1)):
+                writer.write(prefix, length)
+                # values are shifted so that the range is symmetric around 0, as in the paper
+                writer.write(dod - 1 if dod > 0 and nbits < 64 else dod, nbits)
+                return
+
+    def _writeValue(self, bits):
+        writer = self._writer
+        xor = bits ^ self._value
+        if xor == 0:
+            writer.write(0, 1)
+            return
+        leading = min(_leadingZeros(xor), 31)
+        trailing = _trailingZeros(xor)
+        if leading >= self._leading and trailing >= self._trailing:
+            # fits in the previous window of meaningful bits
+            writer.write(0b10, 2)
+            writer.write(xor >> self._trailing, 64 - self._leading - self._trailing)
+            return
+        meaningful = 64 - leading - trailing
+        writer.write(0b11, 2)
+        writer.write(leading, 5)
+        # 64 meaningful bits does not fit in 6 bits, it is stored as 0
+        writer.write(meaningful & 0x3F, 6)
+        writer.write(xor >> trailing, meaningful)
+        self._leading = leading
+        self._trailing = trailing
+
+    def range(self, start=None, end=None):
+        """yields the (timestamp, value) pairs with start <= timestamp <= end"""
+        if self._count == 0:
+            return
+        reader = _BitReader(self._writer.bytes())
+        timestamp = reader.read(64)
+        bits = reader.read(64)
+        delta = 0
+        leading = 0
+        trailing = 0
+        for i in range(self._count):
+            if i > 0:
+                if reader.bit() == 0:
+                    dod = 0
+                else:
+                    for prefix,length,nbits in timestampBuckets[:-1]:
+                        if reader.bit() == 0:
+                            break
+                    else:
+                        nbits = 64
+                    dod = reader.read(nbits)
+                    if nbits < 64:
+                        if dod >= (1 << (nbits - 1)):
+                            dod -= 1 << nbits
+                        dod += 1 if dod >= 0 else 0
+                    elif dod >= (1 << 63):
+                        dod -= 1 << 64
+                delta += dod
+                timestamp += delta
+                if reader.bit() == 1:
+                    if reader.bit() == 1:
+                        leading = reader.read(5)
+                        meaningful = reader.read(6) or 64
+                        trailing = 64 - leading - meaningful
+                    bits ^= reader.read(64 - leading - trailing) << trailing
+            if end is not None and timestamp > end:
+                return
+            if start is None or timestamp >= start:
+                value = _bitsFloat(bits)
+                yield timestamp, (int(value) if self.integers else value)
+
+    @staticmethod
+    def fromResult(result, msResolution=False):
+        """builds a compressed series from a series of the /api/query response.
+           Timestamps are in seconds unless msResolution is set, as in the query."""
+        series = OpenTSDBCompressedSeries(result.get("metric"), result.get("tags"), result.get("aggregateTags"))
+        scale = 1 if msResolution else 1000
+        dps = result.get("dps",{})
+        if isinstance(dps,dict):
+            points = sorted((int(t)*scale,v) for t,v in list(dps.items()))
+        else:
+            # arrays=true format
+            points = sorted((int(t)*scale,v) for t,v in dps)
+        series.extend(points)
+        return series
+
+    def toResult(self, start=None, end=None, msResolution=False):
+        """the series in the /api/query format, optionally restricted to a time range in ms"""
+        return { "metric":self.metric,
+                 "tags":dict(self.tags),
+                 "aggregateTags":list(self.aggregateTags),
+                 "dps":{ str(t if msResolution else t//1000):v for t,v in self.range(start, end) } }
@@ -0,0 +1,187 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import copy
+import time
+from .opentsdbquery import OpenTSDBMetricSubQuery, OpenTSDBtsuidSubQuery, formatDuration, resolveTime
+from .opentsdbengine import parseDownsample
+from .opentsdbplanner import OpenTSDBQueryPlanner
+from .opentsdbbatch import OpenTSDBQueryBatcher
+from .opentsdberrors import OpenTSDBError
+
+class OpenTSDBCostEstimator:
+    """Estimates the number of data points a query will return before it is sent,
+       and applies a policy to the queries above maxPoints:
+           * reject: raises an OpenTSDBError with code 413, without contacting the TSD.
+           * downsample: adds a downsample (with the given aggregator) to the sub queries that have none,
+             coarse enough to fit in the budget.
+           * split: cuts the time range in consecutive windows, each sent as a separate query.
+             The client merges the results.
+
+       The estimate for each sub query is: number of series x time range / interval.
+       The interval is the downsample interval if any, or the expected interval between two points of a series.
+       The number of series is taken from (in order) the tsuids of the sub query, the lookup cache
+       for fully specified sub queries, or the cardinality learned from TSMeta data (see learn and learnTSMeta).
+       Unknown metrics count for defaultSeries series, reported every interval seconds."""
+
+    policies = ["reject", "downsample", "split"]
+
+    def __init__(self, maxPoints=1000000, policy="reject", interval=60, cache=None, defaultSeries=1, aggregator="avg"):
+        if policy not in OpenTSDBCostEstimator.policies:
+            raise ValueError("policy must be one of %s."%", ".join(OpenTSDBCostEstimator.policies))
+        if not isinstance(maxPoints,int) or maxPoints<1:
+            raise ValueError("maxPoints must be a strictly positive integer")
+        self.maxPoints = maxPoints
+        self.policy = policy
+        self.interval = interval
+        self.cache = cache
+        self.defaultSeries = defaultSeries
+        self.aggregator = aggregator
+        # metric -> (number of series, interval in ms or None)
+        self.cardinality = {}
+
+    def learn(self, metric, series, interval=None):
+        """records the number of series of a metric, and optionally the interval between points in seconds"""
+        self.cardinality[metric] = (series, None if interval is None else int(interval*1000))
+
+    def learnTSMeta(self, tsmetas):
+        """learns the cardinality of metrics from a list of TSMeta maps, as returned by get_tsmeta(metric=...).
+           The interval is derived from created, lastReceived and totalDatapoints when the TSD tracks them."""
+        metrics = {}
+        for tsmeta in tsmetas:
+            metric = tsmeta.get("metric")
+            if isinstance(metric,dict):
+                metric = metric.get("name")
+            if metric is None:
+                continue
+            stats = metrics.setdefault(metric,[0,0,0])
+            stats[0] += 1
+            if tsmeta.get("totalDatapoints",0)>1 and tsmeta.get("lastReceived",0)>tsmeta.get("created",0):
+                stats[1] += tsmeta["lastReceived"]-tsmeta["created"]
+                stats[2] += tsmeta["totalDatapoints"]-1
+        for metric,(series,span,points) in list(metrics.items()):
+            self.learn(metric, series, float(span)/points if points else None)
+
+    def seriesCount(self, subquery):
+        if isinstance(subquery,OpenTSDBtsuidSubQuery):
+            return len(subquery.tsuids)
+        if self.cache is not None:
+            target = OpenTSDBQueryPlanner.eligible(subquery)
+            if target is not None:
+                tsuids = self.cache.get(*target)
+                if tsuids is not None:
+                    return len(tsuids)
+        return self.cardinality.get(subquery.metric,(self.defaultSeries,None))[0]
+
+    def rawInterval(self, subquery):
+        """expected interval between two points of a series, in ms"""
+        interval = None
+        if isinstance(subquery,OpenTSDBMetricSubQuery):
+            interval = self.cardinality.get(subquery.metric,(None,None))[1]
+        return interval or int(self.interval*1000)
+
+    def timeRange(self, query, now=None):
+        """start and end of the query in ms"""
+        if now is None: now = int(time.time()*1000)
+        start = resolveTime(query.start, now)
+        end = now if query.end is None else resolveTime(query.end, now)
+        return start, end
+
+    def points(self, subquery, span):
+        """estimated number of points returned by a sub query over span ms"""
+        interval = self.rawInterval(subquery)
+        if subquery.downsample is not None:
+            downsample = parseDownsample(subquery.downsample)[0]
+            interval = max(interval, span if downsample is None else downsample)
+        return self.seriesCount(subquery) * max(1, -(-span//interval))
+
+    def estimate(self, query, now=None):
+        """estimated number of points returned by the query"""
+        start, end = self.timeRange(query, now)
+        return sum(self.points(q, max(end-start,0)) for q in query.subqueries)
+
+    def apply(self, query, now=None):
+        """returns the list of queries to run instead of query, according to the policy"""
+        start, end = self.timeRange(query, now)
+        span = max(end-start,0)
+        total = sum(self.points(q, span) for q in query.subqueries)
+        if total<=self.maxPoints:
+            return [query]
+        if self.policy=="reject":
+            raise OpenTSDBError(413, "Query rejected: about %d data points expected, more than the %d allowed."%(total,self.maxPoints), None, None)
+        if self.policy=="downsample":
+            return [self._downsample(query, span, total)]
+        return self._split(query, start, end, total)
+
+    def _downsample(self, query, span, total):
+        factor = float(total)/self.maxPoints
+        subqueries = []
+        for q in query.subqueries:
+            if q.downsample is None:
+                q = copy.copy(q)
+                interval = int(-(-self.rawInterval(q)*factor//1000))*1000
+                q.downsample = "%s-%s"%(formatDuration(interval), self.aggregator)
+            subqueries.append(q)
+        if sum(self.points(q, span) for q in subqueries)>self.maxPoints:
+            raise OpenTSDBError(413, "Query rejected: too many data points, even after downsampling.", None, None)
+        downsampled = copy.copy(query)
+        downsampled.subqueries = subqueries
+        return downsampled
+
+    def _split(self, query, start, end, total):
+        # windows are aligned on the largest downsample interval so that no bucket is cut in two
+        align = 1
+        for q in query.subqueries:
+            if q.downsample is not None:
+                interval = parseDownsample(q.downsample)[0]
+                if interval is None:
+                    raise OpenTSDBError(413, "Query rejected: a 0all downsample cannot be split.", None, None)
+                align = max(align, interval)
+        count = -(-total//self.maxPoints)
+        length = -(-(end-start)//count)
+        boundaries = [start]
+        for i in range(1,count):
+            boundary = -(-(start+i*length)//align)*align
+            if boundaries[-1]<boundary<end:
+                boundaries.append(boundary)
+        boundaries.append(end+1)
+        queries = []
+        for first,last in zip(boundaries[:-1],boundaries[1:]):
+            window = copy.copy(query)
+            window.start = first
+            window.end = last-1
+            window.showQuery = True
+            queries.append(window)
+        return queries
+
+    @staticmethod
+    def merge(results, query):
+        """merges the results of the windows produced by split into the result of the original query"""
+        merged = [ {} for q in query.subqueries ]
+        for result in results:
+            for index,series in enumerate(OpenTSDBQueryBatcher.demultiplex(result, query.subqueries)):
+                for s in series:
+                    key = (s.get("metric"), tuple(sorted(s.get("tags",{}).items())), tuple(sorted(s.get("aggregateTags",[]))))
+                    if key in merged[index]:
+                        merged[index][key]["dps"].update(s.get("dps",{}))
+                    else:
+                        merged[index][key] = dict(s, dps=dict(s.get("dps",{})))
+        output = []
+        for series in merged:
+            for s in series.values():
+                if not query.showQuery:
+                    s.pop("query",None)
+                output.append(s)
+        return output
@@ -0,0 +1,228 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from .opentsdbquery import relativeFormat, resolveTime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class OpenTSDBDiskCache:
+    """Persistent cache of /api/query results, for jobs that run repeatedly on the same historical windows.
+
+       Only queries on a closed time window are cached: start and end must be absolute and end must be in the past.
+       The key is the URL with the canonical query, so any change of the query is a different entry.
+
+       Each entry is a directory with a small index.json (the series without their data points) and two
+       numpy files holding the timestamps and values of all the series. load returns the series with
+       memory-mapped arrays: nothing is read or copied until the data is used. get rebuilds the usual
+       /api/query format, and together with put implements the cache interface of RESTOpenTSDBClient:
+
+           client = RESTOpenTSDBClient(host, port, cache=OpenTSDBDiskCache("/var/cache/opentsdb"))
+
+       Entries are written to a temporary directory and renamed, so readers never see partial entries.
+       The global index used for eviction is protected by a lock file. The least recently used entries
+       are removed when the cache grows beyond maxBytes."""
+
+    def __init__(self, directory, maxBytes=1024*1024*1024):
+        if np is None:
+            raise ImportError("The disk cache requires numpy.")
+        if fcntl is None:
+            raise ImportError("The disk cache requires fcntl.")
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self._threadLock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(key):
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    @staticmethod
+    def cacheable(key, now=None):
+        """True if the key is a query on a closed time window"""
+        try:
+            query = json.loads(key[key.index("{"):])
+        except ValueError:
+            return False
+        if not isinstance(query,dict) or "queries" not in query or query.get("end") is None:
+            return False
+        for t in [query.get("start"), query["end"]]:
+            if isinstance(t,str) and relativeFormat.match(t):
+                return False
+        if now is None: now = int(time.time()*1000)
+        try:
+            return resolveTime(query["end"])<=now
+        except (TypeError, ValueError):
+            return False
+
+    def _lock(self):
+        self._threadLock.acquire()
+        try:
+            fd = os.open(os.path.join(self.directory, "lock"), os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except Exception:
+            self._threadLock.release()
+            raise
+        return fd
+
+    def _unlock(self, fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        finally:
+            self._threadLock.release()
+
+    def _readIndex(self):
+        try:
+            with open(os.path.join(self.directory, "index.json")) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _writeIndex(self, index):
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.rename(path, os.path.join(self.directory, "index.json"))
+
+    def load(self, key):
+        """the cached series, with memory-mapped timestamps and values arrays instead of dps. None if not cached."""
+        theKey = OpenTSDBDiskCache.key(key)
+        path = os.path.join(self.directory, theKey)
+        try:
+            with open(os.path.join(path, "index.json")) as f:
+                entry = json.load(f)
+            # the files stay readable through the mapping even if the entry is evicted meanwhile
+            timestamps = np.load(os.path.join(path, "timestamps.npy"), mmap_mode="r")
+            values = np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+        except (IOError, ValueError):
+            return None
+        fd = self._lock()
+        try:
+            index = self._readIndex()
+            if theKey in index:
+                index[theKey]["atime"] = time.time()
+                self._writeIndex(index)
+        finally:
+            self._unlock(fd)
+        output = []
+        for s in entry["series"]:
+            series = dict(s["meta"])
+            series["timestamps"] = timestamps[s["offset"]:s["offset"]+s["count"]]
+            series["values"] = values[s["offset"]:s["offset"]+s["count"]]
+            output.append(series)
+        return output
+
+    def get(self, key):
+        """the cached results in the /api/query format, or None"""
+        series = self.load(key)
+        if series is None:
+            return None
+        output = []
+        for s in series:
+            result = { k:v for k,v in list(s.items()) if k not in ["timestamps", "values"] }
+            values = [None if v!=v else v for v in s["values"].tolist()]
+            result["dps"] = { str(t):v for t,v in zip(s["timestamps"].tolist(), values) }
+            output.append(result)
+        return output
+
+    def put(self, key, results):
+        """stores the results of a query on a closed time window. Returns False if they cannot be cached."""
+        if not OpenTSDBDiskCache.cacheable(key) or not isinstance(results,list):
+            return False
+        if not all(isinstance(r,dict) and isinstance(r.get("dps"),dict) for r in results):
+            return False
+        entry = { "key":key, "series":[] }
+        timestamps = []
+        values = []
+        for r in results:
+            dps = sorted((int(t),v) for t,v in list(r["dps"].items()))
+            entry["series"].append({ "meta":{ k:v for k,v in list(r.items()) if k!="dps" },
+                                     "offset":len(timestamps), "count":len(dps) })
+            timestamps += [t for t,v in dps]
+            values += [v for t,v in dps]
+        integers = all(isinstance(v,int) and not isinstance(v,bool) for v in values)
+        values = np.array([float("nan") if v is None else v for v in values], dtype=np.int64 if integers else np.float64)
+        theKey = OpenTSDBDiskCache.key(key)
+        temporary = tempfile.mkdtemp(dir=self.directory)
+        try:
+            np.save(os.path.join(temporary, "timestamps.npy"), np.array(timestamps, dtype=np.int64))
+            np.save(os.path.join(temporary, "values.npy"), values)
+            with open(os.path.join(temporary, "index.json"), "w") as f:
+                json.dump(entry, f)
+            size = sum(os.path.getsize(os.path.join(temporary, f)) for f in os.listdir(temporary))
+            if size>self.maxBytes:
+                return False
+            fd = self._lock()
+            try:
+                path = os.path.join(self.directory, theKey)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                os.rename(temporary, path)
+                index = self._readIndex()
+                index[theKey] = { "size":size, "atime":time.time() }
+                while sum(e["size"] for e in index.values())>self.maxBytes:
+                    self._remove(index, min(index, key=lambda k: index[k]["atime"]))
+                self._writeIndex(index)
+            finally:
+                self._unlock(fd)
+        finally:
+            if os.path.isdir(temporary):
+                shutil.rmtree(temporary)
+        return True
+
+    def _remove(self, index, theKey):
+        index.pop(theKey, None)
+        shutil.rmtree(os.path.join(self.directory, theKey), ignore_errors=True)
+
+    def size(self):
+        """total size of the cached entries in bytes"""
+        fd = self._lock()
+        try:
+            return sum(e["size"] for e in self._readIndex().values())
+        finally:
+            self._unlock(fd)
+
+    def __len__(self):
+        fd = self._lock()
+        try:
+            return len(self._readIndex())
+        finally:
+            self._unlock(fd)
+
+    def clear(self):
+        fd = self._lock()
+        try:
+            index = self._readIndex()
+            for theKey in list(index):
+                self._remove(index, theKey)
+            self._writeIndex(index)
+        finally:
+            self._unlock(fd)
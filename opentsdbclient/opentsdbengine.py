@@ -0,0 +1,277 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import re
+import time
+from .opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, parseDuration, resolveTime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# aggregators interpolating missing values linearly when combining series. Others only use actual values.
+lerpAggregators = ["sum", "min", "max", "avg", "dev"]
+exactAggregators = ["zimsum", "mimmin", "mimmax", "count", "first", "last"]
+percentileFormat = re.compile("^(e?)p(\\d+)(r3|r7)?\\Z")
+downsampleFormat = re.compile("^(\\d+(ms|s|m|h|d|w|n|y)|0all)-([a-z0-9]+)(-(none|nan|null|zero))?\\Z")
+
+# Java Long.MAX_VALUE, the default counterMax of OpenTSDB
+longMax = 9223372036854775807
+
+def parseDownsample(downsample):
+    """splits a downsample specification like 1m-avg-nan into (interval in ms, aggregator, fill policy).
+       The interval is None for 0all."""
+    match = downsampleFormat.match(downsample) if isinstance(downsample,str) else None
+    if match is None:
+        raise ValueError("Invalid downsample specification: %s"%str(downsample))
+    interval = None if match.group(1)=="0all" else parseDuration(match.group(1))
+    if interval==0:
+        raise ValueError("Invalid downsample interval: %s"%downsample)
+    return interval, match.group(3), match.group(5) or "none"
+
+def checkAggregator(aggregator):
+    if aggregator in lerpAggregators or aggregator in exactAggregators or aggregator=="none":
+        return True
+    match = percentileFormat.match(aggregator)
+    if match is None or (match.group(1)=="e")!=(match.group(3) is not None):
+        raise ValueError("Aggregator %s is not supported by the local engine."%aggregator)
+    return True
+
+def _percentiles(values, starts, counts, aggregator):
+    """percentile of each bucket. Values must be sorted within each bucket.
+       pXX follows the default estimation of OpenTSDB (Apache Commons Math, legacy),
+       epXXr3 and epXXr7 the R-3 and R-7 estimations."""
+    match = percentileFormat.match(aggregator)
+    digits = match.group(2)
+    p = int(digits)/100. if len(digits)<=2 else int(digits)/10.**len(digits)
+    n = counts.astype(np.float64)
+    if match.group(3)=="r3":
+        # closest observation, ties to the even order statistic
+        h = n*p - 0.5
+        j = np.floor(h)
+        gamma = np.where((h==j) & (j%2==0), 0, 1)
+        k = np.clip(j+gamma-1, 0, n-1).astype(np.int64)
+        return values[starts+k]
+    if match.group(3)=="r7":
+        h = (n-1)*p
+    else:
+        h = np.clip((n+1)*p - 1, 0, n-1)
+    low = np.floor(h).astype(np.int64)
+    high = np.minimum(low+1, counts-1)
+    return values[starts+low] + (h-low)*(values[starts+high]-values[starts+low])
+
+def reduceBuckets(buckets, values, aggregator):
+    """aggregates values per bucket. Buckets must be sorted.
+       Returns the unique buckets and the aggregated values, vectorized over all the buckets."""
+    if len(buckets)==0:
+        return buckets, values.astype(np.float64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets))+1))
+    ends = np.concatenate((starts[1:], [len(buckets)]))
+    counts = ends - starts
+    keys = buckets[starts]
+    if aggregator in ["sum","zimsum"]:
+        return keys, np.add.reduceat(values, starts)
+    if aggregator in ["min","mimmin"]:
+        return keys, np.minimum.reduceat(values, starts)
+    if aggregator in ["max","mimmax"]:
+        return keys, np.maximum.reduceat(values, starts)
+    if aggregator=="count":
+        return keys, counts.astype(np.float64)
+    if aggregator=="avg":
+        return keys, np.add.reduceat(values, starts)/counts
+    if aggregator=="dev":
+        sums = np.add.reduceat(values, starts)
+        squares = np.add.reduceat(values*values, starts)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variance = (squares - sums*sums/counts)/(counts-1)
+        return keys, np.where(counts>1, np.sqrt(np.maximum(variance,0)), 0.)
+    if aggregator=="first":
+        return keys, values[starts]
+    if aggregator=="last":
+        return keys, values[ends-1]
+    checkAggregator(aggregator)
+    order = np.lexsort((values, buckets))
+    return keys, _percentiles(values[order], starts, counts, aggregator)
+
+def downsample(timestamps, values, interval, aggregator, fillPolicy="none", start=None, end=None):
+    """downsamples one series. Timestamps are in ms and sorted.
+       Buckets are aligned on multiples of the interval and identified by their start.
+       With a fill policy other than none, empty buckets between start and end are filled."""
+    if interval is None:
+        # 0all: a single bucket for the whole range
+        if len(timestamps)==0:
+            return timestamps, values
+        first = timestamps[0] if start is None else start
+        keys, result = reduceBuckets(np.zeros(len(timestamps),dtype=np.int64), values, aggregator)
+        return np.array([first],dtype=np.int64), result
+    buckets = timestamps - timestamps % interval
+    keys, result = reduceBuckets(buckets, values, aggregator)
+    if fillPolicy=="none" or (len(keys)==0 and (start is None or end is None)):
+        return keys, result
+    first = (start - start % interval) if start is not None else keys[0]
+    last = (end - end % interval) if end is not None else keys[-1]
+    grid = np.arange(first, last+1, interval, dtype=np.int64)
+    filled = np.full(len(grid), 0. if fillPolicy=="zero" else np.nan)
+    inside = (keys>=first) & (keys<=last)
+    filled[(keys[inside]-first)//interval] = result[inside]
+    return grid, filled
+
+def rate(timestamps, values, counter=False, counterMax=None, resetValue=None):
+    """per second rate of change of one series. The first point is dropped.
+       For counters, a decrease is a rollover at counterMax.
+       If resetValue is set, rates above it are considered as counter resets and replaced by 0."""
+    if len(timestamps)<2:
+        return timestamps[:0], values[:0].astype(np.float64)
+    delta = np.diff(values).astype(np.float64)
+    if counter:
+        maximum = float(longMax if counterMax is None else counterMax)
+        rollover = delta<0
+        delta[rollover] = maximum - values[:-1][rollover] + values[1:][rollover]
+    result = delta/(np.diff(timestamps)/1000.)
+    if counter and resetValue is not None and resetValue>0:
+        result[result>resetValue] = 0.
+    return timestamps[1:], result
+
+def aggregate(series, aggregator):
+    """combines several series (list of (timestamps, values)) into one.
+       For most aggregators, series are linearly interpolated on the union of the timestamps,
+       within their own time range. zimsum, mimmin, mimmax, count, first and last only use actual values."""
+    series = [(t,v) for t,v in series if len(t)]
+    if len(series)==0:
+        return np.array([],dtype=np.int64), np.array([],dtype=np.float64)
+    grid = np.unique(np.concatenate([t for t,_ in series]))
+    matrix = np.full((len(series),len(grid)), np.nan)
+    for i,(t,v) in enumerate(series):
+        v = v.astype(np.float64)
+        if aggregator in exactAggregators:
+            matrix[i,np.searchsorted(grid,t)] = v
+        else:
+            matrix[i] = np.interp(grid, t, v, left=np.nan, right=np.nan)
+    # flatten column by column: buckets are the grid indices, series order is kept within a bucket
+    present = ~np.isnan(matrix.T)
+    columns = np.nonzero(present)[0]
+    keys, result = reduceBuckets(columns, matrix.T[present], aggregator)
+    # timestamps where all the series are missing (filled with NaN) stay missing
+    output = np.full(len(grid), np.nan)
+    output[keys] = result
+    return grid, output
+
+
+class OpenTSDBLocalEngine:
+    """Computes OpenTSDB views of raw series on the client side: filtering, grouping,
+       downsampling with fill policies, counter-aware rates and aggregation across series.
+       The same raw data can then be viewed at several resolutions and with several aggregators
+       without sending more queries to the TSD:
+
+           engine = OpenTSDBLocalEngine.fetch(client, "sys.cpu.user", "1d-ago")
+           hourly_max = engine.view("max", downsample="1h-max")
+           p99 = engine.view("p99", downsample="1m-p99")
+
+       As in OpenTSDB, each series is first downsampled, then converted to a rate and finally aggregated.
+       Computations are vectorized with numpy."""
+
+    def __init__(self, results, start=None, end=None):
+        """results are series as returned by /api/query, typically with the none aggregator."""
+        if np is None:
+            raise ImportError("The local engine requires numpy.")
+        self.start = None if start is None else resolveTime(start)
+        self.end = None if end is None else resolveTime(end)
+        self.series = [OpenTSDBLocalEngine.arrays(r, self.start, self.end) for r in results]
+
+    @staticmethod
+    def fetch(client, metric, start, end=None, filters=None):
+        """fetches every raw series of the metric matching the filters once, and returns an engine on them"""
+        subquery = OpenTSDBMetricSubQuery("none", metric, filters=filters)
+        query = OpenTSDBQuery([subquery], start, end, msResolution=True)
+        now = int(time.time()*1000)
+        return OpenTSDBLocalEngine(client.query(query), resolveTime(start, now), None if end is None else resolveTime(end, now))
+
+    @staticmethod
+    def arrays(result, start=None, end=None):
+        """converts a series from the /api/query response to numpy arrays, restricted to [start, end]"""
+        dps = result.get("dps",{})
+        timestamps = np.fromiter((int(t) for t in dps), dtype=np.int64, count=len(dps))
+        # same convention as the TSD: more than 10 digits means milliseconds
+        timestamps = np.where(timestamps<10**10, timestamps*1000, timestamps)
+        values = np.array([float("nan") if v is None else v for v in dps.values()], dtype=np.float64)
+        order = np.argsort(timestamps, kind="stable")
+        timestamps, values = timestamps[order], values[order]
+        keep = ~np.isnan(values)
+        if start is not None: keep &= timestamps>=start
+        if end is not None: keep &= timestamps<=end
+        return { "metric":result.get("metric"),
+                 "tags":result.get("tags",{}),
+                 "timestamps":timestamps[keep],
+                 "values":values[keep] }
+
+    def view(self, aggregator, downsample=None, rate=False, counterMax=None, resetValue=None, filters=None, msResolution=False):
+        """computes one view of the raw series. Arguments have the meaning of OpenTSDBMetricSubQuery."""
+        metric = self.series[0]["metric"] if len(self.series) else "local"
+        return self.run(OpenTSDBMetricSubQuery(aggregator, metric, rate=rate, counterMax=counterMax, resetValue=resetValue,
+                                               downsample=downsample, filters=filters), msResolution)
+
+    def run(self, subquery, msResolution=False):
+        """computes the result of a metric sub query on the raw series, in the /api/query format"""
+        subquery.check()
+        checkAggregator(subquery.aggregator)
+        downsampling = parseDownsample(subquery.downsample) if subquery.downsample is not None else None
+        if downsampling is not None:
+            checkAggregator(downsampling[1])
+        filters = subquery.filters or []
+        groupBy = sorted(set(f.tagKey for f in filters if f.groupBy))
+        groups = {}
+        for s in self.series:
+            if s["metric"] is not None and s["metric"]!=subquery.metric: continue
+            if not all(f.match(s["tags"]) for f in filters): continue
+            if subquery.aggregator=="none":
+                key = (len(groups),)
+            else:
+                key = tuple(s["tags"].get(k) for k in groupBy)
+            groups.setdefault(key,[]).append(s)
+        output = []
+        for key in sorted(groups, key=lambda k: [str(x) for x in k]):
+            members = groups[key]
+            processed = []
+            for s in members:
+                t, v = s["timestamps"], s["values"]
+                if downsampling is not None:
+                    t, v = downsample(t, v, downsampling[0], downsampling[1], downsampling[2], self.start, self.end)
+                if subquery.rate:
+                    t, v = rate(t, v, True, subquery.counterMax, subquery.resetValue)
+                processed.append((t,v))
+            if subquery.aggregator=="none":
+                t, v = processed[0]
+            else:
+                t, v = aggregate(processed, subquery.aggregator)
+            output.append(self._format(subquery.metric, members, t, v, msResolution, downsampling is not None and downsampling[2]=="null"))
+        return output
+
+    def _format(self, metric, members, timestamps, values, msResolution, null):
+        common = dict(members[0]["tags"])
+        aggregated = set()
+        for s in members[1:]:
+            for k,v in list(common.items()):
+                if s["tags"].get(k)!=v:
+                    del common[k]
+                    aggregated.add(k)
+        for s in members:
+            aggregated |= set(k for k in s["tags"] if k not in common)
+        if not msResolution:
+            timestamps = timestamps//1000
+        dps = {}
+        for t,v in zip(timestamps.tolist(), values.tolist()):
+            dps[str(t)] = None if (null and v!=v) else v
+        return { "metric":metric, "tags":common, "aggregateTags":sorted(aggregated), "dps":dps }
@@ -0,0 +1,290 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import ast
+import json
+import numbers
+import operator
+import sys
+from .opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBFilter
+from .opentsdbbatch import OpenTSDBQueryBatcher
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class OpenTSDBExpressionEngine:
+    """Evaluates an OpenTSDBExpQuery on the client side.
+       This gives expressions to servers older than 2.3 and saves TSD CPU on newer ones.
+
+       Each distinct metric of the query is fetched once, with a single /api/query call.
+       Series of the different variables are then joined on their tags (union or intersection),
+       aligned on a common time grid, with missing values replaced according to the fill policy.
+       Expressions, possibly nested, are evaluated on numpy arrays.
+       The output follows the format of /api/query/exp.
+
+       Only basic operations are supported: addition, subtraction, multiplication, division, modulo."""
+
+    operators = { ast.Add: operator.add,
+                  ast.Sub: operator.sub,
+                  ast.Mult: operator.mul,
+                  ast.Div: operator.truediv,
+                  ast.Mod: operator.mod }
+
+    unaryOperators = { ast.USub: operator.neg,
+                       ast.UAdd: operator.pos }
+
+    # numeric literals are ast.Num before python 3.8
+    literals = (ast.Constant,) if sys.version_info>=(3,8) else (ast.Num,)
+
+    def __init__(self, client):
+        if np is None:
+            raise ImportError("The client-side expression engine requires numpy.")
+        self.client = client
+
+    def evaluate(self, expQuery):
+        """runs the query and returns a map similar to the /api/query/exp response"""
+        expQuery.check()
+        metrics = self.fetch(expQuery)
+        expressions = { e["id"]:e for e in expQuery.expressions }
+        for theId in expressions:
+            if theId in metrics:
+                raise ValueError("Expression id %s is also used as metric id."%theId)
+        queryTags = self._queryTags(expQuery)
+        fillPolicies = { m["id"]:m.get("fillPolicy") for m in expQuery.metrics }
+        fillPolicies.update({ e["id"]:e.get("fillPolicy") for e in expQuery.expressions })
+        values = dict(metrics)
+
+        def resolve(theId, visiting):
+            if theId in values:
+                return values[theId]
+            if theId not in expressions:
+                raise ValueError("Unknown variable %s in expression."%theId)
+            if theId in visiting:
+                raise ValueError("Circular dependency detected for expression %s."%theId)
+            visiting.add(theId)
+            expression = expressions[theId]
+            tree = OpenTSDBExpressionEngine.parse(expression["expr"])
+            variables = { name:resolve(name, visiting) for name in OpenTSDBExpressionEngine.variables(tree) }
+            visiting.discard(theId)
+            values[theId] = self._evaluate(tree, variables, expression.get("join"), fillPolicies, queryTags)
+            return values[theId]
+
+        for theId in expressions:
+            resolve(theId, set())
+        if expQuery.outputs is None:
+            outputs = [ { "id":e["id"] } for e in expQuery.expressions ]
+        else:
+            outputs = expQuery.outputs
+        result = []
+        for output in outputs:
+            if output["id"] not in values:
+                raise ValueError("Unknown output %s."%output["id"])
+            result.append(self._output(output, values[output["id"]], fillPolicies.get(output["id"])))
+        return { "outputs":result, "query":expQuery.getMap() }
+
+    def fetch(self, expQuery):
+        """runs a single query for all the metrics. Returns a map metric id -> list of series.
+           Metrics defined twice with the same filter and aggregator are only fetched once."""
+        time = expQuery.timeSection
+        filters = { f["id"]:f["tags"] for f in expQuery.filters }
+        subqueries = []
+        index = {}
+        metricIndex = {}
+        for m in expQuery.metrics:
+            if m["filter"] not in filters:
+                raise ValueError("Unknown filter %s for metric %s."%(m["filter"],m["id"]))
+            subquery = OpenTSDBExpressionEngine.subquery(m, filters[m["filter"]], time)
+            key = json.dumps(subquery.getMap(), sort_keys=True)
+            if key not in index:
+                index[key] = len(subqueries)
+                subqueries.append(subquery)
+            metricIndex[m["id"]] = index[key]
+        query = OpenTSDBQuery(subqueries, time["start"], time.get("end"), msResolution=True, showQuery=True)
+        results = OpenTSDBQueryBatcher.demultiplex(self.client.query(query), subqueries)
+        series = [ [OpenTSDBExpressionEngine.series(r) for r in result] for result in results ]
+        return { theId:series[i] for theId,i in list(metricIndex.items()) }
+
+    @staticmethod
+    def subquery(metric, filters, time):
+        """builds the metric sub query for one metric of the expression query"""
+        downsample = None
+        downsampler = time.get("downsampler")
+        if downsampler is not None:
+            downsample = "%s-%s"%(downsampler["interval"], downsampler["aggregator"])
+            fill = downsampler.get("fillPolicy")
+            # scalar fill cannot be expressed in the downsample string. Missing points are then handled by the metric fill policy.
+            if fill is not None and fill["policy"]!="scalar":
+                downsample += "-" + fill["policy"]
+        return OpenTSDBMetricSubQuery(metric.get("aggregator",time["aggregator"]), metric["metric"],
+                                      rate=time.get("rate",False), downsample=downsample,
+                                      filters=[OpenTSDBFilter(f["type"], f["tagk"], f["filter"], f.get("groupBy",False)) for f in filters])
+
+    @staticmethod
+    def series(result):
+        """converts a series from the /api/query response to numpy arrays"""
+        dps = result.get("dps",{})
+        timestamps = np.array(sorted(int(t) for t in dps), dtype=np.int64)
+        values = np.array([dps[str(t)] for t in timestamps], dtype=np.float64)
+        return { "metrics":[result["metric"]],
+                 "tags":result.get("tags",{}),
+                 "aggregateTags":result.get("aggregateTags",[]),
+                 "timestamps":timestamps,
+                 "values":values }
+
+    @staticmethod
+    def parse(expr):
+        """parses an expression, accepting only numbers, variables and the basic operators"""
+        try:
+            tree = ast.parse(expr, mode="eval")
+        except SyntaxError:
+            raise ValueError("Invalid expression: %s"%expr)
+        for node in ast.walk(tree):
+            if isinstance(node,(ast.Expression, ast.Name, ast.Load)):
+                continue
+            if OpenTSDBExpressionEngine.literal(node) is not None:
+                continue
+            if isinstance(node,ast.BinOp) and type(node.op) in OpenTSDBExpressionEngine.operators:
+                continue
+            if isinstance(node,ast.UnaryOp) and type(node.op) in OpenTSDBExpressionEngine.unaryOperators:
+                continue
+            if type(node) in OpenTSDBExpressionEngine.operators or type(node) in OpenTSDBExpressionEngine.unaryOperators:
+                continue
+            raise ValueError("Unsupported element in expression: %s"%expr)
+        return tree
+
+    @staticmethod
+    def literal(node):
+        """the value of a numeric literal, or None"""
+        if not isinstance(node,OpenTSDBExpressionEngine.literals):
+            return None
+        value = node.value if sys.version_info>=(3,8) else node.n
+        if isinstance(value,bool) or not isinstance(value,numbers.Real):
+            return None
+        return value
+
+    @staticmethod
+    def variables(tree):
+        return sorted(set(node.id for node in ast.walk(tree) if isinstance(node,ast.Name)))
+
+    @staticmethod
+    def fillValue(fillPolicy):
+        if fillPolicy is None:
+            return np.nan
+        if fillPolicy["policy"]=="zero":
+            return 0.
+        if fillPolicy["policy"]=="scalar":
+            return float(fillPolicy["value"])
+        return np.nan
+
+    @staticmethod
+    def reindex(series, grid, fill):
+        """the values of the series on the grid, with fill for the missing timestamps"""
+        values = np.full(len(grid), fill, dtype=np.float64)
+        values[np.searchsorted(grid, series["timestamps"])] = series["values"]
+        return values
+
+    def _queryTags(self, expQuery):
+        """the tag keys used in the filter of each metric"""
+        filters = { f["id"]:f["tags"] for f in expQuery.filters }
+        return { m["id"]:set(f["tagk"] for f in filters[m["filter"]]) for m in expQuery.metrics }
+
+    def _joinKey(self, series, join, tagKeys):
+        tags = series["tags"]
+        if join.get("useQueryTags",False) and tagKeys is not None:
+            tags = { k:v for k,v in list(tags.items()) if k in tagKeys }
+        key = tuple(sorted(tags.items()))
+        if join.get("includeAggTags",True):
+            key += tuple(sorted(series["aggregateTags"]))
+        return key
+
+    def _evaluate(self, tree, variables, join, fillPolicies, queryTags):
+        join = join or {}
+        tagKeys = None
+        for name in variables:
+            if name in queryTags:
+                tagKeys = (tagKeys or set()) | queryTags[name]
+        joined = {}
+        for name,series in list(variables.items()):
+            joined[name] = {}
+            for s in series:
+                joined[name][self._joinKey(s, join, tagKeys)] = s
+        keysets = [set(v.keys()) for v in joined.values()]
+        if len(keysets)==0:
+            keys = [()]
+        elif join.get("operator","union")=="intersection":
+            keys = sorted(set.intersection(*keysets))
+        elif join.get("operator","union")=="union":
+            keys = sorted(set.union(*keysets))
+        else:
+            raise ValueError("Unknown join operator %s."%join["operator"])
+        output = []
+        for key in keys:
+            present = [ joined[name][key] for name in sorted(joined) if key in joined[name] ]
+            grid = np.unique(np.concatenate([s["timestamps"] for s in present])) if present else np.array([],dtype=np.int64)
+            arrays = {}
+            for name in joined:
+                fill = OpenTSDBExpressionEngine.fillValue(fillPolicies.get(name))
+                if key in joined[name]:
+                    arrays[name] = OpenTSDBExpressionEngine.reindex(joined[name][key], grid, fill)
+                else:
+                    arrays[name] = np.full(len(grid), fill, dtype=np.float64)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = self._compute(tree.body, arrays, len(grid))
+            metrics = []
+            for s in present:
+                metrics += [m for m in s["metrics"] if m not in metrics]
+            output.append({ "metrics":metrics,
+                            "tags":present[0]["tags"] if present else {},
+                            "aggregateTags":sorted(set(t for s in present for t in s["aggregateTags"])),
+                            "timestamps":grid,
+                            "values":values })
+        return output
+
+    def _compute(self, node, arrays, size):
+        if isinstance(node,ast.BinOp):
+            return OpenTSDBExpressionEngine.operators[type(node.op)](self._compute(node.left, arrays, size), self._compute(node.right, arrays, size))
+        if isinstance(node,ast.UnaryOp):
+            return OpenTSDBExpressionEngine.unaryOperators[type(node.op)](self._compute(node.operand, arrays, size))
+        if isinstance(node,ast.Name):
+            return arrays[node.id]
+        return np.full(size, float(OpenTSDBExpressionEngine.literal(node)), dtype=np.float64)
+
+    def _output(self, output, series, fillPolicy):
+        """formats a list of series as an output of /api/query/exp"""
+        if len(series):
+            grid = np.unique(np.concatenate([s["timestamps"] for s in series]))
+        else:
+            grid = np.array([],dtype=np.int64)
+        columns = np.column_stack([grid.astype(np.float64)] + [OpenTSDBExpressionEngine.reindex(s, grid, np.nan) for s in series])
+        null = fillPolicy is not None and fillPolicy["policy"]=="null"
+        dps = []
+        for row in columns.tolist():
+            values = [None if (null and v!=v) else v for v in row[1:]]
+            dps.append([int(row[0])] + values)
+        meta = [ { "index":0, "metrics":["timestamp"] } ]
+        for i,s in enumerate(series):
+            meta.append({ "index":i+1, "metrics":s["metrics"], "commonTags":s["tags"], "aggregatedTags":s["aggregateTags"] })
+        result = { "id":output["id"],
+                   "dps":dps,
+                   "dpsMeta":{ "firstTimestamp":int(grid[0]) if len(grid) else 0,
+                               "lastTimestamp":int(grid[-1]) if len(grid) else 0,
+                               "setCount":len(grid),
+                               "series":len(series) },
+                   "meta":meta }
+        if "alias" in output:
+            result["alias"] = output["alias"]
+        return result
@@ -0,0 +1,133 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from .opentsdbquery import OpenTSDBMetricSubQuery, OpenTSDBFilter
+from .opentsdbengine import OpenTSDBLocalEngine
+
+# aggregators whose partial results on disjoint sets of series can be combined, and how
+combinedAggregators = { "sum":"sum", "zimsum":"zimsum", "count":"zimsum",
+                        "min":"min", "max":"max", "mimmin":"mimmin", "mimmax":"mimmax" }
+
+class OpenTSDBFanOut:
+    """Runs a query as several concurrent queries, each restricted to a shard of the values of a tag key.
+
+       Each metric sub query gets an extra literal_or filter on tagKey listing the values of its shard.
+       Shards are sent in parallel, round robin on the given clients (one per TSD).
+       Results are then put back together:
+           * if the sub query groups by tagKey (or uses the none aggregator), shards hold disjoint groups
+             and are simply concatenated;
+           * sum, zimsum, count, min, max, mimmin and mimmax are recombined from the partial aggregates of each shard;
+           * other aggregators (avg, dev, percentiles, ...) are computed locally from the individual series,
+             fetched with the none aggregator.
+       Local recombination requires numpy.
+
+       The tag values are taken from a literal_or filter of the sub query on tagKey, from values,
+       or looked up on the TSD (search LOOKUP)."""
+
+    def __init__(self, clients, tagKey, shards=8, values=None, workers=None):
+        if not isinstance(clients,list):
+            clients = [clients]
+        if len(clients)<1:
+            raise ValueError("At least one client is required.")
+        if not isinstance(shards,int) or shards<1:
+            raise ValueError("shards must be a strictly positive integer")
+        self.clients = clients
+        self.tagKey = tagKey
+        self.shards = shards
+        self.values = values
+        self.workers = workers
+
+    def tagValues(self, subquery):
+        """the values of tagKey the sub query can select"""
+        for f in subquery.filters or []:
+            if f.tagKey==self.tagKey and f.filterType=="literal_or":
+                return sorted(set(f.filterExpression.split("|")))
+        if self.values is not None:
+            return sorted(set(self.values))
+        response = self.clients[0].search("LOOKUP", metric=subquery.metric, tags={self.tagKey:"*"})
+        results = response.get("results",[])
+        if response.get("totalResults",len(results))>len(results):
+            raise ValueError("Incomplete lookup of the values of %s: give them explicitly."%self.tagKey)
+        return sorted(set(r["tags"][self.tagKey] for r in results if self.tagKey in r.get("tags",{})))
+
+    def partition(self, values):
+        """splits the values in at most shards lists of similar sizes"""
+        count = min(self.shards, len(values))
+        return [values[i::count] for i in range(count)]
+
+    def _mode(self, subquery):
+        if subquery.aggregator=="none" or any(f.tagKey==self.tagKey and f.groupBy for f in subquery.filters or []):
+            return "concatenate"
+        if subquery.aggregator in combinedAggregators:
+            return "combine"
+        return "raw"
+
+    def shardQueries(self, query, subquery):
+        """the queries to send for one sub query, one per shard"""
+        mode = self._mode(subquery)
+        queries = []
+        for shard in self.partition(self.tagValues(subquery)):
+            q = copy.copy(subquery)
+            if mode=="raw":
+                q.aggregator = "none"
+            q.filters = list(subquery.filters or []) + [OpenTSDBFilter("literal_or", self.tagKey, "|".join(shard))]
+            shardQuery = copy.copy(query)
+            shardQuery.subqueries = [q]
+            queries.append(shardQuery)
+        return queries
+
+    def query(self, query):
+        """runs the query, fanned out on the shards. Tsuid sub queries are sent as they are."""
+        query.check()
+        jobs = []
+        for subquery in query.subqueries:
+            if isinstance(subquery,OpenTSDBMetricSubQuery):
+                jobs.append((subquery, self.shardQueries(query, subquery)))
+            else:
+                single = copy.copy(query)
+                single.subqueries = [subquery]
+                jobs.append((subquery, [single]))
+        queries = [q for _,shardQueries in jobs for q in shardQueries]
+        with ThreadPoolExecutor(max_workers=self.workers or max(len(queries),1)) as executor:
+            futures = [executor.submit(self.clients[i%len(self.clients)].query, q) for i,q in enumerate(queries)]
+            results = [f.result() or [] for f in futures]
+        output = []
+        for subquery,shardQueries in jobs:
+            shardResults = results[:len(shardQueries)]
+            results = results[len(shardQueries):]
+            output += self._merge(subquery, shardResults, query.msResolution)
+        return output
+
+    def _merge(self, subquery, shardResults, msResolution):
+        mode = self._mode(subquery) if isinstance(subquery,OpenTSDBMetricSubQuery) else "concatenate"
+        series = [s for r in shardResults for s in r]
+        if mode=="concatenate":
+            return series
+        # group on the tags the sub query groups by, and aggregate locally
+        groupBy = sorted(set(f.tagKey for f in subquery.filters or [] if f.groupBy))
+        regroup = OpenTSDBMetricSubQuery(combinedAggregators[subquery.aggregator] if mode=="combine" else subquery.aggregator,
+                                         subquery.metric, filters=[OpenTSDBFilter("wildcard", k, "*", True) for k in groupBy])
+        merged = OpenTSDBLocalEngine(series).run(regroup, msResolution)
+        if mode=="combine":
+            # tags aggregated within the shards stay aggregated
+            for m in merged:
+                aggregated = set(m["aggregateTags"])
+                for s in series:
+                    if all(s.get("tags",{}).get(k)==m["tags"].get(k) for k in groupBy):
+                        aggregated |= set(s.get("aggregateTags",[]))
+                m["aggregateTags"] = sorted(aggregated)
+        return merged
@@ -0,0 +1,176 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import copy
+import json
+import threading
+import time
+from .opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBtsuidSubQuery, parseDuration, formatDuration, resolveTime
+
+# how a coarser bucket is computed from the buckets of a finer level, per downsample aggregator.
+# avg is an approximation when the finer buckets do not hold the same number of points.
+derivedAggregators = { "sum":"sum", "zimsum":"sum", "count":"sum",
+                       "min":"min", "mimmin":"min", "max":"max", "mimmax":"max",
+                       "first":"first", "last":"last", "avg":"avg" }
+
+def _reduce(values, aggregator):
+    if aggregator=="sum": return sum(values)
+    if aggregator=="min": return min(values)
+    if aggregator=="max": return max(values)
+    if aggregator=="first": return values[0]
+    if aggregator=="last": return values[-1]
+    return sum(values)/float(len(values))
+
+def _missing(coverage, start, end):
+    """the parts of [start,end[ not in the coverage, a sorted list of disjoint [a,b[ intervals"""
+    gaps = []
+    for a,b in coverage:
+        if b<=start: continue
+        if a>=end: break
+        if a>start: gaps.append([start,a])
+        start = max(start,b)
+    if start<end: gaps.append([start,end])
+    return gaps
+
+def _cover(coverage, start, end):
+    """adds [start,end[ to the coverage, merging overlapping and adjacent intervals"""
+    merged = []
+    for a,b in sorted(coverage + [[start,end]]):
+        if merged and a<=merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1],b)
+        else:
+            merged.append([a,b])
+    return merged
+
+
+class OpenTSDBLODCache:
+    """Level of detail cache for zoomable charts.
+
+       For each sub query (metric, filters, aggregator) and downsample aggregator, the cache keeps a pyramid of
+       downsampled versions of the series, one per level (10s, 1m, 10m and 1h by default).
+       A request is answered from the finest level that respects the point budget, when it is cached
+       over the whole time range. Otherwise its missing ranges are computed from a finer cached level
+       when possible (coarse buckets are reductions of fine buckets, like in a RRD),
+       and only what remains is fetched from the TSD.
+
+       The bucket containing now is never cached, so that recent data is always fresh."""
+
+    def __init__(self, client, levels=["10s","1m","10m","1h"], aggregator="avg"):
+        self.client = client
+        self.levels = sorted(parseDuration(l) for l in levels)
+        if len(self.levels)<1:
+            raise ValueError("At least one level is required.")
+        self.aggregator = aggregator
+        self._lock = threading.Lock()
+        # key -> level -> { "coverage":[[a,b[,...], "series":{ series key -> (series map, {ts:value}) } }
+        self._pyramids = {}
+
+    @staticmethod
+    def key(subquery, aggregator):
+        myself = subquery.getMap()
+        myself.pop("downsample",None)
+        return (json.dumps(myself, sort_keys=True), aggregator)
+
+    def level(self, span, points):
+        """the finest level giving at most about points values over span ms (the coarsest one if none does)"""
+        for interval in self.levels:
+            if span/float(interval)<=points:
+                return interval
+        return self.levels[-1]
+
+    def query(self, subquery, start, end=None, points=800, aggregator=None, msResolution=False, now=None):
+        """returns the series of the sub query over the time range, in the /api/query format,
+           with at most about points values per series."""
+        if not isinstance(subquery,(OpenTSDBMetricSubQuery,OpenTSDBtsuidSubQuery)):
+            raise TypeError("Subqueries must be either OpenTSDBMetricSubQuery or OpenTSDBtsuidSubQuery.")
+        subquery.check()
+        if aggregator is None:
+            aggregator = self.aggregator if subquery.downsample is None else subquery.downsample.split("-")[1]
+        if now is None: now = int(time.time()*1000)
+        start = resolveTime(start, now)
+        end = now if end is None else resolveTime(end, now)
+        key = OpenTSDBLODCache.key(subquery, aggregator)
+        target = self.level(end-start, points)
+        with self._lock:
+            pyramid = self._pyramids.setdefault(key, {})
+            level = pyramid.setdefault(target, { "coverage":[], "series":{} })
+            gaps = _missing(level["coverage"], start//target*target, -(-(end+1)//target)*target)
+            if not gaps:
+                return self._format(level, start//target*target, end, msResolution)
+            gaps = self._derive(pyramid, target, aggregator, gaps)
+        # the TSD is contacted without holding the lock
+        for a,b in gaps:
+            self._fetch(subquery, key, target, aggregator, a, b, now)
+        with self._lock:
+            return self._format(self._pyramids[key][target], start//target*target, end, msResolution)
+
+    def _derive(self, pyramid, target, aggregator, gaps):
+        """fills gaps of the target level from finer levels. Returns the gaps that remain."""
+        derived = derivedAggregators.get(aggregator)
+        if derived is None:
+            return gaps
+        level = pyramid[target]
+        for interval in sorted(pyramid, reverse=True):
+            if interval>=target or target%interval!=0:
+                continue
+            finer = pyramid[interval]
+            remaining = []
+            for a,b in gaps:
+                if _missing(finer["coverage"], a, b):
+                    remaining.append([a,b])
+                    continue
+                for seriesKey,(meta,dps) in list(finer["series"].items()):
+                    buckets = {}
+                    for t in sorted(dps):
+                        if a<=t<b:
+                            buckets.setdefault(t//target*target,[]).append(dps[t])
+                    values = level["series"].setdefault(seriesKey,(meta,{}))[1]
+                    for t,bucket in list(buckets.items()):
+                        values[t] = _reduce(bucket, derived)
+                level["coverage"] = _cover(level["coverage"], a, b)
+            gaps = remaining
+        return gaps
+
+    def _fetch(self, subquery, key, interval, aggregator, start, end, now):
+        # the current bucket is incomplete: it is returned but not marked as cached
+        complete = min(end, now//interval*interval)
+        q = copy.copy(subquery)
+        q.downsample = "%s-%s"%(formatDuration(interval), aggregator)
+        results = self.client.query(OpenTSDBQuery([q], start, end-1, msResolution=True))
+        with self._lock:
+            level = self._pyramids.setdefault(key, {}).setdefault(interval, { "coverage":[], "series":{} })
+            for s in results or []:
+                seriesKey = (s.get("metric"), tuple(sorted(s.get("tags",{}).items())), tuple(sorted(s.get("aggregateTags",[]))))
+                meta = { k:v for k,v in list(s.items()) if k!="dps" }
+                values = level["series"].setdefault(seriesKey,(meta,{}))[1]
+                for t,v in list(s.get("dps",{}).items()):
+                    values[int(t)] = v
+            if complete>start:
+                level["coverage"] = _cover(level["coverage"], start, complete)
+
+    def _format(self, level, start, end, msResolution):
+        output = []
+        for meta,dps in level["series"].values():
+            points = [(t,dps[t]) for t in sorted(dps) if start<=t<=end]
+            if not points:
+                continue
+            series = dict(meta)
+            series["dps"] = { str(t if msResolution else t//1000):v for t,v in points }
+            output.append(series)
+        return output
+
+    def clear(self):
+        with self._lock:
+            self._pyramids.clear()
@@ -0,0 +1,91 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+from .opentsdberrors import OpenTSDBError
+from .opentsdbobjects import OpenTSDBTimeSeries
+
+class OpenTSDBMetaLoader:
+    """Loads the meta data of many time series at once, as OpenTSDBTimeSeries.loadFrom does for one.
+
+       With a search query, the TSMeta records are first fetched with search TSMETA, in pages of at least pageSize
+       (this requires a search plugin on the TSD). The series not found that way are loaded with get_tsmeta,
+       up to workers requests in parallel. The metric and tags of series given by their TSUID are taken
+       from the TSMeta record itself, without the LOOKUP done by loadFrom.
+
+           loader = OpenTSDBMetaLoader(client, workers=16)
+           series = loader.load(tsuids, query="sys.cpu.*")
+
+       As for loadFrom, the TSMeta of series that have none yet is created if create is True."""
+
+    def __init__(self, client, workers=8, pageSize=1000, create=True):
+        self.client = client
+        self.workers = workers
+        self.pageSize = pageSize
+        self.create = create
+
+    @staticmethod
+    def key(metric, tags):
+        return (metric, tuple(sorted(tags.items())))
+
+    def search(self, query):
+        """all the TSMeta records matching a search query, fetched page by page"""
+        return list(self.client.search_iter("TSMETA", query=query, pageSize=self.pageSize, maxPageSize=max(self.pageSize,10000)))
+
+    def load(self, series, query=None):
+        """returns populated OpenTSDBTimeSeries for a list of OpenTSDBTimeSeries and/or TSUIDs"""
+        series = [OpenTSDBTimeSeries(tsuid=ts) if isinstance(ts,str) else ts for ts in series]
+        byTsuid = {}
+        byName = {}
+        if query is not None:
+            for meta in self.search(query):
+                byTsuid[meta["tsuid"]] = meta
+                byName[OpenTSDBMetaLoader.key(meta["metric"]["name"], OpenTSDBTimeSeries.metaTags(meta))] = meta
+        pending = []
+        for ts in series:
+            if ts.metadata.tsuid is not None:
+                meta = byTsuid.get(ts.metadata.tsuid)
+            else:
+                meta = byName.get(OpenTSDBMetaLoader.key(ts.metric, ts.tags))
+            if meta is None:
+                pending.append(ts)
+            else:
+                ts.setMeta(meta)
+        if len(pending)>0:
+            with ThreadPoolExecutor(max_workers=min(self.workers,len(pending))) as executor:
+                for _ in executor.map(self._load, pending): pass
+        return series
+
+    def _load(self, ts):
+        if ts.metadata.tsuid is not None:
+            try:
+                meta = self.client.get_tsmeta(tsuid=ts.metadata.tsuid)
+            except OpenTSDBError:
+                if not self.create or ts.metric is None:
+                    raise
+                meta = self.client.set_tsmeta(metric=ts.tsString())
+        else:
+            r = self.client.get_tsmeta(metric=ts.tsString())
+            # the metric query also matches series with more tags
+            r = [m for m in r if OpenTSDBTimeSeries.metaTags(m)==ts.tags]
+            if len(r)==0:
+                if not self.create:
+                    raise ValueError("No meta data for %s."%ts.tsString())
+                meta = self.client.set_tsmeta(metric=ts.tsString())
+            elif len(r)>1:
+                raise ValueError("Attempt to load meta for an ambiguous TS. Please specify all the tags.",r)
+            else:
+                meta = r[0]
+        return ts.setMeta(meta)
@@ -16,7 +16,10 @@
 import copy
 import json
 import string
+import threading
+import time
 import unicodedata as ud
+from concurrent.futures import ThreadPoolExecutor
 from .opentsdberrors import OpenTSDBError
 
 class OpenTSDBAnnotation:
@@ -72,7 +75,13 @@ class OpenTSDBAnnotation:
 
 
 class OpenTSDBTSMeta:
-    """Meta data for a time series, identified by its tsuid"""
+    """Meta data for a time series, identified by its tsuid.
+       Changes to the editable fields are tracked: saveTo only sends the fields changed since the
+       object was loaded or saved, and nothing at all if none changed."""
+    # fields that can be set by the user, and the corresponding set_tsmeta arguments
+    editable = { "description":"description", "displayName":"displayName", "notes":"notes", "custom":"custom",
+                 "units":"units", "dataType":"dataType", "retention":"retention", "max":"maximum", "min":"minimum" }
+
     def __init__(self, **kwargs):
         self.created = kwargs.get("created",0)
         self.dataType = kwargs.get("dataType",'')
@@ -87,6 +96,8 @@ class OpenTSDBTSMeta:
         self.tsuid = kwargs.get("tsuid",'')
         self.units = kwargs.get("units",'')
         self.custom = kwargs["custom"] if kwargs.get("custom",None) is not None else {}
+        self._saved = { "description":'', "displayName":'', "notes":'', "custom":{}, "units":'', "dataType":'',
+                        "retention":0, "max":'NaN', "min":'NaN' }
 
     def set(self, **kwargs):
         self.created = kwargs.get("created",self.created)
@@ -104,16 +115,36 @@ class OpenTSDBTSMeta:
         self.custom = kwargs.get("custom",self.custom) if kwargs.get("custom",self.custom) is not None else {}
 
     def getMap(self):
-        return self.__dict__
+        return { k:v for k,v in list(self.__dict__.items()) if not k.startswith("_") }
+
+    def _snapshot(self):
+        return { k:copy.deepcopy(getattr(self,k)) for k in OpenTSDBTSMeta.editable }
+
+    def loaded(self, **kwargs):
+        """sets the fields from a record of the TSD, and marks the object as unchanged"""
+        self.set(**kwargs)
+        self._saved = self._snapshot()
+        return self
+
+    def changes(self):
+        """the editable fields changed since the object was loaded or saved"""
+        return { k:getattr(self,k) for k in OpenTSDBTSMeta.editable if getattr(self,k)!=self._saved.get(k) }
+
+    def dirty(self):
+        return len(self.changes())>0
 
     def loadFrom(self, client):
-        r = client.get_tsmeta(self, self.tsuid)
-        self.set(**r)
+        r = client.get_tsmeta(tsuid=self.tsuid)
+        self.loaded(**r)
         return self
 
-    def saveTo(self, client):
-        self.set(**client.set_tsmeta(self.tsuid, None, self.description, self.displayName, self.notes,
-                                     self.custom, self.units, self.dataType, self.retention, self.max, self.min))
+    def saveTo(self, client, force=False):
+        """sends the changed fields (all of them if force). Does nothing if there is no change."""
+        changes = self.getMap() if force else self.changes()
+        changes = { OpenTSDBTSMeta.editable[k]:v for k,v in list(changes.items()) if k in OpenTSDBTSMeta.editable }
+        if len(changes)==0:
+            return self
+        self.loaded(**client.set_tsmeta(self.tsuid, **changes))
         return self
 
     def delete(self, client):
@@ -122,7 +153,10 @@ class OpenTSDBTSMeta:
 
 
 class OpenTSDBUIDMeta:
-    """Meta data for a UID (metric, tagk or tagv)"""
+    """Meta data for a UID (metric, tagk or tagv).
+       As for OpenTSDBTSMeta, saveTo only sends the fields changed since the object was loaded or saved."""
+    editable = [ "description", "displayName", "notes", "custom" ]
+
     def __init__(self, **kwargs):
         self.name = kwargs.get("name",'')
         self.uid = kwargs.get("uid",'')
@@ -132,6 +166,7 @@ class OpenTSDBUIDMeta:
         self.displayName = kwargs.get("displayName",'')
         self.notes = kwargs.get("notes",'')
         self.custom = kwargs["custom"] if kwargs.get("custom",None) is not None else {}
+        self._saved = { "description":'', "displayName":'', "notes":'', "custom":{} }
 
     def set(self, **kwargs):
         self.name = kwargs.get("name",self.name)
@@ -144,15 +179,32 @@ class OpenTSDBUIDMeta:
         self.custom = kwargs.get("custom",self.custom) if kwargs.get("custom",self.custom) is not None else {}
         
     def getMap(self):
-        return self.__dict__
+        return { k:v for k,v in list(self.__dict__.items()) if not k.startswith("_") }
+
+    def loaded(self, **kwargs):
+        """sets the fields from a record of the TSD, and marks the object as unchanged"""
+        self.set(**kwargs)
+        self._saved = { k:copy.deepcopy(getattr(self,k)) for k in OpenTSDBUIDMeta.editable }
+        return self
+
+    def changes(self):
+        """the editable fields changed since the object was loaded or saved"""
+        return { k:getattr(self,k) for k in OpenTSDBUIDMeta.editable if getattr(self,k)!=self._saved.get(k) }
+
+    def dirty(self):
+        return len(self.changes())>0
 
     def loadFrom(self, client):
         r = client.get_uidmeta(self.uid, self.type)
-        self.set(**r)
+        self.loaded(**r)
         return self
 
-    def saveTo(self, client):
-        self.set(**client.set_uidmeta(self.uid, self.type, self.description, self.displayName, self.notes, self.custom))
+    def saveTo(self, client, force=False):
+        """sends the changed fields (all of them if force). Does nothing if there is no change."""
+        changes = { k:getattr(self,k) for k in OpenTSDBUIDMeta.editable } if force else self.changes()
+        if len(changes)==0:
+            return self
+        self.loaded(**client.set_uidmeta(self.uid, self.type, **changes))
         return self
 
     def delete(self, client):
@@ -245,12 +297,18 @@ class OpenTSDBTimeSeries:
         mystring[-1] = "}"
         return "".join(mystring)
 
-    def assign_uid(self,client):
+    def assign_uid(self,client,uidCache=None):
+        """assigns the UIDs of the metric and tags. With an OpenTSDBUIDCache, names already known
+           are not sent to the TSD, and the call is skipped if all of them are known."""
         if self.metadata.tsuid is not None:
             raise ValueError("UID already assigned.")
         if self.metric is None or len(self.tags)==0:
             raise ValueError("Cannot assign uid if metric and tags are not set.")
         if not(self.metadata.tsuid is None and self.metric is not None and len(self.tags)>0): return
+        if uidCache is not None:
+            if not uidCache.fill(self):
+                uidCache.assign(client,[self])
+            return
         try:
             r = client.assign_uid([self.metric], list(self.tags.keys()), list(self.tags.values()))
         except OpenTSDBError as e:
@@ -298,7 +356,7 @@ class OpenTSDBTimeSeries:
                 raise ValueError("Attempt to load meta for an ambiguous TS. Please specify all the tags.",r)
             else:
                 meta = r[0]
-        self.metric_meta.set(**meta["metric"])
+        self.setMeta(meta)
         if self.metric is None or self.tags is None:
             timeseries = client.search("LOOKUP", metric=self.metric_meta.name)["results"]
             for ts in timeseries:
@@ -306,27 +364,76 @@ class OpenTSDBTimeSeries:
                     self.metric= ts["metric"]
                     self.tags = ts["tags"]
                     break
-        self.metadata.set(**meta)
+        return self
+
+    @staticmethod
+    def metaTags(meta):
+        """the tags of a TSMeta record, listed by the TSD as tagk, tagv pairs"""
+        tags = {}
+        tagk = None
+        for tags_meta in meta.get("tags",[]):
+            if tags_meta["type"]=="TAGK":
+                tagk = tags_meta["name"]
+            elif tagk is not None:
+                tags[tagk] = tags_meta["name"]
+                tagk = None
+        return tags
+
+    def setMeta(self, meta):
+        """fills the meta data from a TSMeta record, and the metric and tags if they are not set"""
+        self.metric_meta.loaded(**meta["metric"])
+        self.metadata.loaded(**meta)
         for tags_meta in meta["tags"]:
             if tags_meta["type"]=="TAGK":
                 if not tags_meta["name"] in self.tagk_meta:
                     self.tagk_meta[tags_meta["name"]] = OpenTSDBUIDMeta()
-                self.tagk_meta[tags_meta["name"]].set(**tags_meta)
+                self.tagk_meta[tags_meta["name"]].loaded(**tags_meta)
             else:
-                if not tags_meta["name"] in self.tagk_meta:
+                if not tags_meta["name"] in self.tagv_meta:
                     self.tagv_meta[tags_meta["name"]] = OpenTSDBUIDMeta()
-                self.tagv_meta[tags_meta["name"]].set(**tags_meta)
+                self.tagv_meta[tags_meta["name"]].loaded(**tags_meta)
+        if self.metric is None and meta["metric"].get("name"):
+            self.metric = meta["metric"]["name"]
+        if self.tags is None and len(meta["tags"])>0:
+            self.tags = OpenTSDBTimeSeries.metaTags(meta)
         return self
 
-    def saveTo(self,client):
-        self.metadata.saveTo(client)
-        self.metric_meta.saveTo(client)
-        for _,meta in list(self.tagk_meta.items()):
-            meta.saveTo(client)
-        for _,meta in list(self.tagv_meta.items()):
-            meta.saveTo(client)
+    def metaObjects(self):
+        """the TSMeta and UIDMeta objects of the time series"""
+        return [self.metadata, self.metric_meta] + list(self.tagk_meta.values()) + list(self.tagv_meta.values())
+
+    def saveTo(self, client, force=False, workers=4):
+        """saves the meta data that changed (all of it if force), up to workers requests in parallel"""
+        OpenTSDBTimeSeries.saveAll(client, [self], force, workers)
         return self
 
+    @staticmethod
+    def saveAll(client, series, force=False, workers=8):
+        """saves the changed meta data of many time series, up to workers requests in parallel.
+           Identical changes to the same UID meta, e.g. a tag value shared by several series, are sent once."""
+        pending = []
+        duplicates = {}
+        for ts in series:
+            for meta in ts.metaObjects():
+                if not (force or meta.dirty()):
+                    continue
+                if isinstance(meta,OpenTSDBUIDMeta):
+                    key = (meta.type.upper(), meta.uid, json.dumps(meta.changes(), sort_keys=True))
+                    if key in duplicates:
+                        duplicates[key][1].append(meta)
+                        continue
+                    duplicates[key] = (meta,[])
+                pending.append(meta)
+        if len(pending)==0:
+            return series
+        with ThreadPoolExecutor(max_workers=min(workers,len(pending))) as executor:
+            for _ in executor.map(lambda meta: meta.saveTo(client, force), pending): pass
+        # the duplicates get the record saved by the first one
+        for meta,others in list(duplicates.values()):
+            for other in others:
+                other.loaded(**meta.getMap())
+        return series
+
     def deleteMeta(self, client, recursive=False):
         self.metadata.delete(client)
         if recursive:
@@ -508,8 +615,11 @@ class OpenTSDBRule:
         client.delete_tree_rule(self.treeId, self.level, self.order)
 
 class OpenTSDBTreeBranch:
+    """A branch of a tree. Leaves are (OpenTSDBTimeSeries, displayName) pairs, built when first accessed.
+       branches is None for a branch listed by its parent but not loaded itself.
+       With a client, the branch is loaded by an OpenTSDBTreeLoader, with all its sub branches if recursive."""
 
-    def __init__(self, branchId=None, treeId=None, path=None, displayName=None, depth=None, leaves=None, branches=None, client=None, recursive=False ):
+    def __init__(self, branchId=None, treeId=None, path=None, displayName=None, depth=None, leaves=None, branches=None, client=None, recursive=False, **kwargs):
         self.treeId = treeId
         self.path = path
         self.displayName = displayName
@@ -519,33 +629,110 @@ class OpenTSDBTreeBranch:
         self.branches = branches
 
         if client is not None:
-            # in that case, load from the client. If recursive is set, this will recursively load all the tree.
-            # NOTE: check if this is needed. I think so reading the doc: leaves and branches are null for sub-branches.
-            if branchId is not None:
-                data = client.get_tree_branch(branch=self.branchId)
-            elif treeId is not None:
-                data = client.get_tree_branch(branch=self.treeId)
-            else:
+            if branchId is None and treeId is None:
                 raise ValueError("Need treeId or branchId to load a branch.")
-            self.treeId = data["treeId"]
-            self.path = data["path"]
-            self.displayName = data["displayName"]
-            self.branchId = data["branchId"]
-            self.depth = data["depth"]
-            self.leaves = [(OpenTSDBTimeSeries(l["metric"], l["tags"], l["tsuid"]), l["displayName"]) for l in data["leaves"]]
-            if recursive:
-                self.branches = []
-                for b in data["branches"]:
-                    b["client"]=client
-                    b["recursive"]=True
-                    self.branches.append(OpenTSDBTreeBranch(**b))
+            loaded = OpenTSDBTreeLoader(client).load(treeId=treeId, branchId=branchId, depth=None if recursive else 0)
+            self.__dict__.update(loaded.__dict__)
+
+    @property
+    def leaves(self):
+        if self._leaves is None and self._leafData is not None:
+            self._leaves = [(OpenTSDBTimeSeries(l["metric"], l["tags"], l["tsuid"]), l["displayName"]) for l in self._leafData]
+            self._leafData = None
+        return self._leaves
+
+    @leaves.setter
+    def leaves(self, leaves):
+        self._leaves = leaves
+        self._leafData = None
+
+    def numLeaves(self):
+        if self._leafData is not None:
+            return len(self._leafData)
+        return len(self._leaves or [])
+
+    def loaded(self, data):
+        """fills the branch from a get_tree_branch answer. Sub branches are listed but not loaded."""
+        self.treeId = data["treeId"]
+        self.path = data.get("path")
+        self.displayName = data.get("displayName")
+        self.branchId = data["branchId"]
+        self.depth = data.get("depth")
+        self._leaves = None
+        self._leafData = data.get("leaves") or []
+        self.branches = [OpenTSDBTreeBranch(**{ k:v for k,v in list(b.items()) if k not in ["leaves","branches"] })
+                         for b in data.get("branches") or []]
+        return self
+
+    def walk(self):
+        """iterates over the branch and its loaded sub branches, breadth first"""
+        level = [self]
+        while level:
+            for b in level:
+                yield b
+            level = [c for b in level for c in b.branches or []]
+
+
+class OpenTSDBTreeLoader:
+    """Loads tree branches breadth first: the branches of a level are fetched in parallel, up to workers at a time.
+       Answers of get_tree_branch are cached by branchId for ttl seconds, so that browsing the same part of the
+       tree again does not query the TSD. A loader can be kept and reused:
+
+           loader = OpenTSDBTreeLoader(client)
+           root = loader.load(treeId=1, depth=1)
+           branch = loader.load(branchId=root.branches[0].branchId, depth=1)"""
+
+    def __init__(self, client, workers=8, ttl=300):
+        self.client = client
+        self.workers = workers
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def fetch(self, treeId=None, branchId=None):
+        """the answer of get_tree_branch, from the cache if possible"""
+        key = branchId if branchId is not None else "%04X"%treeId
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and (self.ttl is None or time.time()-entry[0]<=self.ttl):
+                return entry[1]
+        if branchId is not None:
+            data = self.client.get_tree_branch(branch=branchId)
+        else:
+            data = self.client.get_tree_branch(treeId=treeId)
+        with self._lock:
+            self._cache[key] = (time.time(), data)
+            self._cache[data["branchId"]] = (time.time(), data)
+        return data
+
+    def invalidate(self, branchId=None):
+        """forgets one branch, or everything"""
+        with self._lock:
+            if branchId is None:
+                self._cache.clear()
             else:
-                self.branches = [OpenTSDBTreeBranch(**b) for b in data["branches"]]
+                self._cache.pop(branchId, None)
+
+    def load(self, treeId=None, branchId=None, depth=None):
+        """the branch, with its sub branches loaded down to depth levels below it (all of them if None)"""
+        if branchId is None and treeId is None:
+            raise ValueError("Need treeId or branchId to load a branch.")
+        root = OpenTSDBTreeBranch().loaded(self.fetch(treeId, branchId))
+        level = [root]
+        d = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while (depth is None or d<depth):
+                children = [c for b in level for c in b.branches]
+                if len(children)==0:
+                    break
+                for child,data in zip(children, executor.map(lambda c: self.fetch(branchId=c.branchId), children)):
+                    child.loaded(data)
+                level = children
+                d += 1
+        return root
 
 
 class OpenTSDBTree(OpenTSDBTreeBranch):
 
     def __init__(self,treeId,client):
-        OpenTSDBTreeBranch.__init__(treeId=treeId, client=client, recursive=True)
-
-
+        OpenTSDBTreeBranch.__init__(self, treeId=treeId, client=client, recursive=True)
@@ -0,0 +1,133 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import copy
+import threading
+import time
+from .opentsdbquery import OpenTSDBQuery, OpenTSDBPreparedQuery, OpenTSDBMetricSubQuery, OpenTSDBtsuidSubQuery
+
+class OpenTSDBLookupCache:
+    """Local cache of search("LOOKUP") results: the TSUIDs of the series of a metric carrying a set of tags.
+       Entries expire after ttl seconds (never if ttl is None), so that new series are eventually seen.
+
+       get only reads the cache. lookup queries the server and stores the answer.
+       Incomplete answers (more results than returned by the server) are not cached."""
+
+    def __init__(self, client, ttl=300):
+        self.client = client
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    @staticmethod
+    def key(metric, tags):
+        return (metric, tuple(sorted(tags.items())))
+
+    def get(self, metric, tags):
+        """the cached list of TSUIDs, or None if unknown or expired"""
+        key = OpenTSDBLookupCache.key(metric, tags)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self.ttl is not None and time.time()-entry[0]>self.ttl:
+                del self._entries[key]
+                return None
+            return list(entry[1])
+
+    def put(self, metric, tags, tsuids):
+        with self._lock:
+            self._entries[OpenTSDBLookupCache.key(metric, tags)] = (time.time(), list(tsuids))
+
+    def lookup(self, metric, tags):
+        """asks the server for the TSUIDs and caches them. Returns None if the answer is incomplete."""
+        response = self.client.search("LOOKUP", metric=metric, tags=tags)
+        results = response.get("results",[])
+        if response.get("totalResults",len(results))>len(results):
+            return None
+        tsuids = sorted(r["tsuid"] for r in results)
+        self.put(metric, tags, tsuids)
+        return tsuids
+
+    def invalidate(self, metric=None):
+        """forgets the entries of one metric, or everything"""
+        with self._lock:
+            if metric is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0]==metric]:
+                    del self._entries[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class OpenTSDBQueryPlanner:
+    """Rewrites metric sub queries into TSUID sub queries when the series they select are known.
+
+       A metric sub query is eligible when each of its filters is a literal_or on a single value,
+       with at most one filter per tag key, and explicitTags is not set.
+       The TSD then reads the listed series directly instead of scanning every series of the metric,
+       which matters for metrics with many series. Aggregation, rate and downsampling are kept.
+
+       Sub queries that are not eligible, or whose series are not in the cache, are sent unchanged.
+       With lookupOnMiss=True, a cache miss triggers a LOOKUP first."""
+
+    def __init__(self, cache, lookupOnMiss=False):
+        self.cache = cache
+        self.lookupOnMiss = lookupOnMiss
+
+    @staticmethod
+    def eligible(subquery):
+        """the (metric, tags) pair fully specifying the series selected by the sub query, or None"""
+        if not isinstance(subquery,OpenTSDBMetricSubQuery) or subquery.explicitTags or not subquery.filters:
+            return None
+        tags = {}
+        for f in subquery.filters:
+            if f.filterType!="literal_or" or "|" in f.filterExpression or f.tagKey in tags:
+                return None
+            tags[f.tagKey] = f.filterExpression
+        return (subquery.metric, tags)
+
+    def rewrite(self, subquery):
+        """returns the equivalent TSUID sub query, or the sub query itself"""
+        target = OpenTSDBQueryPlanner.eligible(subquery)
+        if target is None:
+            return subquery
+        tsuids = self.cache.get(*target)
+        if tsuids is None and self.lookupOnMiss:
+            tsuids = self.cache.lookup(*target)
+        if not tsuids:
+            # unknown, or no series at all: let the TSD answer the original query
+            return subquery
+        return OpenTSDBtsuidSubQuery(subquery.aggregator, tsuids, rate=subquery.rate, counterMax=subquery.counterMax,
+                                     resetValue=subquery.resetValue, downsample=subquery.downsample)
+
+    def plan(self, query):
+        """returns a copy of the query with eligible sub queries rewritten. The original query is left untouched."""
+        if isinstance(query,OpenTSDBPreparedQuery):
+            # the prepared serialization is kept unless a sub query is rewritten
+            original = query.original()
+            planned = self.plan(original)
+            return query if planned is original else planned
+        if not isinstance(query,OpenTSDBQuery):
+            return query
+        subqueries = [self.rewrite(q) for q in query.subqueries]
+        if all(a is b for a,b in zip(subqueries, query.subqueries)):
+            return query
+        planned = copy.copy(query)
+        planned.subqueries = subqueries
+        return planned
@@ -14,7 +14,69 @@
 # under the License.
 
 from .opentsdbobjects import OpenTSDBTimeSeries
+import copy
+import fnmatch
+import json
+import re
 import string
+import time
+
+durationUnits = { "ms":1, "s":1000, "m":60000, "h":3600000, "d":86400000, "w":604800000, "n":2592000000, "y":31536000000 }
+durationFormat = re.compile("^(\d+)(ms|s|m|h|d|w|n|y)\Z")
+relativeFormat = re.compile("^(\d+(ms|s|m|h|d|w|n|y))-ago\Z")
+absoluteFormat = re.compile("^(\d{4})/(\d{2})/(\d{2})([ -](\d{2}):(\d{2})(:(\d{2}))?)?\Z")
+
+def parseDuration(duration):
+    """converts an OpenTSDB duration like 30s, 1m or 2h to milliseconds. Months are 30 days and years 365 days."""
+    match = durationFormat.match(duration) if isinstance(duration,str) else None
+    if match is None:
+        raise ValueError("Invalid duration: %s"%str(duration))
+    return int(match.group(1))*durationUnits[match.group(2)]
+
+def formatDuration(duration):
+    """converts a number of milliseconds to the shortest OpenTSDB duration, e.g. 90000 to 90s and 7200000 to 2h"""
+    if not isinstance(duration,int) or duration<=0:
+        raise ValueError("Invalid duration: %s"%str(duration))
+    for unit in ["d", "h", "m", "s"]:
+        if duration%durationUnits[unit]==0:
+            return "%d%s"%(duration//durationUnits[unit], unit)
+    return "%dms"%duration
+
+# downsample intervals used by fit, in ms. Snapping to a few values keeps query results cacheable.
+niceIntervals = [ 1000, 2000, 5000, 10000, 15000, 30000,
+                  60000, 120000, 300000, 600000, 900000, 1800000,
+                  3600000, 7200000, 10800000, 21600000, 43200000,
+                  86400000, 172800000, 604800000, 2592000000 ]
+
+def niceInterval(duration):
+    """the smallest nice interval greater or equal to duration (in ms). Beyond 30 days, a whole number of days."""
+    for interval in niceIntervals:
+        if interval>=duration:
+            return interval
+    return -(-int(duration)//86400000)*86400000
+
+def resolveTime(thetime, now=None):
+    """converts an OpenTSDB time specification to a timestamp in milliseconds.
+       Accepts timestamps in seconds or milliseconds (as int or str), relative times like 1h-ago 
+       and absolute dates like 2016/01/01-12:00:00 (local time).
+       now, in milliseconds, is used for relative times (current time if None)."""
+    if isinstance(thetime,str) and thetime.isdigit():
+        thetime = int(thetime)
+    if isinstance(thetime,int):
+        # same convention as the TSD: more than 10 digits means milliseconds
+        return thetime if len(str(thetime))>10 else thetime*1000
+    if not isinstance(thetime,str):
+        raise TypeError("time must be an integer or a string")
+    match = relativeFormat.match(thetime)
+    if match is not None:
+        if now is None: now = int(time.time()*1000)
+        return now - parseDuration(match.group(1))
+    match = absoluteFormat.match(thetime)
+    if match is not None:
+        fields = [int(match.group(i)) for i in (1,2,3)]
+        fields += [int(match.group(i) or 0) for i in (5,6,8)]
+        return int(time.mktime(tuple(fields)+(0,0,-1)))*1000
+    raise ValueError("Invalid time: %s"%thetime)
 
 class OpenTSDBQuery:
     """Enables extracting data from the storage system in various formats determined by the serializer selected.
@@ -80,6 +142,96 @@ class OpenTSDBQuery:
             else:
                 q.check()
 
+    def prepare(self):
+        """validates the query once and returns an OpenTSDBPreparedQuery where everything but the time range is pre-serialized.
+           This is meant for queries that are run repeatedly with only start and end changing."""
+        return OpenTSDBPreparedQuery(self)
+
+    def fit(self, points, aggregator="avg", fillPolicy=None, minInterval=1000, now=None):
+        """returns a copy of the query downsampled to about points values per series, e.g. the width of a chart in pixels.
+           The interval is snapped up to a nice value (see niceIntervals). Sub queries that already have a downsample
+           keep their aggregator and fill policy, and their interval if it is coarser.
+           Nothing is changed if the interval would be below minInterval ms, the resolution of the data."""
+        if not isinstance(points,int) or points<1:
+            raise ValueError("points must be a strictly positive integer")
+        if now is None: now = int(time.time()*1000)
+        start = resolveTime(self.start, now)
+        end = now if self.end is None else resolveTime(self.end, now)
+        needed = max(end-start,0)/float(points)
+        interval = niceInterval(needed) if needed>minInterval else None
+        subqueries = []
+        for q in self.subqueries:
+            q = copy.copy(q)
+            if interval is not None and q.downsample is None:
+                q.downsample = "%s-%s"%(formatDuration(interval), aggregator)
+                if fillPolicy is not None:
+                    q.downsample += "-" + fillPolicy
+            elif interval is not None:
+                current, sep, rest = q.downsample.partition("-")
+                if current!="0all" and parseDuration(current)<interval:
+                    q.downsample = formatDuration(interval) + sep + rest
+            subqueries.append(q)
+        fitted = copy.copy(self)
+        fitted.subqueries = subqueries
+        return fitted
+
+
+class OpenTSDBPreparedQuery:
+    """An OpenTSDBQuery validated and serialized once.
+       The static part of the query (sub queries, filters, flags) is kept as JSON fragments.
+       Each execution only serializes the time parameters, obtained via bind:
+
+           prepared = OpenTSDBQuery([subquery], start).prepare()
+           client.query(prepared.bind("1h-ago"))
+
+       Changes made to the original query after prepare are not seen by the prepared query.
+       The client features working on sub queries (planner, cost policy, recent writes) use original."""
+
+    def __init__(self, query):
+        query.check()
+        self._query = copy.deepcopy(query)
+        myself = query.getMap()
+        myself.pop("start")
+        myself.pop("end",None)
+        # json.dumps(..., sort_keys=True) output is reconstructed from fragments sorted by key.
+        self._fragments = sorted((k,json.dumps(v, sort_keys=True)) for k,v in list(myself.items()))
+        self.start = query.start
+        self.end = query.end
+        self.delete = query.delete
+
+    def bind(self, start, end=None):
+        """returns a copy of the prepared query for the given time range. The serialized static part is shared."""
+        bound = copy.copy(self)
+        bound.start = start
+        bound.end = end
+        bound.check()
+        return bound
+
+    def check(self):
+        """only the time range has to be checked, the rest was checked by prepare."""
+        if ((not isinstance(self.start,int) and not isinstance(self.start,str)) or
+            (self.end is not None and not isinstance(self.end,int) and not isinstance(self.end,str))):
+            raise TypeError("OpenTSDBPreparedQuery type mismatch")
+
+    def original(self):
+        """the OpenTSDBQuery equivalent to the prepared query, for its current time range"""
+        query = copy.copy(self._query)
+        query.start = self.start
+        query.end = self.end
+        return query
+
+    def json(self):
+        """the serialized query, identical to json.dumps(query.getMap(), sort_keys=True)"""
+        fragments = list(self._fragments)
+        fragments.append(("start",json.dumps(self.start)))
+        if self.end is not None:
+            fragments.append(("end",json.dumps(self.end)))
+        fragments.sort(key=lambda f: f[0])
+        return "{" + ", ".join("%s: %s"%(json.dumps(k),v) for k,v in fragments) + "}"
+
+    def getMap(self):
+        return json.loads(self.json())
+
 
 class OpenTSDBMetricSubQuery:
     """ Metric Query - The full name of a metric is supplied along with an optional list of tags. 
@@ -106,6 +258,8 @@ class OpenTSDBMetricSubQuery:
             if self.counterMax is not None: rateOptions["counterMax"] = self.counterMax
             if self.resetValue is not None: rateOptions["resetValue"] = self.resetValue
             myself["rateOptions"] = rateOptions
+        if self.downsample is not None:
+            myself["downsample"] = self.downsample
         if self.filters is not None:
             myself["filters"] = [f.getMap() for f in self.filters]
         return myself
@@ -132,16 +286,33 @@ class OpenTSDBtsuidSubQuery:
     """TSUID Query - A list of one or more TSUIDs that share a common metric. 
        This is optimized for fetching individual time series where aggregation is not required."""
 
-    def __init__(self, aggregator, tsuids):
+    def __init__(self, aggregator, tsuids, rate=False, counterMax=None, resetValue=None, downsample=None):
         self.aggregator = aggregator
         self.tsuids = tsuids
+        self.rate = rate
+        self.counterMax = counterMax
+        self.resetValue = resetValue
+        self.downsample = downsample
 
     def getMap(self):
-        return { "aggregator": self.aggregator, "tsuids": self.tsuids }
+        myself = { "aggregator": self.aggregator, "tsuids": self.tsuids }
+        if self.rate:
+            myself["rate"] = self.rate
+            rateOptions = { "counter": True }
+            if self.counterMax is not None: rateOptions["counterMax"] = self.counterMax
+            if self.resetValue is not None: rateOptions["resetValue"] = self.resetValue
+            myself["rateOptions"] = rateOptions
+        if self.downsample is not None:
+            myself["downsample"] = self.downsample
+        return myself
 
     def check(self):
         if (not isinstance(self.aggregator,str) or
-            not (isinstance(self.tsuids, list) and not isinstance(self.tsuids, str))):
+            not (isinstance(self.tsuids, list) and not isinstance(self.tsuids, str)) or
+            not isinstance(self.rate, bool) or
+            (self.counterMax is not None and not isinstance(self.counterMax,int)) or
+            (self.resetValue is not None and not isinstance(self.resetValue,int)) or
+            (self.downsample is not None and not isinstance(self.downsample,str))):
                 raise TypeError("OpenTSDBtsuidSubQuery type mismatch")
         if len(self.tsuids)<1:
             raise ValueError("OpenTSDBtsuidSubQuery tsuid list cannot be empty")
@@ -177,6 +348,26 @@ class OpenTSDBFilter:
             not isinstance(self.groupBy,bool)):
                raise TypeError("OpenTSDBFilter type mismatch")
 
+    def match(self, tags):
+        """evaluates the filter on the client side for a set of tags. 
+           A series without the tag key never matches. Supports the filters built into OpenTSDB."""
+        value = tags.get(self.tagKey)
+        if value is None:
+            return False
+        if self.filterType in ["literal_or", "not_literal_or"]:
+            found = value in self.filterExpression.split("|")
+            return found if self.filterType=="literal_or" else not found
+        if self.filterType in ["iliteral_or", "not_iliteral_or"]:
+            found = value.lower() in self.filterExpression.lower().split("|")
+            return found if self.filterType=="iliteral_or" else not found
+        if self.filterType=="wildcard":
+            return fnmatch.fnmatchcase(value, self.filterExpression.replace("[","[[]").replace("?","[?]"))
+        if self.filterType=="iwildcard":
+            return fnmatch.fnmatchcase(value.lower(), self.filterExpression.lower().replace("[","[[]").replace("?","[?]"))
+        if self.filterType=="regexp":
+            return re.search(self.filterExpression, value) is not None
+        raise ValueError("Filter %s cannot be evaluated on the client side."%self.filterType)
+
 
 class OpenTSDBExpQuery:
     """Allows for querying data using expressions. The query is broken up into different sections.
@@ -383,7 +574,7 @@ class OpenTSDBQueryLast:
         if self.metrics is not None:
             for m in self.metrics:
                queries.append(m)
-        if self.tsuids is not None:
+        if self.tsuids is not None and len(self.tsuids)>0:
             queries.append({"tsuids":self.tsuids})
 
         return { "queries": queries, "resolveNames": self.resolveNames, "backScan": self.backScan }
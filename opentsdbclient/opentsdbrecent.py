@@ -0,0 +1,203 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import heapq
+import threading
+import time
+from .opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBQueryLast, resolveTime
+from .opentsdbengine import OpenTSDBLocalEngine, np
+
+class OpenTSDBRecentWrites:
+    """Bounded buffer of the points recently written with put_measurements, indexed by series and time.
+       The client merges it with the results of query and OpenTSDBQueryLast, so that a point can be read back
+       immediately, even if the TSD did not persist it yet.
+
+       Points are kept for window seconds (based on their timestamp) and at most maxPoints points are kept.
+       Merging only adds points missing from the TSD answer, for results that are a single series
+       (aggregateTags empty) and sub queries without downsample or rate. Groups missing from the TSD answer
+       are added, aggregated locally unless the sub query leaves series unaggregated (requires numpy). Query last results are merged
+       when resolveNames is set, since the series have to be identified by metric and tags.
+
+       With authoritative=True, this client is assumed to be the only writer of the buffered metrics:
+       queries lying entirely in the buffered time range are then computed locally (requires numpy)."""
+
+    def __init__(self, window=300, maxPoints=100000, authoritative=False):
+        self.window = window
+        self.maxPoints = maxPoints
+        self.authoritative = authoritative
+        self._lock = threading.Lock()
+        # (metric, tags) -> { timestamp in ms: value }
+        self._series = {}
+        self._heap = []
+        # every point written with a timestamp >= horizon is in the buffer
+        self.horizon = int(time.time()*1000)
+
+    @staticmethod
+    def key(metric, tags):
+        return (metric, tuple(sorted(tags.items())))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    def record(self, measurements, now=None):
+        """adds the points of a list of OpenTSDBMeasurement"""
+        if now is None: now = int(time.time()*1000)
+        with self._lock:
+            for m in measurements:
+                if m.ts.metric is None:
+                    continue
+                key = OpenTSDBRecentWrites.key(m.ts.metric, m.ts.tags)
+                timestamp = resolveTime(m.timestamp)
+                points = self._series.setdefault(key,{})
+                if timestamp not in points:
+                    heapq.heappush(self._heap, (timestamp, key))
+                points[timestamp] = m.value
+            self._evict(now)
+
+    def _evict(self, now):
+        oldest = now - self.window*1000
+        while self._heap and (self._heap[0][0]<oldest or len(self._heap)>self.maxPoints):
+            timestamp, key = heapq.heappop(self._heap)
+            points = self._series[key]
+            del points[timestamp]
+            if not points:
+                del self._series[key]
+            self.horizon = max(self.horizon, timestamp+1)
+        self.horizon = max(self.horizon, oldest)
+
+    def series(self, metric, start=None, end=None, now=None):
+        """the buffered series of a metric as /api/query results with ms timestamps, restricted to [start, end]"""
+        if now is None: now = int(time.time()*1000)
+        with self._lock:
+            self._evict(now)
+            output = []
+            for (name,tags),points in list(self._series.items()):
+                if name!=metric:
+                    continue
+                dps = { str(t):v for t,v in sorted(points.items()) if (start is None or t>=start) and (end is None or t<=end) }
+                if not dps:
+                    continue
+                output.append({ "metric":name, "tags":dict(tags), "aggregateTags":[], "dps":dps })
+            return output
+
+    def answer(self, query, now=None):
+        """computes the query locally if the buffer holds all its data, else returns None"""
+        if not self.authoritative or np is None or not isinstance(query,OpenTSDBQuery):
+            return None
+        if now is None: now = int(time.time()*1000)
+        start = resolveTime(query.start, now)
+        end = now if query.end is None else resolveTime(query.end, now)
+        if start<self.horizon or not all(isinstance(q,OpenTSDBMetricSubQuery) for q in query.subqueries):
+            return None
+        results = []
+        for q in query.subqueries:
+            engine = OpenTSDBLocalEngine(self.series(q.metric, start, end, now), start, end)
+            results += engine.run(q, query.msResolution)
+        return results
+
+    def merge(self, query, results, now=None):
+        """adds the buffered points missing from the results of an OpenTSDBQuery or OpenTSDBQueryLast"""
+        if isinstance(query,OpenTSDBQueryLast):
+            return self._mergeLast(query, results, now)
+        if not isinstance(query,OpenTSDBQuery) or results is None:
+            return results
+        if now is None: now = int(time.time()*1000)
+        start = resolveTime(query.start, now)
+        end = now if query.end is None else resolveTime(query.end, now)
+        # results may be shared with other callers: series are copied before being modified
+        results = list(results)
+        for metric in set(q.metric for q in query.subqueries if isinstance(q,OpenTSDBMetricSubQuery)):
+            subqueries = [q for q in query.subqueries if getattr(q,"metric",None)==metric]
+            # results cannot be attributed to one sub query without ambiguity
+            if len(subqueries)>1 or subqueries[0].rate or subqueries[0].downsample is not None:
+                continue
+            subquery = subqueries[0]
+            echo = OpenTSDBRecentWrites._echo(query, subquery, results)
+            groupBy = set(f.tagKey for f in subquery.filters or [] if f.groupBy)
+            missing = []
+            for buffered in self.series(metric, start, end, now):
+                if not all(f.match(buffered["tags"]) for f in subquery.filters or []):
+                    continue
+                matches = [i for i,r in enumerate(results) if r.get("metric")==metric and
+                           all(buffered["tags"].get(k)==v for k,v in list(r.get("tags",{}).items()))]
+                if not matches:
+                    if not OpenTSDBRecentWrites._alone(subquery, groupBy, buffered["tags"]):
+                        # groups absent from the TSD answer are aggregated below
+                        missing.append(buffered)
+                        continue
+                    results.append(OpenTSDBRecentWrites._withEcho({ "metric":metric, "tags":buffered["tags"], "aggregateTags":[], "dps":{} }, echo))
+                    index = len(results)-1
+                elif len(matches)==1 and results[matches[0]].get("tags")==buffered["tags"] and not results[matches[0]].get("aggregateTags"):
+                    index = matches[0]
+                else:
+                    # part of a group aggregated by the TSD: cannot be merged exactly
+                    continue
+                dps = dict(results[index].get("dps",{}))
+                for t,v in list(buffered["dps"].items()):
+                    t = t if query.msResolution else str(int(t)//1000)
+                    if t not in dps:
+                        dps[t] = v
+                results[index] = dict(results[index], dps=dict(sorted(dps.items(), key=lambda p: int(p[0]))))
+            if missing and np is not None:
+                engine = OpenTSDBLocalEngine(missing, start, end)
+                results += [OpenTSDBRecentWrites._withEcho(r, echo) for r in engine.run(subquery, query.msResolution)]
+        return results
+
+    @staticmethod
+    def _alone(subquery, groupBy, tags):
+        """True if the series is a group by itself, and the aggregator leaves a lone series unchanged"""
+        if subquery.aggregator=="none":
+            return True
+        return groupBy.issuperset(tags) and subquery.aggregator not in ["count", "dev"]
+
+    @staticmethod
+    def _echo(query, subquery, results):
+        """the sub query as echoed by the TSD with showQuery, for the series added to the results"""
+        if not query.showQuery:
+            return None
+        index = query.subqueries.index(subquery)
+        for r in results:
+            echo = r.get("query")
+            if echo is not None and echo.get("index", index)==index and echo.get("metric")==subquery.metric:
+                return echo
+        echo = subquery.getMap()
+        echo["index"] = index
+        return echo
+
+    @staticmethod
+    def _withEcho(series, echo):
+        if echo is not None:
+            series["query"] = echo
+        return series
+
+    def _mergeLast(self, query, results, now):
+        if not query.resolveNames or query.metrics is None or results is None:
+            return results
+        if now is None: now = int(time.time()*1000)
+        results = [dict(r) for r in results]
+        for m in query.metrics:
+            for buffered in self.series(m["metric"], now=now):
+                if not all(buffered["tags"].get(k)==v for k,v in list(m.get("tags",{}).items())):
+                    continue
+                timestamp, value = list(buffered["dps"].items())[-1]
+                timestamp = int(timestamp)
+                matches = [r for r in results if r.get("metric")==m["metric"] and r.get("tags")==buffered["tags"]]
+                if not matches:
+                    results.append({ "metric":m["metric"], "tags":buffered["tags"], "timestamp":timestamp, "value":str(value) })
+                elif matches[0].get("timestamp",0)<timestamp:
+                    matches[0]["timestamp"] = timestamp
+                    matches[0]["value"] = str(value)
+        return results
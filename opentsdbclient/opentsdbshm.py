@@ -0,0 +1,228 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import inspect
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# python 3.13 can create segments that are not tracked
+_trackArgument = "track" in inspect.signature(shared_memory.SharedMemory.__init__).parameters
+
+def _attach(name, create=False, size=0):
+    """opens a shared memory segment that outlives the process.
+       By default, python unlinks the segments created by a process when it exits, which would
+       destroy the cache of the other workers: the resource tracker is told to forget about them."""
+    if _trackArgument:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+def _unlink(name):
+    try:
+        segment = _attach(name)
+    except FileNotFoundError:
+        return
+    segment.close()
+    if not _trackArgument:
+        # unlink unregisters the segment from the tracker
+        resource_tracker.register(segment._name, "shared_memory")
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class OpenTSDBSharedMemoryCache:
+    """Query result cache shared by the processes of a host, e.g. the workers of a web server.
+
+       Each result is stored compressed in its own shared memory segment. A shared index segment maps keys
+       to segments, with their size and last access time. The index is protected by a lock file (fcntl),
+       so any process using the same name sees the results fetched by the others.
+
+       Entries expire after ttl seconds. The least recently used entries are evicted to stay below
+       maxBytes and maxEntries. Typical use:
+
+           client = RESTOpenTSDBClient(host, port, cache=OpenTSDBSharedMemoryCache("dashboards"))
+
+       Segments persist until unlink is called, even if all the processes exit."""
+
+    def __init__(self, name="opentsdb", maxBytes=64*1024*1024, maxEntries=1024, ttl=60, indexSize=1024*1024, lockFile=None):
+        if fcntl is None:
+            raise ImportError("The shared memory cache requires fcntl.")
+        self.name = name
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.indexSize = indexSize
+        self.lockFile = lockFile or os.path.join(tempfile.gettempdir(), "%s.lock"%name)
+        # fcntl locks are per process: threads are serialized by a regular lock
+        self._threadLock = threading.Lock()
+        self._index = None
+
+    def _lock(self):
+        self._threadLock.acquire()
+        try:
+            fd = os.open(self.lockFile, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except Exception:
+            self._threadLock.release()
+            raise
+        return fd
+
+    def _unlock(self, fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        finally:
+            self._threadLock.release()
+
+    def _indexSegment(self):
+        """the index segment, created if needed. Must be called with the lock held."""
+        if self._index is None:
+            try:
+                self._index = _attach("%s_index"%self.name)
+            except FileNotFoundError:
+                self._index = _attach("%s_index"%self.name, create=True, size=self.indexSize)
+                self._index.buf[:4] = struct.pack(">I", 0)
+        return self._index
+
+    def _readIndex(self):
+        buf = self._indexSegment().buf
+        length = struct.unpack(">I", bytes(buf[:4]))[0]
+        if length==0:
+            return { "seq":0, "entries":{} }
+        return json.loads(bytes(buf[4:4+length]).decode())
+
+    def _writeIndex(self, index):
+        data = json.dumps(index).encode()
+        buf = self._indexSegment().buf
+        if len(data)+4>len(buf):
+            return False
+        buf[4:4+len(data)] = data
+        buf[:4] = struct.pack(">I", len(data))
+        return True
+
+    @staticmethod
+    def key(key):
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, key):
+        """the cached value, or None"""
+        theKey = OpenTSDBSharedMemoryCache.key(key)
+        now = time.time()
+        fd = self._lock()
+        try:
+            index = self._readIndex()
+            entry = index["entries"].get(theKey)
+            if entry is None:
+                return None
+            if self.ttl is not None and now-entry["ctime"]>self.ttl:
+                self._remove(index, theKey)
+                self._writeIndex(index)
+                return None
+            try:
+                segment = _attach(entry["segment"])
+            except FileNotFoundError:
+                self._remove(index, theKey)
+                self._writeIndex(index)
+                return None
+            data = bytes(segment.buf[:entry["size"]])
+            segment.close()
+            entry["atime"] = now
+            self._writeIndex(index)
+        finally:
+            self._unlock(fd)
+        return json.loads(zlib.decompress(data).decode())
+
+    def put(self, key, value):
+        """stores a JSON serializable value. Returns False if it is not cached: values larger than maxBytes,
+           or whose entry does not fit in the index (indexSize)."""
+        data = zlib.compress(json.dumps(value).encode())
+        if len(data)>self.maxBytes:
+            return False
+        theKey = OpenTSDBSharedMemoryCache.key(key)
+        now = time.time()
+        fd = self._lock()
+        try:
+            index = self._readIndex()
+            self._remove(index, theKey)
+            entries = index["entries"]
+            for k in [k for k,e in list(entries.items()) if self.ttl is not None and now-e["ctime"]>self.ttl]:
+                self._remove(index, k)
+            while entries and (len(entries)>=self.maxEntries or sum(e["size"] for e in entries.values())+len(data)>self.maxBytes):
+                self._remove(index, min(entries, key=lambda k: entries[k]["atime"]))
+            index["seq"] += 1
+            name = "%s_%s_%d"%(self.name, theKey[:16], index["seq"])
+            segment = _attach(name, create=True, size=max(len(data),1))
+            segment.buf[:len(data)] = data
+            segment.close()
+            entries[theKey] = { "segment":name, "size":len(data), "ctime":now, "atime":now }
+            # the index itself is bounded: evict until it fits
+            while not self._writeIndex(index):
+                if not entries:
+                    # indexSize is too small even for an empty index
+                    return False
+                self._remove(index, min(entries, key=lambda k: entries[k]["atime"]))
+        finally:
+            self._unlock(fd)
+        return theKey in entries
+
+    def _remove(self, index, theKey):
+        entry = index["entries"].pop(theKey, None)
+        if entry is not None:
+            _unlink(entry["segment"])
+
+    def __len__(self):
+        fd = self._lock()
+        try:
+            return len(self._readIndex()["entries"])
+        finally:
+            self._unlock(fd)
+
+    def clear(self):
+        """removes all the entries"""
+        fd = self._lock()
+        try:
+            index = self._readIndex()
+            for theKey in list(index["entries"]):
+                self._remove(index, theKey)
+            self._writeIndex(index)
+        finally:
+            self._unlock(fd)
+
+    def unlink(self):
+        """removes all the entries and the index. Other processes must not use the cache anymore."""
+        self.clear()
+        fd = self._lock()
+        try:
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+            _unlink("%s_index"%self.name)
+        finally:
+            self._unlock(fd)
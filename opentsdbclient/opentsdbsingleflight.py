@@ -0,0 +1,75 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sys
+import threading
+from concurrent.futures import Future
+if sys.version_info>=(3,5):
+    # async_do
+    from .opentsdbasync import OpenTSDBAsyncSingleFlight
+else:
+    class OpenTSDBAsyncSingleFlight:
+        pass
+
+class OpenTSDBSingleFlight(OpenTSDBAsyncSingleFlight):
+    """Deduplicates identical calls that are in flight at the same time.
+       The first caller for a given key (the leader) performs the call.
+       Callers arriving with the same key before it completes wait for the leader
+       and receive the same result, or the same exception.
+       Once the call is completed, the key is forgotten: the next caller starts a new flight.
+
+       Both threads (do) and asyncio coroutines (async_do, python 3.5 or higher) can join the same flight.
+       Results are shared between all the callers and should be treated as read-only."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def _join(self, key):
+        """returns the future for the key and whether the caller is the leader."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self._calls[key] = future
+            return future, True
+
+    def _run(self, key, future, fn, args):
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self._forget(key)
+            future.set_exception(e)
+        else:
+            self._forget(key)
+            future.set_result(result)
+
+    def _forget(self, key):
+        with self._lock:
+            self._calls.pop(key, None)
+
+    def inflight(self):
+        """number of distinct calls currently in flight."""
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key, fn, *args):
+        """calls fn(*args) unless an identical call is already in flight, and returns its result."""
+        future, leader = self._join(key)
+        if leader:
+            self._run(key, future, fn, args)
+        return future.result()
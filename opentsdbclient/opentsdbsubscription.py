@@ -0,0 +1,184 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import itertools
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from .opentsdbquery import OpenTSDBQueryLast
+
+class OpenTSDBLastValueSubscriptions:
+    """Keeps the last values of many series up to date with /api/query/last, and calls back on changes.
+
+       Subscriptions are grouped in batches of batchSize series, each batch being a single query/last call.
+       Batches are refreshed every interval seconds, at instants spread over the interval to avoid bursts,
+       and several batches due at the same time are sent concurrently (workers threads).
+       A callback is only called for the series whose timestamp or value changed since the last refresh.
+
+           subscriptions = OpenTSDBLastValueSubscriptions(client, interval=5)
+           subscriptions.subscribe(show, metric="sys.cpu.user", tags={"host":"web01"})
+           subscriptions.subscribe(show, tsuid="000001000001000001")
+           subscriptions.start()
+
+       The callback receives the query/last result of the series (timestamp, value, tsuid, and metric and tags
+       for subscriptions by metric). poll can also be called directly instead of using the background thread.
+       If a batch or a callback fails, the other changes are still reported before poll raises the first error."""
+
+    def __init__(self, client, interval=5, batchSize=100, backScan=24, workers=4, onError=None):
+        self.client = client
+        self.interval = interval
+        self.batchSize = batchSize
+        self.backScan = backScan
+        self.workers = workers
+        self.onError = onError
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._subscriptions = {}
+        self._values = {}
+        self._schedule = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback, metric=None, tags=None, tsuid=None):
+        """registers a callback for a series, given by its tsuid or by metric and tags. Returns a handle for unsubscribe."""
+        if (metric is None)==(tsuid is None):
+            raise ValueError("Either metric or tsuid must be set.")
+        if metric is not None:
+            target = OpenTSDBQueryLast.metric(metric, tags or {})
+        else:
+            int(tsuid,16)
+            target = tsuid
+        with self._lock:
+            handle = next(self._ids)
+            self._subscriptions[handle] = (target, callback)
+            self._schedule = None
+        return handle
+
+    def unsubscribe(self, handle):
+        with self._lock:
+            self._subscriptions.pop(handle, None)
+            for key in [k for k in self._values if k[0]==handle]:
+                del self._values[key]
+            self._schedule = None
+
+    def values(self):
+        """the last known values, as a map handle -> list of query/last results"""
+        with self._lock:
+            output = {}
+            for (handle,tsuid),series in list(self._values.items()):
+                output.setdefault(handle,[]).append(series)
+            return output
+
+    def _batches(self, now):
+        """splits the subscriptions in batches, with due times spread over the interval"""
+        handles = sorted(self._subscriptions)
+        batches = [handles[i:i+self.batchSize] for i in range(0, len(handles), self.batchSize)]
+        return [ [now + i*self.interval/float(len(batches)), batch] for i,batch in enumerate(batches) ]
+
+    def poll(self, now=None, force=False):
+        """refreshes the batches that are due (all of them if force), and calls back on changes.
+           Returns the number of changed series."""
+        if now is None: now = time.time()
+        with self._lock:
+            if self._schedule is None:
+                self._schedule = self._batches(now)
+            due = []
+            for slot in self._schedule:
+                if force or slot[0]<=now:
+                    due.append([(h, self._subscriptions[h]) for h in slot[1] if h in self._subscriptions])
+                    slot[0] = max(slot[0]+self.interval, now) if not force else now+self.interval
+        if len(due)==0:
+            return 0
+        if len(due)==1 or self.workers<=1:
+            outcomes = [self._attempt(batch) for batch in due]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers,len(due))) as executor:
+                outcomes = list(executor.map(self._attempt, due))
+        # the changes are already stored: they are reported even if another batch or a callback failed
+        count = 0
+        errors = [error for changed,error in outcomes if error is not None]
+        for changed,error in outcomes:
+            for callback,series in changed:
+                try:
+                    callback(series)
+                except Exception as e:
+                    errors.append(e)
+                count += 1
+        if errors:
+            raise errors[0]
+        return count
+
+    def _attempt(self, batch):
+        """refreshes a batch. Returns the changes and the error raised, if any."""
+        try:
+            return self._refresh(batch), None
+        except Exception as e:
+            return [], e
+
+    def _refresh(self, batch):
+        """sends one query/last call for a batch and returns the (callback, series) pairs to notify"""
+        if len(batch)==0:
+            return []
+        metrics = [target for h,(target,cb) in batch if isinstance(target,dict)]
+        tsuids = [target for h,(target,cb) in batch if not isinstance(target,dict)]
+        query = OpenTSDBQueryLast(metrics, tsuids, resolveNames=len(metrics)>0, backScan=self.backScan)
+        results = self.client.query(query) or []
+        changed = []
+        with self._lock:
+            for handle,(target,callback) in batch:
+                if handle not in self._subscriptions:
+                    continue
+                for series in results:
+                    if isinstance(target,dict):
+                        if series.get("metric")!=target["metric"]: continue
+                        if not all(series.get("tags",{}).get(k)==v for k,v in list(target["tags"].items())): continue
+                    elif series.get("tsuid")!=target:
+                        continue
+                    key = (handle, series.get("tsuid"))
+                    previous = self._values.get(key)
+                    if previous is None or (previous["timestamp"],previous["value"])!=(series["timestamp"],series["value"]):
+                        self._values[key] = series
+                        changed.append((callback, series))
+        return changed
+
+    def start(self):
+        """refreshes in a background thread until stop is called"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="opentsdb-last-values")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                if self.onError is not None:
+                    self.onError(e)
+                else:
+                    warnings.warn("Refresh of last values failed: %s"%str(e), RuntimeWarning)
+            with self._lock:
+                nextDue = min([slot[0] for slot in self._schedule or []] or [time.time()+self.interval])
+            self._stop.wait(max(0, min(nextDue-time.time(), self.interval)))
@@ -0,0 +1,216 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+import time
+import warnings
+
+suggestTypes = ["metrics", "tagk", "tagv"]
+
+class OpenTSDBPrefixTrie:
+    """Set of strings supporting sorted prefix enumeration.
+       Chains of nodes with a single child are stored as one edge labelled by a string (radix tree)."""
+
+    def __init__(self):
+        # node: [ { first character: (label, child node) }, is a word ]
+        self._root = [{}, False]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, word):
+        """inserts a word. Returns True if it was not there yet."""
+        node = self._root
+        while True:
+            if word=="":
+                if node[1]:
+                    return False
+                node[1] = True
+                self._size += 1
+                return True
+            edge = node[0].get(word[0])
+            if edge is None:
+                node[0][word[0]] = (word, [{}, True])
+                self._size += 1
+                return True
+            label, child = edge
+            common = 0
+            while common<min(len(label),len(word)) and label[common]==word[common]:
+                common += 1
+            if common<len(label):
+                # split the edge
+                middle = [{ label[common]:(label[common:], child) }, False]
+                node[0][word[0]] = (label[:common], middle)
+                child = middle
+            node = child
+            word = word[common:]
+
+    def __contains__(self, word):
+        node, rest = self._find(word)
+        return node is not None and rest=="" and node[1]
+
+    def _find(self, prefix):
+        """the node below which all the words start with prefix, and the part of its label beyond the prefix"""
+        node = self._root
+        while prefix!="":
+            edge = node[0].get(prefix[0])
+            if edge is None:
+                return None, None
+            label, child = edge
+            if label.startswith(prefix):
+                return child, label[len(prefix):]
+            if not prefix.startswith(label):
+                return None, None
+            node = child
+            prefix = prefix[len(label):]
+        return node, ""
+
+    def prefix(self, prefix, limit=None):
+        """the words starting with prefix, in lexicographic order, at most limit of them"""
+        node, rest = self._find(prefix)
+        output = []
+        if node is None:
+            return output
+        stack = [(prefix+rest, node)]
+        while stack and (limit is None or len(output)<limit):
+            word, node = stack.pop()
+            if node[1]:
+                output.append(word)
+            for c in sorted(node[0], reverse=True):
+                label, child = node[0][c]
+                stack.append((word+label, child))
+        return output
+
+
+class OpenTSDBSuggestCache:
+    """Client side autocompletion of metrics, tag keys and tag values, answering suggest calls from prefix tries.
+
+       When the TSD answers suggest(prefix) with less than maxResults names, the cache knows all the names
+       starting with that prefix and answers any longer prefix locally. Other prefixes go to the TSD:
+
+           suggestions = OpenTSDBSuggestCache(client)
+           suggestions.suggest("metrics", "sys.c")    # one call to the TSD
+           suggestions.suggest("metrics", "sys.cpu")  # local
+
+       Names can also be added from an OpenTSDBCatalog. start refreshes the known prefixes every interval
+       seconds in a background thread, so that new names show up. Deleted names are never removed."""
+
+    def __init__(self, client, maxResults=10000, interval=300, onError=None):
+        self.client = client
+        self.maxResults = maxResults
+        self.interval = interval
+        self.onError = onError
+        self._lock = threading.Lock()
+        self._tries = { t:OpenTSDBPrefixTrie() for t in suggestTypes }
+        # type -> { prefix whose names are all known: time of the last fetch }
+        self._complete = { t:{} for t in suggestTypes }
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _checkType(datatype):
+        if datatype not in suggestTypes:
+            raise ValueError("Invalid suggest type: %s"%datatype)
+
+    def add(self, datatype, names, complete=False):
+        """adds names. With complete=True, they are assumed to be all the names of that type."""
+        OpenTSDBSuggestCache._checkType(datatype)
+        with self._lock:
+            for name in names:
+                self._tries[datatype].add(name)
+            if complete:
+                self._complete[datatype][""] = time.time()
+
+    def addCatalog(self, catalog, complete=False):
+        """adds the metrics, tag keys and tag values of an OpenTSDBCatalog"""
+        self.add("metrics", catalog.metrics(), complete)
+        tagKeys = catalog.tagKeys()
+        self.add("tagk", tagKeys, complete)
+        values = set()
+        for tagk in tagKeys:
+            values.update(catalog.tagValues(tagk))
+        self.add("tagv", sorted(values), complete)
+
+    def known(self, datatype, prefix):
+        """True if all the names starting with prefix are in the cache"""
+        OpenTSDBSuggestCache._checkType(datatype)
+        with self._lock:
+            return any(prefix[:i] in self._complete[datatype] for i in range(len(prefix)+1))
+
+    def suggest(self, datatype, query="", maxResults=25):
+        """the names of the given type starting with query, sorted, as client.suggest returns them"""
+        if not self.known(datatype, query):
+            self.fetch(datatype, query)
+        with self._lock:
+            return self._tries[datatype].prefix(query, maxResults)
+
+    def fetch(self, datatype, prefix):
+        """asks the TSD for the names starting with prefix"""
+        names = self.client.suggest(datatype, prefix, self.maxResults) or []
+        with self._lock:
+            for name in names:
+                self._tries[datatype].add(name)
+            if len(names)<self.maxResults:
+                self._complete[datatype][prefix] = time.time()
+            else:
+                # the prefix outgrew maxResults: the TSD has to be asked again
+                self._complete[datatype].pop(prefix, None)
+        return names
+
+    def refresh(self, now=None):
+        """fetches again the known prefixes older than interval (not covered by a shorter one).
+           Returns the number of calls to the TSD."""
+        if now is None: now = time.time()
+        with self._lock:
+            due = []
+            for datatype in suggestTypes:
+                complete = self._complete[datatype]
+                for prefix,fetched in list(complete.items()):
+                    if now-fetched>=self.interval and not any(prefix[:i] in complete for i in range(len(prefix))):
+                        due.append((datatype, prefix))
+        for datatype,prefix in due:
+            self.fetch(datatype, prefix)
+        return len(due)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(t) for t in self._tries.values())
+
+    def start(self):
+        """refreshes in a background thread until stop is called"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="opentsdb-suggest")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                if self.onError is not None:
+                    self.onError(e)
+                else:
+                    warnings.warn("Refresh of suggestions failed: %s"%str(e), RuntimeWarning)
@@ -0,0 +1,138 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import re
+from .opentsdbobjects import OpenTSDBRule, OpenTSDBTimeSeries
+
+class OpenTSDBTreeSimulator:
+    """Applies the rules of an OpenTSDBTreeDefinition locally, to predict the tree built by the TSD without test_tree.
+
+       As the TSD does, levels are processed in order and the first rule of a level (by order) that matches gives
+       the name of the branch at that level. A rule takes the metric (METRIC), the value of the tag field (TAGK) or
+       a custom field of the meta data of the metric, tag key or tag value (*_CUSTOM). The value is then
+       transformed by regex (group regexGroupIdx) or split by separator into several branches, and formatted with
+       displayFormat ({ovalue}, {value}, {tag_name} and {tsuid}). The last name is the leaf, the others the branches.
+       With strictMatch, a series must match a rule on every level.
+
+           simulator = OpenTSDBTreeSimulator(definition)
+           result = simulator.simulate(catalog.series("sys.cpu.user"))
+           result["leaves"], result["collisions"], result["notMatched"]
+
+       Series are OpenTSDBTimeSeries, or maps with tsuid, metric and tags as returned by LOOKUP or OpenTSDBCatalog.
+       Custom rules need the meta data of OpenTSDBTimeSeries. Regular expressions are evaluated by python:
+       constructs specific to java regular expressions are not supported."""
+
+    def __init__(self, definition):
+        self.strictMatch = definition.strictMatch
+        self.levels = []
+        for level in sorted(definition.rules, key=int):
+            orders = definition.rules[level]
+            rules = [r if isinstance(r,OpenTSDBRule) else OpenTSDBRule(**r) for _,r in sorted(list(orders.items()), key=lambda o: int(o[0]))]
+            self.levels.append([(r, re.compile(r.regex) if r.regex else None) for r in rules])
+
+    @staticmethod
+    def _series(ts):
+        """tsuid, metric, tags and custom fields of a series: metric custom, { tagk: custom }, { tagv: custom }"""
+        if isinstance(ts,OpenTSDBTimeSeries):
+            return (ts.metadata.tsuid, ts.metric, ts.tags or {}, ts.metric_meta.custom or {},
+                    { k:m.custom or {} for k,m in list(ts.tagk_meta.items()) }, { v:m.custom or {} for v,m in list(ts.tagv_meta.items()) })
+        return (ts.get("tsuid"), ts["metric"], ts.get("tags") or {}, {}, {}, {})
+
+    @staticmethod
+    def _value(rule, metric, tags, metricCustom, tagkCustom, tagvCustom):
+        """the (value, tag name) the rule reads from the series, or None"""
+        if rule.type=="METRIC":
+            return (metric, None)
+        if rule.type=="METRIC_CUSTOM":
+            value = metricCustom.get(rule.customField)
+            return None if value is None else (value, None)
+        if rule.type=="TAGK":
+            value = tags.get(rule.field)
+            return None if value is None else (value, rule.field)
+        if rule.type=="TAGK_CUSTOM":
+            if rule.field not in tags:
+                return None
+            value = tagkCustom.get(rule.field,{}).get(rule.customField)
+            return None if value is None else (value, rule.field)
+        if rule.type=="TAGV_CUSTOM":
+            for k,v in sorted(tags.items()):
+                if (rule.field is None or k==rule.field) and rule.customField in tagvCustom.get(v,{}):
+                    return (tagvCustom[v][rule.customField], k)
+        return None
+
+    @staticmethod
+    def _names(rule, regex, value, tagName, tsuid):
+        """the branch names produced by a rule from a value, or None if it does not match"""
+        if regex is not None:
+            match = regex.search(value)
+            if match is None or rule.regexGroupIdx+1>len(match.groups()) or not match.group(rule.regexGroupIdx+1):
+                return None
+            names = [match.group(rule.regexGroupIdx+1)]
+        elif rule.separator:
+            names = [n for n in re.split(rule.separator, value) if n]
+        else:
+            names = [value]
+        if not names:
+            return None
+        if rule.displayFormat:
+            names = [rule.displayFormat.replace("{ovalue}", value).replace("{value}", n)
+                                       .replace("{tag_name}", tagName or "").replace("{tsuid}", tsuid or "") for n in names]
+        return names
+
+    def evaluate(self, ts):
+        """the path of names of a series (branches then leaf), or a message explaining why it does not match"""
+        tsuid, metric, tags, metricCustom, tagkCustom, tagvCustom = OpenTSDBTreeSimulator._series(ts)
+        path = []
+        for level,rules in enumerate(self.levels):
+            for rule,regex in rules:
+                found = OpenTSDBTreeSimulator._value(rule, metric, tags, metricCustom, tagkCustom, tagvCustom)
+                names = None if found is None else OpenTSDBTreeSimulator._names(rule, regex, found[0], found[1], tsuid)
+                if names is not None:
+                    path += names
+                    break
+            else:
+                if self.strictMatch:
+                    return None, "Failed to match a rule on level %d with strict matching enabled"%level
+        if not path:
+            return None, "No rule matched"
+        return path, None
+
+    def simulate(self, series):
+        """runs the series through the rules. Returns
+               leaves: { tsuid: path }, the last element of the path being the leaf name
+               collisions: { tsuid: tsuid of the series already at the same place }
+               notMatched: { tsuid: message }
+               branches: the tree of branch names, as nested maps"""
+        leaves = {}
+        collisions = {}
+        notMatched = {}
+        branches = {}
+        placed = {}
+        for ts in series:
+            tsuid = OpenTSDBTreeSimulator._series(ts)[0]
+            path, message = self.evaluate(ts)
+            if path is None:
+                notMatched[tsuid] = message
+                continue
+            key = tuple(path)
+            if key in placed and placed[key]!=tsuid:
+                collisions[tsuid] = placed[key]
+                continue
+            placed[key] = tsuid
+            leaves[tsuid] = path
+            node = branches
+            for name in path[:-1]:
+                node = node.setdefault(name, {})
+        return { "leaves":leaves, "collisions":collisions, "notMatched":notMatched, "branches":branches }
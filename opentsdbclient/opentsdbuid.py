@@ -0,0 +1,170 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import tempfile
+import threading
+from .opentsdberrors import OpenTSDBError
+
+uidTypes = ["metric", "tagk", "tagv"]
+
+class OpenTSDBUIDCache:
+    """Client side cache of the name <-> UID mappings of metrics, tag keys and tag values.
+
+       UIDs never change once assigned, so entries do not expire. assign resolves the UIDs of many
+       time series at once: the names missing from the cache are deduplicated and sent in a few
+       assign_uid calls, names that already exist being recovered from the error messages of the TSD.
+
+           uids = OpenTSDBUIDCache("/var/lib/collector/uids.json")
+           uids.assign(client, series)
+           uids.save()
+
+       With a path, the mappings are loaded at construction and written back by save."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._uids = { t:{} for t in uidTypes }
+        self._names = { t:{} for t in uidTypes }
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def _checkType(uidtype):
+        if uidtype.lower() not in uidTypes:
+            raise ValueError("Invalid UID type: %s"%uidtype)
+        return uidtype.lower()
+
+    def uid(self, uidtype, name):
+        """the UID of a name, or None if unknown"""
+        with self._lock:
+            return self._uids[OpenTSDBUIDCache._checkType(uidtype)].get(name)
+
+    def name(self, uidtype, uid):
+        """the name of a UID, or None if unknown"""
+        with self._lock:
+            return self._names[OpenTSDBUIDCache._checkType(uidtype)].get(uid.upper())
+
+    def put(self, uidtype, name, uid):
+        uidtype = OpenTSDBUIDCache._checkType(uidtype)
+        int(uid,16)
+        with self._lock:
+            self._uids[uidtype][name] = uid.upper()
+            self._names[uidtype][uid.upper()] = name
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(self._uids[t]) for t in uidTypes)
+
+    def clear(self):
+        with self._lock:
+            self._uids = { t:{} for t in uidTypes }
+            self._names = { t:{} for t in uidTypes }
+
+    def load(self, path=None):
+        """adds the mappings stored in a file written by save"""
+        with open(path or self.path) as f:
+            stored = json.load(f)
+        for uidtype in uidTypes:
+            for name,uid in list(stored.get(uidtype,{}).items()):
+                self.put(uidtype, name, uid)
+        return self
+
+    def save(self, path=None):
+        """writes the mappings to a JSON file. The file is replaced atomically."""
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path given to save the UID cache.")
+        with self._lock:
+            data = json.dumps(self._uids, sort_keys=True)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.rename(temporary, path)
+
+    def update(self, response):
+        """adds the UIDs of an assign_uid response, including the names reported as already assigned.
+           Returns the errors that are not about existing names, as a map type -> { name:message }."""
+        errors = {}
+        for uidtype in uidTypes:
+            for name,uid in list((response.get(uidtype) or {}).items()):
+                self.put(uidtype, name, uid)
+            for name,message in list((response.get("%s_errors"%uidtype) or {}).items()):
+                # e.g. "Name already exists with UID: 000042"
+                uid = message.split()[-1] if "exists" in message else ""
+                try:
+                    int(uid,16)
+                except ValueError:
+                    errors.setdefault(uidtype,{})[name] = message
+                    continue
+                self.put(uidtype, name, uid)
+        return errors
+
+    def missing(self, series):
+        """the names of the time series not in the cache, as a map type -> sorted list"""
+        missing = { t:set() for t in uidTypes }
+        with self._lock:
+            for ts in series:
+                if ts.metric not in self._uids["metric"]:
+                    missing["metric"].add(ts.metric)
+                for k,v in list(ts.tags.items()):
+                    if k not in self._uids["tagk"]:
+                        missing["tagk"].add(k)
+                    if v not in self._uids["tagv"]:
+                        missing["tagv"].add(v)
+        return { t:sorted(names) for t,names in list(missing.items()) }
+
+    def assign(self, client, series, batchSize=1000):
+        """resolves the UIDs of a list of OpenTSDBTimeSeries with as few assign_uid calls as possible,
+           at most batchSize names per call, and sets the uid of their metric and tags meta.
+           Raises an OpenTSDBError if some names could not be assigned."""
+        series = [ts for ts in series if ts.metric is not None]
+        names = [(t,name) for t,names in list(self.missing(series).items()) for name in names]
+        errors = {}
+        for i in range(0, len(names), batchSize):
+            chunk = names[i:i+batchSize]
+            lists = { t:[name for tt,name in chunk if tt==t] or None for t in uidTypes }
+            try:
+                response = client.assign_uid(lists["metric"], lists["tagk"], lists["tagv"])
+            except OpenTSDBError as e:
+                if e.code!=400:
+                    raise
+                response = json.loads(e.details)
+            for t,failed in list(self.update(response).items()):
+                errors.setdefault(t,{}).update(failed)
+        for ts in series:
+            self.fill(ts)
+        if errors:
+            raise OpenTSDBError(400, "assign_uid: some names could not be assigned", json.dumps(errors), "")
+        return series
+
+    def fill(self, ts):
+        """sets the uid of the metric and tags meta of a time series from the cache. Returns True if all are known."""
+        complete = True
+        with self._lock:
+            uid = self._uids["metric"].get(ts.metric)
+            if uid is None:
+                complete = False
+            else:
+                ts.metric_meta.uid = uid
+            for k,v in list(ts.tags.items()):
+                for uidtype,name,meta in [("tagk",k,ts.tagk_meta),("tagv",v,ts.tagv_meta)]:
+                    uid = self._uids[uidtype].get(name)
+                    if uid is None:
+                        complete = False
+                    elif name in meta:
+                        meta[name].uid = uid
+        return complete
@@ -1 +1,17 @@
+import json
 import testtools
+from requests.exceptions import HTTPError
+
+
+class FakeResponse:
+    def __init__(self,status_code,content):
+        self.status_code = status_code
+        self.content = content
+        self.text = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code>=400:
+            raise HTTPError()
@@ -0,0 +1,101 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbobjects import OpenTSDBAnnotation
+from opentsdbannotationindex import OpenTSDBIntervalTree, OpenTSDBAnnotationIndex
+import json
+import random
+import requests
+
+
+class TestOpenTSDBIntervalTree(TestCase):
+
+    def test_overlap(self):
+        rng = random.Random(42)
+        tree = OpenTSDBIntervalTree()
+        intervals = {}
+        for i in range(2000):
+            start = rng.randint(0,10000)
+            end = start + rng.choice([0, rng.randint(0,50), rng.randint(0,2000)])
+            ident = rng.randint(0,5)
+            tree.add(start, end, ident, (start,end,ident))
+            intervals[(start,ident)] = (start,end,ident)
+        for start,ident in rng.sample(sorted(intervals), 500):
+            tree.remove(start, ident)
+            del intervals[(start,ident)]
+        tree.remove(-1, 0)
+        self.assertEqual(len(intervals),len(tree))
+        for i in range(200):
+            lo = rng.randint(-100,10100)
+            hi = lo + rng.randint(0,500)
+            expected = sorted(v for v in intervals.values() if v[0]<=hi and v[1]>=lo)
+            self.assertEqual(expected,sorted(tree.overlap(lo,hi)))
+        # iteration is ordered by start and id
+        self.assertEqual(sorted(intervals.values(), key=lambda v: (v[0],v[2])),list(tree))
+        self.assertRaises(ValueError,tree.add,10,5,0,None)
+
+
+class TestOpenTSDBAnnotationIndex(TestCase):
+
+    def test_index(self):
+        index = OpenTSDBAnnotationIndex()
+        index.add([OpenTSDBAnnotation(100, 200, "000001000001000001", "deploy"),
+                   OpenTSDBAnnotation(150, tsuid="000001000001000002", description="restart"),
+                   {"startTime":120, "endTime":400, "description":"outage"},
+                   OpenTSDBAnnotation(500, 600, "000001000001000001", "deploy 2")])
+        self.assertEqual(4,len(index))
+        self.assertEqual(["deploy","outage","restart"],[a.description for a in index.overlap(150,160)])
+        self.assertEqual(["deploy","outage"],[a.description for a in index.overlap(150,160,tsuids=["000001000001000001"])])
+        self.assertEqual(["restart"],[a.description for a in index.overlap(150,tsuids=["000001000001000002"],includeGlobal=False)])
+        self.assertEqual(["outage"],[a.description for a in index.overlap(300,450)])
+        self.assertEqual([],index.overlap(700,800))
+        # same tsuid and start time: replaced
+        index.add(OpenTSDBAnnotation(100, 130, "000001000001000001", "deploy (fixed)"))
+        self.assertEqual(4,len(index))
+        self.assertEqual(["outage","restart"],[a.description for a in index.overlap(140,160)])
+        index.remove(120)
+        index.remove(150, "000001000001000002")
+        self.assertEqual(["deploy (fixed)"],[a.description for a in index.overlap(0,1000,includeGlobal=True,tsuids=["000001000001000001","000001000001000002"])][:1])
+        self.assertEqual(2,len(index))
+
+    def test_client(self):
+        stored = [{"startTime":100+i, "tsuid":"%018X"%(i%3), "description":"a%d"%i} for i in range(30)] + [{"startTime":110, "description":"global"}]
+        calls = []
+        def my_post(url,data):
+            query = json.loads(data)
+            calls.append((url,query))
+            if url.endswith("/bulk"):
+                return FakeResponse(200,data)
+            return FakeResponse(200,json.dumps({"type":"ANNOTATION","totalResults":len(stored),
+                                                "results":stored[query["startindex"]:query["startindex"]+query["limit"]]}))
+        def my_delete(url,data):
+            calls.append((url,json.loads(data)))
+            return FakeResponse(200,json.dumps({"totalDeleted":1}))
+        self.patch(requests, 'post', my_post)
+        self.patch(requests, 'delete', my_delete)
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        index = OpenTSDBAnnotationIndex()
+        self.assertEqual(31,index.load(client, pageSize=10))
+        self.assertEqual(["a8","a9","global","a10"],[a.description for a in index.overlap(108,110)])
+        index.save(client, [OpenTSDBAnnotation(109, tsuid="%018X"%0, description="new")])
+        # a9 has the same tsuid and start time: replaced
+        self.assertEqual(["a8","new","global","a10"],[a.description for a in index.overlap(108,110)])
+        index.delete(client, 105, 110, ["%018X"%1], considerGlobal=True)
+        self.assertEqual({"startTime":105, "endTime":110, "tsuids":["%018X"%1], "global":True},calls[-1][1])
+        self.assertEqual(["a5","a6","a8","new"],[a.description for a in index.overlap(105,110)])
@@ -0,0 +1,92 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBMetricSubQuery, OpenTSDBtsuidSubQuery
+from opentsdbbatch import OpenTSDBQueryBatcher
+from opentsdberrors import OpenTSDBError
+import json
+import requests
+
+
+def fake_server(calls):
+    """answers each subquery with one series per metric/tsuid, echoing the query with its index"""
+    def my_post(url,data):
+        query = json.loads(data)
+        calls.append(query)
+        results = []
+        for i,q in enumerate(query["queries"]):
+            q["index"] = i
+            name = q.get("metric",q.get("tsuids",[""])[0])
+            results.append({"metric":name,"tags":{},"aggregateTags":[],"query":q,"dps":{"1":i}})
+        return FakeResponse(200,json.dumps(results))
+    return my_post
+
+
+class TestOpenTSDBQueryBatcher(TestCase):
+
+    def test_batch(self):
+        calls = []
+        self.patch(requests, 'post', fake_server(calls))
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        with client.batch() as batch:
+            cpu = batch.add(OpenTSDBMetricSubQuery("sum","sys.cpu.user"),"1h-ago")
+            mem = batch.add(OpenTSDBMetricSubQuery("sum","sys.mem.free"),"1h-ago")
+            ts = batch.add(OpenTSDBtsuidSubQuery("sum",["000001000002000042"]),"1h-ago")
+            other = batch.add(OpenTSDBMetricSubQuery("max","sys.cpu.user"),"2h-ago","1h-ago")
+            self.assertEqual(4,batch.pending())
+        self.assertEqual(2,len(calls))
+        self.assertEqual("sys.cpu.user",cpu.result()[0]["metric"])
+        self.assertEqual("sys.mem.free",mem.result()[0]["metric"])
+        self.assertEqual("000001000002000042",ts.result()[0]["metric"])
+        self.assertEqual("sys.cpu.user",other.result()[0]["metric"])
+        for call in calls:
+            self.assertEqual(True,call["showQuery"])
+
+    def test_maxBatch(self):
+        calls = []
+        self.patch(requests, 'post', fake_server(calls))
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        batch = OpenTSDBQueryBatcher(client, maxBatch=2)
+        first = batch.add(OpenTSDBMetricSubQuery("sum","sys.cpu.user"),1356998400)
+        self.assertEqual(0,len(calls))
+        second = batch.add(OpenTSDBMetricSubQuery("sum","sys.cpu.nice"),1356998400)
+        self.assertEqual(1,len(calls))
+        self.assertEqual(0,batch.pending())
+        self.assertEqual(1,second.result()[0]["dps"]["1"])
+        self.assertRaises(ValueError,OpenTSDBQueryBatcher,client,0)
+
+    def test_demultiplex(self):
+        subqueries = [OpenTSDBMetricSubQuery("sum","sys.cpu.user"),OpenTSDBMetricSubQuery("sum","sys.cpu.nice")]
+        results = [{"metric":"sys.cpu.nice","tags":{"host":"web01"},"query":{"aggregator":"sum","metric":"sys.cpu.nice","index":1}},
+                   {"metric":"sys.cpu.nice","tags":{"host":"web02"},"query":{"aggregator":"sum","metric":"sys.cpu.nice","index":1}}]
+        self.assertEqual([[],results],OpenTSDBQueryBatcher.demultiplex(results,subqueries))
+        # no index: match on the echoed query
+        for r in results: del r["query"]["index"]
+        self.assertEqual([[],results],OpenTSDBQueryBatcher.demultiplex(results,subqueries))
+        self.assertRaises(ValueError,OpenTSDBQueryBatcher.demultiplex,[{"metric":"sys.cpu.nice"}],subqueries)
+
+    def test_error(self):
+        def my_post(url,data): return FakeResponse(400,json.dumps({"error":{"code":400,"message":"No such name for 'metrics'"}}))
+        self.patch(requests, 'post', my_post)
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        with client.batch() as batch:
+            cpu = batch.add(OpenTSDBMetricSubQuery("sum","sys.cpu.user"),"1h-ago")
+            mem = batch.add(OpenTSDBMetricSubQuery("sum","sys.mem.free"),"1h-ago")
+        self.assertRaises(OpenTSDBError,cpu.result)
+        self.assertRaises(OpenTSDBError,mem.result)
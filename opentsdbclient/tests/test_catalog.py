@@ -0,0 +1,103 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBFilter
+from opentsdbplanner import OpenTSDBQueryPlanner
+from opentsdbcatalog import OpenTSDBCatalog
+import json
+import os
+import re
+import requests
+import tempfile
+
+
+def tsmeta(i, metric, host, dc, created):
+    uid = lambda t,name: {"uid":"%06X"%i, "type":t, "name":name}
+    return { "tsuid":"%06d"%i, "metric":uid("METRIC",metric), "tags":[uid("TAGK","host"),uid("TAGV",host),uid("TAGK","dc"),uid("TAGV",dc)],
+             "created":created, "lastReceived":0 }
+
+
+class TestOpenTSDBCatalog(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBCatalog, self).setUp()
+        self.records = [tsmeta(i, "sys.cpu.user" if i%2 else "sys.cpu.nice", "web%02d"%(i%10), "lga" if i<10 else "sjc", 1000+i) for i in range(20)]
+        self.queries = []
+        def my_post(url,data):
+            query = json.loads(data)
+            self.queries.append(query["query"])
+            since = re.match(r"created:\[(\d+) TO \*\]", query["query"])
+            results = [r for r in self.records if since is None or r["created"]>=int(since.group(1))]
+            page = results[query["startindex"]:query["startindex"]+query["limit"]]
+            return FakeResponse(200,json.dumps({"type":"TSMETA","totalResults":len(results),"results":page}))
+        self.patch(requests, 'post', my_post)
+        self.client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+
+    def test_lookup(self):
+        catalog = OpenTSDBCatalog()
+        self.assertEqual(20,catalog.sync(self.client, pageSize=7))
+        self.assertEqual(20,len(catalog))
+        self.assertEqual(["sys.cpu.nice","sys.cpu.user"],catalog.metrics())
+        self.assertEqual([{"tsuid":"000003","metric":"sys.cpu.user","tags":{"host":"web03","dc":"lga"}},
+                          {"tsuid":"000013","metric":"sys.cpu.user","tags":{"host":"web03","dc":"sjc"}}],
+                         catalog.series("sys.cpu.user",{"host":"web03"}))
+        self.assertEqual(["000013"],catalog.get("sys.cpu.user",{"host":"web03","dc":"sjc"}))
+        self.assertEqual([],catalog.get("sys.cpu.user",{"host":"web02"}))
+        self.assertEqual(10,catalog.cardinality("sys.cpu.user"))
+        self.assertEqual(10,catalog.cardinality(tags={"dc":"lga"}))
+        self.assertEqual(20,catalog.cardinality("*",{"host":"*"}))
+        self.assertEqual({"lga":5,"sjc":5},catalog.tagValues("dc","sys.cpu.nice"))
+        self.assertEqual({"web01":1},catalog.tagValues("host","sys.cpu.user",{"dc":"sjc","host":"web01"}))
+
+    def test_sync(self):
+        path = os.path.join(tempfile.mkdtemp(), "catalog.db")
+        catalog = OpenTSDBCatalog(path, overlap=5)
+        self.assertEqual(None,catalog.lastSync())
+        catalog.sync(self.client)
+        self.assertEqual(1019,catalog.lastSync())
+        # only the new and recently updated series are fetched
+        self.records.append(tsmeta(20, "sys.mem.free", "web00", "lga", 1030))
+        # with the overlap, the last series of the previous sync are fetched again
+        self.assertEqual(7,catalog.sync(self.client))
+        self.assertEqual("created:[1014 TO *] OR lastReceived:[1014 TO *]",self.queries[-1])
+        self.assertEqual(21,len(catalog))
+        catalog.close()
+        # the catalog persists, and a full sync removes the deleted series
+        catalog = OpenTSDBCatalog(path)
+        self.assertEqual(21,len(catalog))
+        self.assertEqual(1030,catalog.lastSync())
+        del self.records[0]
+        catalog.sync(self.client, full=True)
+        self.assertEqual("*",self.queries[-1])
+        self.assertEqual(20,len(catalog))
+        self.assertEqual([],catalog.get("sys.cpu.nice",{"host":"web00","dc":"lga"}))
+        catalog.remove("000020")
+        self.assertEqual(["sys.cpu.nice","sys.cpu.user"],catalog.metrics())
+        # a full sync that fails leaves the catalog as it was
+        self.records.append({"tsuid":"000021"})
+        self.assertRaises(KeyError,catalog.sync,self.client,full=True)
+        self.assertEqual(19,len(catalog))
+
+    def test_planner(self):
+        catalog = OpenTSDBCatalog()
+        catalog.add("000001000001000001","sys.cpu.user",{"host":"web01"})
+        planner = OpenTSDBQueryPlanner(catalog)
+        query = OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("literal_or","host","web01")])],"1h-ago")
+        self.assertEqual(["000001000001000001"],planner.plan(query).subqueries[0].tsuids)
+        self.assertRaises(ValueError,catalog.add,"nothex","sys.cpu.user",{})
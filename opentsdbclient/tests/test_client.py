@@ -359,8 +359,13 @@ class TestClientServer(TestCase):
         expressions = [OpenTSDBExpQuery.expression("e1","cpunice*2")]
         outputs = [OpenTSDBExpQuery.output("cpunice","CPU nice"),OpenTSDBExpQuery.output("e1","CPU nice twice")]
         theQuery = OpenTSDBExpQuery(timeSection, filters, metrics, expressions, outputs)
-        self.assertRaises(RuntimeError,self.client.query,theQuery) # 2.3 only...
-        ## decode and test
+        # before 2.3, the expression is evaluated by the client
+        r3 = self.client.query(theQuery)
+        self.assertEqual(["cpunice","e1"],[o["id"] for o in r3["outputs"]])
+        self.assertEqual("CPU nice twice",r3["outputs"][1]["alias"])
+        for raw,twice in zip(r3["outputs"][0]["dps"],r3["outputs"][1]["dps"]):
+            self.assertEqual(raw[0],twice[0])
+            self.assertTrue(abs(2*raw[1]-twice[1])<1e-6)
         ## NOTE I am experiencing problems with 2.3-RC1... server crash with some basic query. Too early?
 
         # last query
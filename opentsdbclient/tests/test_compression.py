@@ -0,0 +1,68 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+
+from testtools import TestCase
+from opentsdbcompression import OpenTSDBCompressedSeries
+import math
+import random
+
+
+class TestOpenTSDBCompressedSeries(TestCase):
+
+    def test_roundtrip(self):
+        rng = random.Random(42)
+        t = 1356998400000
+        points = []
+        for i in range(2000):
+            t += rng.choice([1000, 1000, 1000, 999, 1003, 60000, 1, 5000000, 2**40])
+            points.append((t, rng.choice([0.0, -1.5, 1e300, rng.random(), rng.gauss(0,1e6), points[-1][1] if points else 3.0])))
+        series = OpenTSDBCompressedSeries()
+        series.extend(points)
+        self.assertEqual(2000,len(series))
+        self.assertEqual(points,list(series))
+        self.assertFalse(series.integers)
+        self.assertEqual(points[0][0],series.first())
+        self.assertEqual(points[-1][0],series.last())
+
+    def test_compression(self):
+        series = OpenTSDBCompressedSeries()
+        for i in range(10000):
+            series.append(1356998400000+i*10000, 40 + (i//100)%7)
+        self.assertTrue(series.integers)
+        self.assertEqual([(1356998400000,40),(1356998410000,40)],list(series.range(end=1356998410000)))
+        # regular timestamps and mostly constant values: about 2 bits per point
+        self.assertTrue(series.nbytes()<3000)
+
+    def test_range(self):
+        series = OpenTSDBCompressedSeries()
+        series.extend((t*1000,float(t)) for t in range(100))
+        self.assertEqual([(10000,10.),(11000,11.)],list(series.range(10000,11500)))
+        self.assertEqual([],list(series.range(200000)))
+        self.assertEqual(100,len(list(series.range())))
+        self.assertRaises(ValueError,series.append,99000,1.)
+        series.append(100000,None)
+        self.assertTrue(math.isnan(list(series.range(100000))[0][1]))
+        self.assertEqual([],list(OpenTSDBCompressedSeries()))
+
+    def test_result(self):
+        result = {"metric":"sys.cpu.user","tags":{"host":"web01"},"aggregateTags":["cpu"],"dps":{"1356998460":2,"1356998400":1}}
+        series = OpenTSDBCompressedSeries.fromResult(result)
+        self.assertEqual([(1356998400000,1),(1356998460000,2)],list(series))
+        self.assertEqual(result,series.toResult())
+        self.assertEqual({"1356998460000":2},series.toResult(start=1356998401000,msResolution=True)["dps"])
+        series = OpenTSDBCompressedSeries.fromResult({"metric":"m","dps":[[1356998400123,0.5]]},msResolution=True)
+        self.assertEqual([(1356998400123,0.5)],list(series))
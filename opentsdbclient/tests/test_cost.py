@@ -0,0 +1,117 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBtsuidSubQuery, OpenTSDBFilter
+from opentsdbplanner import OpenTSDBLookupCache
+from opentsdbcost import OpenTSDBCostEstimator
+from opentsdberrors import OpenTSDBError
+import json
+import requests
+
+
+day = 86400000
+now = 100*day
+
+
+class TestOpenTSDBCostEstimator(TestCase):
+
+    def test_estimate(self):
+        cache = OpenTSDBLookupCache(None)
+        cache.put("sys.cpu.user",{"host":"web01"},["000001000001000001","000001000001000002"])
+        estimator = OpenTSDBCostEstimator(cache=cache, interval=60)
+        estimator.learnTSMeta([{"metric":{"name":"sys.mem.free"},"created":0,"lastReceived":3000,"totalDatapoints":101},
+                               {"metric":{"name":"sys.mem.free"},"created":0,"lastReceived":0,"totalDatapoints":0},
+                               {"metric":{"name":"sys.mem.free"},"created":1000,"lastReceived":4000,"totalDatapoints":101}])
+        self.assertEqual((3,30000),estimator.cardinality["sys.mem.free"])
+        queries = [ (OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("literal_or","host","web01")]), 2*1440),
+                    (OpenTSDBMetricSubQuery("sum","sys.cpu.user"), 1440),
+                    (OpenTSDBMetricSubQuery("sum","sys.mem.free"), 3*2880),
+                    (OpenTSDBMetricSubQuery("sum","sys.mem.free",downsample="1h-avg"), 3*24),
+                    (OpenTSDBMetricSubQuery("sum","sys.mem.free",downsample="0all-avg"), 3),
+                    (OpenTSDBtsuidSubQuery("sum",["000001000001000001"]), 1440) ]
+        for q,expected in queries:
+            self.assertEqual(expected,estimator.estimate(OpenTSDBQuery([q],"1d-ago"),now))
+        self.assertEqual(1440+3*2880,estimator.estimate(OpenTSDBQuery([queries[1][0],queries[2][0]],(now-day)//1000,now//1000),now))
+
+    def test_policies(self):
+        query = OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user")],"10d-ago")
+        estimator = OpenTSDBCostEstimator(maxPoints=1000)
+        estimator.learn("sys.cpu.user",10)
+        self.assertEqual(144000,estimator.estimate(query,now))
+        self.assertRaises(OpenTSDBError,estimator.apply,query,now)
+        self.assertEqual([query],OpenTSDBCostEstimator(maxPoints=144000).apply(query,now))
+        # downsample: the original query is untouched
+        estimator.policy = "downsample"
+        downsampled = estimator.apply(query,now)
+        self.assertEqual(1,len(downsampled))
+        self.assertEqual("144m-avg",downsampled[0].subqueries[0].downsample)
+        self.assertEqual(None,query.subqueries[0].downsample)
+        self.assertTrue(estimator.estimate(downsampled[0],now)<=1000)
+        # split: windows aligned on the downsample interval
+        estimator.maxPoints = 50000
+        estimator.policy = "split"
+        windows = estimator.apply(query,now)
+        self.assertEqual(3,len(windows))
+        self.assertEqual(now-10*day,windows[0].start)
+        self.assertEqual(windows[0].end+1,windows[1].start)
+        self.assertEqual(now,windows[-1].end)
+        query.subqueries[0].downsample = "1d-avg"
+        estimator.maxPoints = 30
+        windows = estimator.apply(query,now)
+        for w in windows[1:]:
+            self.assertEqual(0,w.start%day)
+        self.assertRaises(ValueError,OpenTSDBCostEstimator,policy="truncate")
+
+    def test_client(self):
+        calls = []
+        def my_post(url,data):
+            query = json.loads(data)
+            calls.append(query)
+            results = []
+            for i,q in enumerate(query["queries"]):
+                q["index"] = i
+                results.append({"metric":q["metric"],"tags":{"host":"web01"},"aggregateTags":[],"query":q,
+                                "dps":{str(query["start"]):i, str(query["end"]):i}})
+            return FakeResponse(200,json.dumps(results))
+        self.patch(requests, 'post', my_post)
+        estimator = OpenTSDBCostEstimator(maxPoints=1500, policy="split")
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0",costPolicy=estimator)
+        query = OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user"),OpenTSDBMetricSubQuery("max","sys.cpu.user")],"1d-ago")
+        result = client.query(query)
+        self.assertEqual(2,len(calls))
+        self.assertEqual(2,len(result))
+        self.assertEqual(4,len(result[0]["dps"]))
+        self.assertEqual([0,0,0,0],list(result[0]["dps"].values()))
+        self.assertEqual([1,1,1,1],list(result[1]["dps"].values()))
+        self.assertFalse("query" in result[0])
+        estimator.policy = "reject"
+        self.assertRaises(OpenTSDBError,client.query,query)
+        self.assertEqual(2,len(calls))
+        # prepared queries are estimated from the original query
+        prepared = query.prepare().bind("1d-ago")
+        self.assertRaises(OpenTSDBError,client.query,prepared)
+        self.assertEqual(2,len(calls))
+        estimator.policy = "split"
+        self.assertEqual(2,len(client.query(prepared)))
+        self.assertEqual(4,len(calls))
+        # and sent as they are when within the budget
+        small = prepared.bind("2m-ago","1m-ago")
+        client.query(small)
+        self.assertEqual(5,len(calls))
+        self.assertEqual(("2m-ago","1m-ago"),(calls[-1]["start"],calls[-1]["end"]))
@@ -0,0 +1,101 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery
+from opentsdbdiskcache import OpenTSDBDiskCache
+import json
+import math
+import requests
+import shutil
+import tempfile
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+results = [ {"metric":"sys.cpu.user","tags":{"host":"web01"},"aggregateTags":[],"dps":{"1356998400":1,"1356998460":2}},
+            {"metric":"sys.cpu.user","tags":{"host":"web02"},"aggregateTags":[],"dps":{"1356998400":0.5,"1356998460":None}} ]
+
+def key(start, end):
+    return "http://localhost:4242/api/query" + json.dumps({"queries":[{"aggregator":"sum","metric":"sys.cpu.user"}],"start":start,"end":end}, sort_keys=True)
+
+
+class TestOpenTSDBDiskCache(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBDiskCache, self).setUp()
+        if np is None:
+            self.skipTest("numpy is not available")
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_cacheable(self):
+        self.assertTrue(OpenTSDBDiskCache.cacheable(key(1356998400,1356998460)))
+        self.assertTrue(OpenTSDBDiskCache.cacheable(key("2013/01/01-00:00:00","2013/01/02")))
+        self.assertFalse(OpenTSDBDiskCache.cacheable(key("1h-ago",1356998460)))
+        self.assertFalse(OpenTSDBDiskCache.cacheable(key(1356998400,"1m-ago")))
+        self.assertFalse(OpenTSDBDiskCache.cacheable(key(1356998400,None)))
+        self.assertFalse(OpenTSDBDiskCache.cacheable(key(1356998400,4102444800)))
+        self.assertFalse(OpenTSDBDiskCache.cacheable("http://localhost:4242/api/version"))
+
+    def test_get_put(self):
+        cache = OpenTSDBDiskCache(self.directory)
+        k = key(1356998400,1356998460)
+        self.assertEqual(None,cache.get(k))
+        self.assertTrue(cache.put(k,results))
+        self.assertFalse(cache.put(key("1h-ago",None),results))
+        loaded = cache.load(k)
+        self.assertTrue(isinstance(loaded[0]["timestamps"],np.memmap))
+        self.assertEqual([1356998400,1356998460],loaded[0]["timestamps"].tolist())
+        self.assertEqual({"host":"web02"},loaded[1]["tags"])
+        self.assertTrue(math.isnan(loaded[1]["values"][1]))
+        self.assertEqual(results,cache.get(k))
+        self.assertEqual(1,len(cache))
+        # another instance, e.g. another process, sees the entry
+        self.assertEqual(results,OpenTSDBDiskCache(self.directory).get(k))
+        cache.clear()
+        self.assertEqual(None,cache.get(k))
+
+    def test_eviction(self):
+        cache = OpenTSDBDiskCache(self.directory)
+        cache.put(key(1356998400,1356998460),results)
+        size = cache.size()
+        cache.maxBytes = 2*size+size//2
+        cache.put(key(1356998400,1356998461),results)
+        cache.get(key(1356998400,1356998460))
+        cache.put(key(1356998400,1356998462),results)
+        self.assertEqual(2,len(cache))
+        self.assertEqual(None,cache.get(key(1356998400,1356998461)))
+        self.assertEqual(results,cache.get(key(1356998400,1356998460)))
+
+    def test_client(self):
+        calls = []
+        def my_post(url,data):
+            calls.append(data)
+            return FakeResponse(200,json.dumps(results))
+        self.patch(requests, 'post', my_post)
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0",cache=OpenTSDBDiskCache(self.directory))
+        query = OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user")],1356998400,1356998460)
+        self.assertEqual(results,client.query(query))
+        self.assertEqual(results,client.query(query))
+        self.assertEqual(1,len(calls))
+        client.query(OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user")],"1h-ago"))
+        client.query(OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user")],"1h-ago"))
+        self.assertEqual(3,len(calls))
@@ -0,0 +1,147 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBFilter
+from opentsdbengine import OpenTSDBLocalEngine, parseDownsample, reduceBuckets, downsample, rate, aggregate
+import json
+import requests
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+raw = [ {"metric":"sys.if.bytes", "tags":{"host":"web01","dc":"lga"}, "dps":{"0":0, "30":30, "60":60, "90":90, "120":120}},
+        {"metric":"sys.if.bytes", "tags":{"host":"web02","dc":"lga"}, "dps":{"0":10, "60":70, "120":5}},
+        {"metric":"sys.if.bytes", "tags":{"host":"web03","dc":"sjc"}, "dps":{"30":1, "90":3}} ]
+
+
+class TestKernels(TestCase):
+
+    def setUp(self):
+        super(TestKernels, self).setUp()
+        if np is None:
+            self.skipTest("numpy is not available")
+
+    def test_parseDownsample(self):
+        self.assertEqual((60000,"avg","none"),parseDownsample("1m-avg"))
+        self.assertEqual((3600000,"p99","nan"),parseDownsample("1h-p99-nan"))
+        self.assertEqual((None,"sum","none"),parseDownsample("0all-sum"))
+        self.assertRaises(ValueError,parseDownsample,"1x-avg")
+        self.assertRaises(ValueError,parseDownsample,"0m-avg")
+        self.assertRaises(ValueError,parseDownsample,None)
+
+    def test_reduceBuckets(self):
+        buckets = np.array([0,0,0,0,1,1])
+        values = np.array([4.,1.,3.,2.,5.,7.])
+        expected = { "sum":[10,12], "min":[1,5], "max":[4,7], "avg":[2.5,6], "count":[4,2], "first":[4,5], "last":[2,7],
+                     "p50":[2.5,6], "ep50r7":[2.5,6], "ep50r3":[2,5] }
+        for aggregator,result in list(expected.items()):
+            keys, r = reduceBuckets(buckets, values, aggregator)
+            self.assertEqual([0,1],keys.tolist())
+            self.assertEqual(result,r.tolist(),aggregator)
+        keys, r = reduceBuckets(buckets, values, "dev")
+        self.assertTrue(abs(r[0]-np.std([4.,1.,3.,2.],ddof=1))<1e-9)
+        self.assertRaises(ValueError,reduceBuckets,buckets,values,"p50r3")
+
+    def test_downsample(self):
+        t = np.array([0,30000,60000,150000])
+        v = np.array([1.,2.,3.,4.])
+        keys, r = downsample(t, v, 60000, "sum")
+        self.assertEqual([0,60000,120000],keys.tolist())
+        self.assertEqual([3.,3.,4.],r.tolist())
+        keys, r = downsample(t, v, 60000, "sum", "zero", 0, 240000)
+        self.assertEqual([0,60000,120000,180000,240000],keys.tolist())
+        self.assertEqual([3.,3.,4.,0.,0.],r.tolist())
+        keys, r = downsample(t, v, None, "max", start=0)
+        self.assertEqual([0],keys.tolist())
+        self.assertEqual([4.],r.tolist())
+
+    def test_rate(self):
+        t = np.array([0,1000,2000,4000])
+        v = np.array([1.,5.,2.,6.])
+        keys, r = rate(t, v)
+        self.assertEqual([1000,2000,4000],keys.tolist())
+        self.assertEqual([4.,-3.,2.],r.tolist())
+        # counter rolling over at 10
+        keys, r = rate(t, v, True, 10)
+        self.assertEqual([4.,7.,2.],r.tolist())
+        # rates above resetValue are resets
+        keys, r = rate(t, v, True, 10, 5)
+        self.assertEqual([4.,0.,2.],r.tolist())
+
+    def test_aggregate(self):
+        a = (np.array([0,2000]),np.array([0.,2.]))
+        b = (np.array([1000,3000]),np.array([10.,10.]))
+        t, r = aggregate([a,b], "sum")
+        self.assertEqual([0,1000,2000,3000],t.tolist())
+        # a is interpolated at 1000, b at 2000, nothing outside of the series range
+        self.assertEqual([0.,11.,12.,10.],r.tolist())
+        t, r = aggregate([a,b], "zimsum")
+        self.assertEqual([0.,10.,2.,10.],r.tolist())
+        t, r = aggregate([a,b], "count")
+        self.assertEqual([1.,1.,1.,1.],r.tolist())
+
+
+class TestOpenTSDBLocalEngine(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBLocalEngine, self).setUp()
+        if np is None:
+            self.skipTest("numpy is not available")
+
+    def test_run(self):
+        engine = OpenTSDBLocalEngine(raw, 0, 120)
+        # sum of everything, lerp
+        r = engine.view("sum")
+        self.assertEqual(1,len(r))
+        self.assertEqual(["dc","host"],r[0]["aggregateTags"])
+        self.assertEqual({},r[0]["tags"])
+        self.assertEqual({"0":10.,"30":71.,"60":132.,"90":130.5,"120":125.},r[0]["dps"])
+        # group by dc, downsampled
+        r = engine.view("max", downsample="1m-max", filters=[OpenTSDBFilter("wildcard","dc","*",True)])
+        self.assertEqual([{"dc":"lga"},{"dc":"sjc","host":"web03"}],[s["tags"] for s in r])
+        self.assertEqual({"0":30.,"60":90.,"120":120.},r[0]["dps"])
+        self.assertEqual({"0":1.,"60":3.},r[1]["dps"])
+        # filtering and no aggregation
+        r = engine.view("none", filters=[OpenTSDBFilter("literal_or","host","web01|web02")])
+        self.assertEqual(2,len(r))
+        self.assertEqual({"host":"web02","dc":"lga"},r[1]["tags"])
+        # counter rate
+        r = engine.view("sum", rate=True, counterMax=100, filters=[OpenTSDBFilter("literal_or","host","web02")])
+        self.assertEqual({"60":1.,"120":35/60.},r[0]["dps"])
+        # fill policies
+        r = engine.view("sum", downsample="1m-sum-null", filters=[OpenTSDBFilter("literal_or","host","web03")], msResolution=True)
+        self.assertEqual({"0":1.,"60000":3.,"120000":None},r[0]["dps"])
+        self.assertRaises(ValueError,engine.view,"median")
+
+    def test_fetch(self):
+        calls = []
+        def my_post(url,data):
+            calls.append(json.loads(data))
+            return FakeResponse(200,json.dumps(raw))
+        self.patch(requests, 'post', my_post)
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        engine = OpenTSDBLocalEngine.fetch(client, "sys.if.bytes", 0, 120)
+        self.assertEqual(1,len(calls))
+        self.assertEqual("none",calls[0]["queries"][0]["aggregator"])
+        self.assertEqual(3,len(engine.series))
+        engine.view("avg", downsample="1m-avg")
+        engine.view("p99", downsample="1m-p99")
+        self.assertEqual(1,len(calls))
@@ -0,0 +1,144 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBExpQuery, OpenTSDBFilter
+from opentsdbexpression import OpenTSDBExpressionEngine
+import ast
+import json
+import math
+import requests
+import templates
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# per metric, the series stored in the fake server
+storage = { "sys.cpu.user": [ {"tags":{"host":"web01"}, "dps":{"1000":1, "2000":2, "3000":3}},
+                              {"tags":{"host":"web02"}, "dps":{"1000":10, "2000":20, "3000":30}} ],
+            "sys.cpu.nice": [ {"tags":{"host":"web01"}, "dps":{"1000":5, "3000":7}},
+                              {"tags":{"host":"web03"}, "dps":{"1000":1}} ] }
+
+
+class TestOpenTSDBExpressionEngine(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBExpressionEngine, self).setUp()
+        if np is None:
+            self.skipTest("numpy is not available")
+        self.fakeServer()
+
+    def fakeServer(self):
+        self.calls = []
+        def my_post(url,data):
+            self.calls.append((url,json.loads(data)))
+            query = json.loads(data)
+            results = []
+            for i,q in enumerate(query["queries"]):
+                q["index"] = i
+                for s in storage[q["metric"]]:
+                    results.append({"metric":q["metric"], "tags":s["tags"], "aggregateTags":[], "query":q, "dps":s["dps"]})
+            return FakeResponse(200,json.dumps(results))
+        self.patch(requests, 'post', my_post)
+
+    def query(self, expressions, join=None, outputs=None, fillPolicy=None):
+        timeSection = OpenTSDBExpQuery.timeSection("sum", "1h-ago")
+        filters = [OpenTSDBExpQuery.filters("f1",[OpenTSDBFilter("wildcard","host","*",True)])]
+        metrics = [OpenTSDBExpQuery.metric("a","f1","sys.cpu.user"),
+                   OpenTSDBExpQuery.metric("b","f1","sys.cpu.nice",fillPolicy=fillPolicy),
+                   OpenTSDBExpQuery.metric("c","f1","sys.cpu.user")]
+        expressions = [OpenTSDBExpQuery.expression(i,e,join) for i,e in expressions]
+        return OpenTSDBExpQuery(timeSection, filters, metrics, expressions, outputs)
+
+    def test_union(self):
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        r = client.query(self.query([("e","a + b")], OpenTSDBExpQuery.join("union"), fillPolicy=OpenTSDBExpQuery.fillPolicy("zero")))
+        # one single request, with each distinct metric once
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual(templates.QUERY_TEMPL%{'host':'localhost','port':4242},self.calls[0][0])
+        self.assertEqual(2,len(self.calls[0][1]["queries"]))
+        output = r["outputs"][0]
+        self.assertEqual("e",output["id"])
+        self.assertEqual(3,output["dpsMeta"]["series"])
+        self.assertEqual([{"host":"web01"},{"host":"web02"},{"host":"web03"}],[m["commonTags"] for m in output["meta"][1:]])
+        # web01: 1+5, 2+0, 3+7 / web02: b filled with zero / web03: a missing is NaN
+        self.assertEqual([[1000,6.,10.],[2000,2.,20.],[3000,10.,30.]],[row[:3] for row in output["dps"]])
+        self.assertTrue(math.isnan(output["dps"][0][3]))
+
+    def test_intersection(self):
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        r = client.query(self.query([("e","a * b")], OpenTSDBExpQuery.join("intersection")))
+        output = r["outputs"][0]
+        self.assertEqual(1,output["dpsMeta"]["series"])
+        self.assertEqual([{"host":"web01"}],[m["commonTags"] for m in output["meta"][1:]])
+        self.assertEqual([1000,5.],output["dps"][0])
+        self.assertEqual(3000,output["dps"][2][0])
+        self.assertEqual(21.,output["dps"][2][1])
+
+    def test_nested(self):
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        outputs = [OpenTSDBExpQuery.output("e2","nested"),OpenTSDBExpQuery.output("a")]
+        r = client.query(self.query([("e1","a + c"),("e2","-(e1 % 7) / 2 + 1")], OpenTSDBExpQuery.join("intersection"), outputs))
+        self.assertEqual(["e2","a"],[o["id"] for o in r["outputs"]])
+        self.assertEqual("nested",r["outputs"][0]["alias"])
+        self.assertEqual([1000,-(2%7)/2.+1,-(20%7)/2.+1],r["outputs"][0]["dps"][0])
+        self.assertEqual([1000,1.,10.],r["outputs"][1]["dps"][0])
+
+    def test_literal(self):
+        tree = OpenTSDBExpressionEngine.parse("cpunice*2 + 0.5")
+        self.assertEqual([0.5,2],sorted(OpenTSDBExpressionEngine.literal(n) for n in ast.walk(tree) if OpenTSDBExpressionEngine.literal(n) is not None))
+        self.assertEqual(["cpunice"],OpenTSDBExpressionEngine.variables(tree))
+        self.assertRaises(ValueError,OpenTSDBExpressionEngine.parse,"a*True")
+        self.assertRaises(ValueError,OpenTSDBExpressionEngine.parse,"a*'2'")
+
+    def test_errors(self):
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        # circular dependency
+        self.assertRaises(ValueError,client.query,self.query([("e1","e2 + a"),("e2","e1 * 2")]))
+        # unknown variable
+        self.assertRaises(ValueError,client.query,self.query([("e1","z + a")]))
+        # unsupported syntax
+        self.assertRaises(ValueError,client.query,self.query([("e1","a ** 2")]))
+        self.assertRaises(ValueError,client.query,self.query([("e1","__import__('os')")]))
+
+    def test_dispatch(self):
+        # 2.3 servers evaluate the expressions, unless asked otherwise
+        def my_post(url,data):
+            self.calls.append((url,json.loads(data)))
+            return FakeResponse(200,json.dumps({"outputs":[]}))
+        self.patch(requests, 'post', my_post)
+        client = RESTOpenTSDBClient("localhost",4242,"2.3.0")
+        client.query(self.query([("e","a + b")]))
+        self.assertEqual(templates.EXPQUERY_TEMPL%{'host':'localhost','port':4242},self.calls[0][0])
+        self.fakeServer()
+        client = RESTOpenTSDBClient("localhost",4242,"2.3.0",expressions="local")
+        client.query(self.query([("e","a + b")]))
+        self.assertEqual(templates.QUERY_TEMPL%{'host':'localhost','port':4242},self.calls[0][0])
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0",expressions="server")
+        self.assertRaises(RuntimeError,client.query,self.query([("e","a + b")]))
+        self.assertRaises(ValueError,RESTOpenTSDBClient,"localhost",4242,"2.2.0",expressions="remote")
+
+    def test_subquery(self):
+        fp = OpenTSDBExpQuery.fillPolicy("nan")
+        time = OpenTSDBExpQuery.timeSection("sum","1h-ago",downsampler=OpenTSDBExpQuery.downsampler("1m","avg",fp),rate=True)
+        metric = OpenTSDBExpQuery.metric("a","f1","sys.cpu.user","max")
+        q = OpenTSDBExpressionEngine.subquery(metric,[OpenTSDBFilter("wildcard","host","*",True).getMap()],time)
+        self.assertEqual({"aggregator":"max","metric":"sys.cpu.user","rate":True,"rateOptions":{"counter":True},"downsample":"1m-avg-nan",
+                          "filters":[{"type":"wildcard","tagk":"host","filter":"*","groupBy":True}]},q.getMap())
@@ -0,0 +1,113 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBFilter
+from opentsdbfanout import OpenTSDBFanOut
+import json
+import requests
+import threading
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# 6 hosts in 2 data centers, all series aligned
+storage = [ {"tags":{"host":"web%02d"%i,"dc":"lga" if i<3 else "sjc"}, "dps":{"60":i, "120":10*i}} for i in range(6) ]
+
+def fake_server(calls, lock):
+    """evaluates literal_or and wildcard filters, group by and the none, sum, min and max aggregators"""
+    def my_post(url,data):
+        query = json.loads(data)
+        with lock:
+            calls.append((url,query))
+        results = []
+        for q in query["queries"]:
+            filters = [OpenTSDBFilter(f["type"],f["tagk"],f["filter"],f["groupBy"]) for f in q.get("filters",[])]
+            selected = [s for s in storage if all(f.match(s["tags"]) for f in filters)]
+            groups = {}
+            for s in selected:
+                key = tuple(s["tags"].get(f.tagKey) for f in filters if f.groupBy) if q["aggregator"]!="none" else s["tags"]["host"]
+                groups.setdefault(key,[]).append(s)
+            for key,members in sorted(groups.items()):
+                function = {"none":sum, "sum":sum, "min":min, "max":max}[q["aggregator"]]
+                dps = { t:function(m["dps"][t] for m in members) for t in members[0]["dps"] }
+                tags = { k:v for k,v in members[0]["tags"].items() if all(m["tags"][k]==v for m in members) }
+                aggregateTags = sorted(k for k in members[0]["tags"] if k not in tags)
+                results.append({"metric":q["metric"],"tags":tags,"aggregateTags":aggregateTags,"dps":dps})
+        return FakeResponse(200,json.dumps(results))
+    return my_post
+
+
+class TestOpenTSDBFanOut(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBFanOut, self).setUp()
+        self.calls = []
+        self.patch(requests, 'post', fake_server(self.calls, threading.Lock()))
+        self.clients = [RESTOpenTSDBClient("tsd1",4242,"2.2.0"), RESTOpenTSDBClient("tsd2",4242,"2.2.0")]
+        self.hosts = ["web%02d"%i for i in range(6)]
+
+    def test_partition(self):
+        fanout = OpenTSDBFanOut(self.clients, "host", shards=4)
+        self.assertEqual([["a","e"],["b"],["c"],["d"]],fanout.partition(["a","b","c","d","e"]))
+        self.assertEqual([["a"],["b"]],fanout.partition(["a","b"]))
+        subquery = OpenTSDBMetricSubQuery("sum","m",filters=[OpenTSDBFilter("literal_or","host","b|a|b")])
+        self.assertEqual(["a","b"],fanout.tagValues(subquery))
+        self.assertRaises(ValueError,OpenTSDBFanOut,self.clients,"host",shards=0)
+
+    def test_combine(self):
+        if np is None:
+            self.skipTest("numpy is not available")
+        fanout = OpenTSDBFanOut(self.clients, "host", shards=3, values=self.hosts)
+        for aggregator,expected in [("sum",{"60":15.,"120":150.}),("max",{"60":5.,"120":50.}),("min",{"60":0.,"120":0.})]:
+            r = fanout.query(OpenTSDBQuery([OpenTSDBMetricSubQuery(aggregator,"sys.cpu.user")],"1h-ago"))
+            self.assertEqual(1,len(r))
+            self.assertEqual(expected,r[0]["dps"])
+            self.assertEqual({},r[0]["tags"])
+            self.assertEqual(["dc","host"],r[0]["aggregateTags"])
+        self.assertEqual(9,len(self.calls))
+        # shards are spread on both TSDs, each with a part of the hosts
+        self.assertEqual(set(["tsd1","tsd2"]),set(url.split("/")[2].split(":")[0] for url,q in self.calls))
+        self.assertEqual("web00|web03",self.calls[0][1]["queries"][0]["filters"][0]["filter"])
+
+    def test_groupBy(self):
+        if np is None:
+            self.skipTest("numpy is not available")
+        fanout = OpenTSDBFanOut(self.clients, "host", shards=2, values=self.hosts)
+        # grouped by dc: partial sums are recombined per dc
+        r = fanout.query(OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("wildcard","dc","*",True)])],"1h-ago"))
+        self.assertEqual([{"dc":"lga"},{"dc":"sjc"}],[s["tags"] for s in r])
+        self.assertEqual({"60":3.,"120":30.},r[0]["dps"])
+        self.assertEqual({"60":12.,"120":120.},r[1]["dps"])
+        # grouped by host: concatenation
+        r = fanout.query(OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("wildcard","host","*",True)])],"1h-ago"))
+        self.assertEqual(6,len(r))
+        self.assertEqual(sorted(self.hosts),sorted(s["tags"]["host"] for s in r))
+
+    def test_raw(self):
+        if np is None:
+            self.skipTest("numpy is not available")
+        fanout = OpenTSDBFanOut(self.clients, "host", shards=2, values=self.hosts)
+        r = fanout.query(OpenTSDBQuery([OpenTSDBMetricSubQuery("avg","sys.cpu.user",filters=[OpenTSDBFilter("wildcard","dc","*",True)])],"1h-ago"))
+        for url,q in self.calls:
+            self.assertEqual("none",q["queries"][0]["aggregator"])
+        self.assertEqual({"60":1.,"120":10.},r[0]["dps"])
+        self.assertEqual({"60":4.,"120":40.},r[1]["dps"])
+        self.assertEqual(["host"],r[0]["aggregateTags"])
@@ -0,0 +1,85 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBMetricSubQuery, OpenTSDBFilter, parseDuration
+from opentsdblod import OpenTSDBLODCache
+import json
+import requests
+
+
+hour = 3600000
+T0 = 1356998400000
+
+
+class TestOpenTSDBLODCache(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBLODCache, self).setUp()
+        self.calls = []
+        def my_post(url,data):
+            # one series, the value of each bucket is its timestamp in seconds
+            query = json.loads(data)
+            q = query["queries"][0]
+            self.calls.append((query["start"],query["end"],q["downsample"]))
+            interval = parseDuration(q["downsample"].split("-")[0])
+            dps = { str(t):t//1000 for t in range(query["start"],query["end"]+1,interval) }
+            return FakeResponse(200,json.dumps([{"metric":q["metric"],"tags":{"host":"web01"},"aggregateTags":[],"dps":dps}]))
+        self.patch(requests, 'post', my_post)
+        self.client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        self.subquery = OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("literal_or","host","web01")])
+
+    def test_zoom(self):
+        cache = OpenTSDBLODCache(self.client)
+        now = T0 + 24*hour
+        r = cache.query(self.subquery, T0, T0+6*hour-1, points=400, now=now)
+        self.assertEqual([(T0,T0+6*hour-1,"1m-avg")],self.calls)
+        self.assertEqual(360,len(r[0]["dps"]))
+        self.assertEqual({"host":"web01"},r[0]["tags"])
+        cache.query(self.subquery, T0, T0+6*hour-1, points=400, now=now)
+        self.assertEqual(1,len(self.calls))
+        # zoom out: derived from the 1m level
+        r = cache.query(self.subquery, T0, T0+6*hour-1, points=30, now=now)
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual(6,len(r[0]["dps"]))
+        self.assertEqual(T0//1000+1770,r[0]["dps"][str(T0//1000)])
+        # zoom in: only the visible range is fetched at 10s
+        r = cache.query(self.subquery, T0+hour, T0+hour+10*60000-1, points=100, msResolution=True, now=now)
+        self.assertEqual((T0+hour,T0+hour+10*60000-1,"10s-avg"),self.calls[-1])
+        self.assertEqual(60,len(r[0]["dps"]))
+        self.assertTrue(str(T0+hour) in r[0]["dps"])
+        # pan: only the missing part is fetched
+        cache.query(self.subquery, T0+5*hour, T0+8*hour-1, points=400, now=now)
+        self.assertEqual((T0+6*hour,T0+8*hour-1,"1m-avg"),self.calls[-1])
+        self.assertEqual(3,len(self.calls))
+        # percentiles cannot be derived from finer levels
+        cache.query(self.subquery, T0, T0+6*hour-1, points=30, aggregator="p99", now=now)
+        self.assertEqual((T0,T0+6*hour-1,"1h-p99"),self.calls[-1])
+
+    def test_recent(self):
+        cache = OpenTSDBLODCache(self.client, levels=["1m"])
+        now = T0 + hour + 30000
+        cache.query(self.subquery, T0, None, points=1000, now=now)
+        cache.query(self.subquery, T0, None, points=1000, now=now)
+        # the current bucket is fetched again, nothing else
+        self.assertEqual((T0+hour,T0+hour+60000-1,"1m-avg"),self.calls[-1])
+        self.assertEqual(2,len(self.calls))
+        cache.clear()
+        cache.query(self.subquery, T0, None, points=1000, now=now)
+        self.assertEqual(T0,self.calls[-1][0])
+        self.assertRaises(ValueError,OpenTSDBLODCache,self.client,levels=[])
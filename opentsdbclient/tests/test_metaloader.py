@@ -0,0 +1,93 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbobjects import OpenTSDBTimeSeries
+from opentsdberrors import OpenTSDBError
+from opentsdbmetaloader import OpenTSDBMetaLoader
+import json
+import requests
+import threading
+
+
+def tsmeta(i, created=0):
+    uid = lambda t,n: {"uid":"%06X"%n, "type":t, "name":{"TAGK":"host","TAGV":"web%02d"%i}.get(t,"sys.cpu.user"),
+                       "description":"", "notes":"", "created":0, "custom":None, "displayName":""}
+    return { "tsuid":"000001000001%06X"%(i+1), "metric":uid("METRIC",1), "tags":[uid("TAGK",1),uid("TAGV",i+1)],
+             "description":"series %d"%i, "notes":"", "created":created, "units":"", "retention":0, "max":"NaN", "min":"NaN",
+             "custom":None, "displayName":"", "dataType":"", "lastReceived":0, "totalDatapoints":0 }
+
+
+class TestOpenTSDBMetaLoader(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBMetaLoader, self).setUp()
+        self.calls = []
+        lock = threading.Lock()
+        # 100 series, the last 10 without TSMeta
+        def my_get(url,params):
+            with lock:
+                self.calls.append(("get",params))
+            if "tsuid" in params:
+                i = int(params["tsuid"][12:],16)-1
+                return FakeResponse(200,json.dumps(tsmeta(i))) if i<90 else FakeResponse(404,json.dumps({"error":{"code":404,"message":"Could not find Timeseries meta data"}}))
+            i = int(params["m"].split("web")[1][:2])
+            return FakeResponse(200,json.dumps([tsmeta(i)] if i<90 else []))
+        def my_post(url,data,params=None):
+            with lock:
+                self.calls.append(("post",params or json.loads(data)))
+            if params is not None:
+                i = int(params["m"].split("web")[1][:2])
+                return FakeResponse(200,json.dumps(tsmeta(i,created=1)))
+            query = json.loads(data)
+            results = [tsmeta(i) for i in range(40)][query["startindex"]:query["startindex"]+query["limit"]]
+            return FakeResponse(200,json.dumps({"type":"TSMETA","totalResults":40,"results":results}))
+        self.patch(requests, 'get', my_get)
+        self.patch(requests, 'post', my_post)
+        self.client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+
+    def test_tsuids(self):
+        loader = OpenTSDBMetaLoader(self.client, workers=4)
+        series = loader.load(["000001000001%06X"%(i+1) for i in range(80)])
+        self.assertEqual(80,len(self.calls))
+        self.assertEqual(80,len(series))
+        for i,ts in enumerate(series):
+            self.assertEqual("sys.cpu.user",ts.metric)
+            self.assertEqual({"host":"web%02d"%i},ts.tags)
+            self.assertEqual("series %d"%i,ts.metadata.description)
+            self.assertEqual("%06X"%(i+1),ts.tagv_meta["web%02d"%i].uid)
+        # without a metric, a missing TSMeta cannot be created
+        self.assertRaises(OpenTSDBError,loader.load,["000001000001%06X"%95])
+
+    def test_search(self):
+        loader = OpenTSDBMetaLoader(self.client, workers=4, pageSize=15)
+        series = loader.load([OpenTSDBTimeSeries("sys.cpu.user",{"host":"web%02d"%i}) for i in range(100)], query="sys.cpu.user")
+        searches = [c for c in self.calls if c[0]=="post" and "startindex" in c[1]]
+        # pages grow while the TSD answers quickly
+        self.assertEqual([(0,15),(15,30)],[(c[1]["startindex"],c[1]["limit"]) for c in searches])
+        # series found by the search are not fetched again, the others are
+        self.assertEqual(60,len([c for c in self.calls if c[0]=="get"]))
+        self.assertEqual(10,len([c for c in self.calls if c[0]=="post" and "create" in c[1]]))
+        self.assertEqual(["series %d"%i for i in range(100)],[ts.metadata.description for ts in series])
+        self.assertEqual(1,series[95].metadata.created)
+        self.assertEqual("000001000001%06X"%43,series[42].metadata.tsuid)
+
+    def test_create(self):
+        loader = OpenTSDBMetaLoader(self.client, create=False)
+        self.assertRaises(ValueError,loader.load,[OpenTSDBTimeSeries("sys.cpu.user",{"host":"web95"})])
+        self.assertEqual({"host":"web07"},OpenTSDBTimeSeries.metaTags(tsmeta(7)))
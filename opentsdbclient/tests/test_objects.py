@@ -102,6 +102,39 @@ class TestOpenTSDBAnnotation(TestCase):
         a = OpenTSDBAnnotation(1369141261,1369141262,"000001000001000001","Network Outage","Switch #5 died and was replaced",{"owner": "jdoe","dept": "ops"})
         a.delete(client)
 
+    def test_bulk(self):
+        """test the bulk endpoint"""
+
+        calls = []
+        def my_post(url,data):
+            calls.append((url,json.loads(data)))
+            return FakeResponse(200,data)
+        def my_delete(url,data):
+            calls.append((url,json.loads(data)))
+            return FakeResponse(200,json.dumps(dict(json.loads(data),totalDeleted=len(json.loads(data)["tsuids"])+1)))
+        self.patch(requests, 'post', my_post)
+        self.patch(requests, 'delete', my_delete)
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        annotations = [OpenTSDBAnnotation(1369141261+i,tsuid="%018X"%i,description="deploy %d"%i) for i in range(250)]
+        saved = client.set_annotations(annotations)
+        self.assertEqual([a.getMap() for a in annotations],[a.getMap() for a in saved])
+        self.assertEqual([100,100,50],[len(c[1]) for c in calls])
+        self.assertTrue(all(c[0].endswith("/api/annotation/bulk") for c in calls))
+        self.assertRaises(ValueError,client.set_annotations,[a.getMap() for a in annotations])
+
+        calls[:] = []
+        tsuids = ["%018X"%i for i in range(25)]
+        response = client.delete_annotations(1369141261, 1369141661, tsuids, considerGlobal=True, chunkSize=10)
+        self.assertEqual(3,len(calls))
+        self.assertEqual([True,False,False],[c[1]["global"] for c in calls])
+        self.assertEqual(tsuids[10:20],calls[1][1]["tsuids"])
+        self.assertEqual(28,response["totalDeleted"])
+        self.assertEqual(tsuids,response["tsuids"])
+        # global notes only
+        client.delete_annotations(1369141261, considerGlobal=True)
+        self.assertEqual({"startTime":1369141261, "tsuids":[], "global":True},calls[-1][1])
+        self.assertRaises(ValueError,client.delete_annotations,1369141261,tsuid=["nothex"])
+
 
 class TestOpenTSDBTimeSeries(TestCase):
 
@@ -384,6 +417,63 @@ class TestOpenTSDBTimeSeries(TestCase):
         ts.deleteMeta(client,True)
 
 
+class TestOpenTSDBMeta(TestCase):
+
+    def test_dirty(self):
+        meta = OpenTSDBTSMeta().loaded(tsuid="000001000001000001", description="cpu", custom={"owner":"jdoe"}, created=1350425579)
+        self.assertFalse(meta.dirty())
+        self.assertEqual(None,meta.getMap().get("_saved"))
+        meta.units = "%"
+        meta.custom["dept"] = "ops"
+        self.assertEqual({"units":"%", "custom":{"owner":"jdoe","dept":"ops"}},meta.changes())
+        meta.units = ""
+        self.assertEqual(["custom"],list(meta.changes()))
+        # new objects: every field set is a change
+        self.assertEqual({"description":"cpu"},OpenTSDBTSMeta(tsuid="000001000001000001", description="cpu").changes())
+        uidmeta = OpenTSDBUIDMeta(type="TAGK", name="host")
+        self.assertFalse(uidmeta.dirty())
+        uidmeta.set(displayName="Host")
+        self.assertEqual({"displayName":"Host"},uidmeta.changes())
+        self.assertFalse(uidmeta.loaded(uid="000001").dirty())
+
+    def test_saveAll(self):
+        calls = []
+        def my_post(url,data,params=None):
+            calls.append((url,json.loads(data)))
+            record = json.loads(data)
+            record["created"] = 1350425579
+            return FakeResponse(200,json.dumps(record))
+        self.patch(requests, 'post', my_post)
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        series = []
+        for i in range(10):
+            ts = OpenTSDBTimeSeries("sys.cpu.nice",{"host":"web%02d"%i, "dc":"lga"},"00000100000100000%d"%i)
+            ts.metric_meta.loaded(uid="000001")
+            ts.tagk_meta["host"].loaded(uid="000001")
+            ts.tagk_meta["dc"].loaded(uid="000002")
+            ts.tagv_meta["web%02d"%i].loaded(uid="%06X"%(i+10))
+            ts.tagv_meta["lga"].loaded(uid="000003")
+            series.append(ts)
+        # nothing changed: nothing sent
+        OpenTSDBTimeSeries.saveAll(client, series)
+        series[0].saveTo(client)
+        self.assertEqual(0,len(calls))
+        # only the changed fields of the changed objects, the shared tag value once
+        series[3].metadata.description = "web03 cpu"
+        for ts in series:
+            ts.tagv_meta["lga"].displayName = "LaGuardia"
+        OpenTSDBTimeSeries.saveAll(client, series, workers=4)
+        self.assertEqual(2,len(calls))
+        self.assertIn(({"tsuid":"000001000001000003", "description":"web03 cpu"}),[c[1] for c in calls])
+        self.assertIn(({"uid":"000003", "type":"TAGV", "displayName":"LaGuardia"}),[c[1] for c in calls])
+        self.assertEqual(1350425579,series[3].metadata.created)
+        self.assertEqual(1350425579,series[7].tagv_meta["lga"].created)
+        self.assertFalse(any(meta.dirty() for ts in series for meta in ts.metaObjects()))
+        # force sends everything
+        series[0].saveTo(client, force=True)
+        self.assertEqual(8,len(calls))
+
+
 class TestOpenTSDBMeasurement(TestCase):
 
     def test_check(self):
@@ -587,7 +677,69 @@ class TestOpenTSDBTreeDefinition(TestCase):
         self.assertEqual({},td.rules)
 
 
-#do nothing here for the following two classes that are 100% interacting with the db.
-#class OpenTSDBTreeBranch:
-#class OpenTSDBTree(OpenTSDBTreeBranch):
+class TestOpenTSDBTreeBranch(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBTreeBranch, self).setUp()
+        # a tree of depth 3: the root has 3 branches, each with 2 branches holding one leaf each
+        self.tree = {}
+        def branch(branchId, depth, children, leaves):
+            self.tree[branchId] = { "treeId":1, "branchId":branchId, "path":{str(i):branchId[:4+2*i] for i in range(depth+1)},
+                                    "displayName":"b"+branchId, "depth":depth, "leaves":leaves or None,
+                                    "branches":[{ "treeId":1, "branchId":c, "displayName":"b"+c, "depth":depth+1,
+                                                  "leaves":None, "branches":None, "numLeaves":1 } for c in children] or None }
+        branch("0001", 0, ["000101","000102","000103"], [])
+        for i in range(1,4):
+            branch("00010%d"%i, 1, ["00010%d0%d"%(i,j) for j in range(1,3)], [])
+            for j in range(1,3):
+                branch("00010%d0%d"%(i,j), 2, [], [{"metric":"sys.cpu.user", "tags":{"host":"web%d%d"%(i,j)},
+                                                    "tsuid":"000001000001%06d"%(10*i+j), "displayName":"web%d%d"%(i,j)}])
+        self.calls = []
+        def my_get(url,data):
+            query = json.loads(data)
+            self.calls.append(query)
+            branchId = query.get("branch") or "%04X"%query["treeId"]
+            return FakeResponse(200,json.dumps(self.tree[branchId]))
+        self.patch(requests, 'get', my_get)
+        self.client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+
+    def test_load(self):
+        tree = OpenTSDBTree(1, self.client)
+        self.assertEqual(10,len(self.calls))
+        self.assertEqual({"treeId":1},self.calls[0])
+        # breadth first: the three branches of the first level come before the second level
+        self.assertEqual(["000101","000102","000103"],sorted(c["branch"] for c in self.calls[1:4]))
+        self.assertEqual(["0001","000101","000102","000103"],[b.branchId for b in tree.walk()][:4])
+        leaf = tree.branches[1].branches[0]
+        self.assertEqual(2,leaf.depth)
+        self.assertEqual(1,leaf.numLeaves())
+        ts,name = leaf.leaves[0]
+        self.assertEqual("web21",name)
+        self.assertEqual({"host":"web21"},ts.tags)
+        self.assertEqual("000001000001000021",ts.metadata.tsuid)
+        self.assertEqual([],tree.leaves)
+        # non recursive: the sub branches are listed only
+        branch = OpenTSDBTreeBranch(branchId="000102", client=self.client)
+        self.assertEqual(["00010201","00010202"],[b.branchId for b in branch.branches])
+        self.assertEqual(None,branch.branches[0].branches)
+        self.assertRaises(ValueError,OpenTSDBTreeBranch,client=self.client)
+
+    def test_loader(self):
+        loader = OpenTSDBTreeLoader(self.client, workers=2, ttl=60)
+        root = loader.load(treeId=1, depth=1)
+        self.assertEqual(4,len(self.calls))
+        self.assertEqual(None,root.branches[0].branches[0].branches)
+        # cached branches are not fetched again
+        branch = loader.load(branchId="000101", depth=1)
+        self.assertEqual(6,len(self.calls))
+        self.assertEqual(["00010101","00010102"],[b.branchId for b in branch.branches])
+        loader.load(treeId=1)
+        self.assertEqual(10,len(self.calls))
+        loader.invalidate("000101")
+        loader.load(treeId=1, depth=1)
+        self.assertEqual(11,len(self.calls))
+        loader.ttl = 0
+        time.sleep(0.01)
+        loader.load(treeId=1, depth=0)
+        self.assertEqual(12,len(self.calls))
 
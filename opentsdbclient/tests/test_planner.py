@@ -0,0 +1,98 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBtsuidSubQuery, OpenTSDBFilter
+from opentsdbplanner import OpenTSDBLookupCache, OpenTSDBQueryPlanner
+import json
+import requests
+
+
+class TestOpenTSDBQueryPlanner(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBQueryPlanner, self).setUp()
+        self.lookups = []
+        self.queries = []
+        def my_get(url,params):
+            self.lookups.append(params["m"])
+            results = [{"tsuid":"000001000001000001","metric":"sys.cpu.user","tags":{"host":"web01"}},
+                       {"tsuid":"000001000001000001000002000002","metric":"sys.cpu.user","tags":{"host":"web01","cpu":"1"}}]
+            return FakeResponse(200,json.dumps({"type":"LOOKUP","results":results,"totalResults":len(results)}))
+        def my_post(url,data):
+            self.queries.append(json.loads(data))
+            return FakeResponse(200,json.dumps([]))
+        self.patch(requests, 'get', my_get)
+        self.patch(requests, 'post', my_post)
+        self.client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+
+    def test_eligible(self):
+        web01 = OpenTSDBFilter("literal_or","host","web01")
+        self.assertEqual(("sys.cpu.user",{"host":"web01"}),OpenTSDBQueryPlanner.eligible(OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[web01])))
+        notEligible = [ OpenTSDBMetricSubQuery("sum","sys.cpu.user"),
+                        OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[web01],explicitTags=True),
+                        OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("literal_or","host","web01|web02")]),
+                        OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("wildcard","host","web*")]),
+                        OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[web01,OpenTSDBFilter("literal_or","host","web02")]),
+                        OpenTSDBtsuidSubQuery("sum",["000001000001000001"]) ]
+        for q in notEligible:
+            self.assertEqual(None,OpenTSDBQueryPlanner.eligible(q))
+
+    def test_rewrite(self):
+        cache = OpenTSDBLookupCache(self.client)
+        planner = OpenTSDBQueryPlanner(cache)
+        subquery = OpenTSDBMetricSubQuery("sum","sys.cpu.user",rate=True,downsample="1m-avg",filters=[OpenTSDBFilter("literal_or","host","web01")])
+        query = OpenTSDBQuery([subquery,OpenTSDBMetricSubQuery("sum","sys.mem.free")],"1h-ago")
+        # cache miss: unchanged
+        self.assertTrue(planner.plan(query) is query)
+        self.assertEqual(0,len(self.lookups))
+        self.assertEqual(["000001000001000001","000001000001000001000002000002"],cache.lookup("sys.cpu.user",{"host":"web01"}))
+        self.assertEqual(["sys.cpu.user{host=web01}"],self.lookups)
+        planned = planner.plan(query)
+        self.assertTrue(planned is not query)
+        self.assertTrue(query.subqueries[0] is subquery)
+        self.assertEqual({"aggregator":"sum","tsuids":["000001000001000001","000001000001000001000002000002"],
+                          "rate":True,"rateOptions":{"counter":True},"downsample":"1m-avg"},planned.subqueries[0].getMap())
+        self.assertTrue(planned.subqueries[1] is query.subqueries[1])
+        cache.invalidate("sys.cpu.user")
+        self.assertEqual(0,len(cache))
+        self.assertTrue(planner.plan(query) is query)
+
+    def test_client(self):
+        planner = OpenTSDBQueryPlanner(OpenTSDBLookupCache(self.client,ttl=None),lookupOnMiss=True)
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0",planner=planner)
+        query = OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("literal_or","host","web01")])],"1h-ago")
+        client.query(query)
+        client.query(query)
+        self.assertEqual(1,len(self.lookups))
+        self.assertEqual(2,len(self.queries))
+        self.assertEqual(["000001000001000001","000001000001000001000002000002"],self.queries[1]["queries"][0]["tsuids"])
+        self.assertFalse("metric" in self.queries[1]["queries"][0])
+        # prepared queries are planned as well
+        client.query(query.prepare().bind("2h-ago"))
+        self.assertEqual(3,len(self.queries))
+        self.assertEqual("2h-ago",self.queries[2]["start"])
+        self.assertEqual(self.queries[1]["queries"],self.queries[2]["queries"])
+
+    def test_incomplete(self):
+        def my_get(url,params):
+            return FakeResponse(200,json.dumps({"type":"LOOKUP","results":[{"tsuid":"000001000001000001"}],"totalResults":30}))
+        self.patch(requests, 'get', my_get)
+        cache = OpenTSDBLookupCache(self.client)
+        self.assertEqual(None,cache.lookup("sys.cpu.user",{"host":"web01"}))
+        self.assertEqual(None,cache.get("sys.cpu.user",{"host":"web01"}))
@@ -15,7 +15,8 @@
 
 
 from testtools import TestCase
-from opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBtsuidSubQuery, OpenTSDBFilter, OpenTSDBExpQuery, OpenTSDBQueryLast
+from opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBtsuidSubQuery, OpenTSDBFilter, OpenTSDBExpQuery, OpenTSDBQueryLast, parseDuration, resolveTime, formatDuration, niceInterval
+import json
 
 class TestOpenTSDBtsuidSubQuery(TestCase):
     """test the OpenTSDBtsuidSubQuery standalone"""
@@ -79,7 +80,7 @@ class TestOpenTSDBMetricSubQuery(TestCase):
         # this is a query with everything
         filters = [OpenTSDBFilter("wildcard","host","*",True),OpenTSDBFilter("literal_or","dc","lga|lga1|lga2")]
         q = OpenTSDBMetricSubQuery("sum", "sys.cpu.0", rate=True, filters=filters, counterMax=100, resetValue=1000, downsample="30m-avg-nan")
-        expected = {'aggregator': 'sum', 'metric': 'sys.cpu.0', 'rate': True, #'explicitTags': False,
+        expected = {'aggregator': 'sum', 'metric': 'sys.cpu.0', 'rate': True, 'downsample': '30m-avg-nan', #'explicitTags': False,
                     'filters': [{'filter': '*', 'type': 'wildcard', 'groupBy': True, 'tagk': 'host', "groupBy":True}, 
                                 {'filter': 'lga|lga1|lga2', 'type': 'literal_or', 'groupBy': False, 'tagk': 'dc'}], 
                     'rateOptions': {'counter': True, 'counterMax': 100, 'resetValue': 1000}}
@@ -90,7 +91,7 @@ class TestOpenTSDBMetricSubQuery(TestCase):
 
         filters = [OpenTSDBFilter("wildcard","host","*",True),OpenTSDBFilter("literal_or","dc","lga|lga1|lga2")]
         q = OpenTSDBMetricSubQuery("sum", "sys.cpu.0", rate=False, filters=filters, counterMax=100, resetValue=1000, downsample="30m-avg-nan")
-        expected = {'aggregator': 'sum', 'metric': 'sys.cpu.0', #'explicitTags': False, 
+        expected = {'aggregator': 'sum', 'metric': 'sys.cpu.0', 'downsample': '30m-avg-nan', #'explicitTags': False, 
                     'filters': [{'filter': '*', 'type': 'wildcard', 'groupBy': True, 'tagk': 'host', "groupBy":True}, 
                                 {'filter': 'lga|lga1|lga2', 'type': 'literal_or', 'groupBy': False, 'tagk': 'dc'}]}
         
@@ -104,6 +105,57 @@ class TestOpenTSDBMetricSubQuery(TestCase):
 
         self.assertEqual(expected,q.getMap())
 
+class TestOpenTSDBFilter(TestCase):
+    """test the client side evaluation of filters"""
+
+    def test_match(self):
+        tags = {"host":"Web01","dc":"lga"}
+        cases = [("literal_or","host","Web01|web02",True), ("literal_or","host","web01",False),
+                 ("iliteral_or","host","web01",True), ("not_literal_or","host","Web01",False),
+                 ("not_iliteral_or","host","web02",True), ("wildcard","host","W*1",True),
+                 ("wildcard","host","w*",False), ("iwildcard","host","w*",True),
+                 ("regexp","host","^Web\\d+$",True), ("literal_or","rack","r1",False)]
+        for filterType,tagk,expression,expected in cases:
+            self.assertEqual(expected,OpenTSDBFilter(filterType,tagk,expression).match(tags),filterType+expression)
+        self.assertRaises(ValueError,OpenTSDBFilter("custom","host","x").match,tags)
+
+
+class TestTime(TestCase):
+    """test the time helpers"""
+
+    def test_parseDuration(self):
+        self.assertEqual(500,parseDuration("500ms"))
+        self.assertEqual(90000,parseDuration("90s"))
+        self.assertEqual(7200000,parseDuration("2h"))
+        self.assertEqual(30*86400000,parseDuration("1n"))
+        self.assertRaises(ValueError,parseDuration,"1x")
+        self.assertRaises(ValueError,parseDuration,60)
+
+    def test_formatDuration(self):
+        self.assertEqual("90s",formatDuration(90000))
+        self.assertEqual("2h",formatDuration(7200000))
+        self.assertEqual("1500ms",formatDuration(1500))
+        self.assertEqual("7d",formatDuration(604800000))
+        self.assertRaises(ValueError,formatDuration,0)
+
+    def test_niceInterval(self):
+        self.assertEqual(1000,niceInterval(10))
+        self.assertEqual(60000,niceInterval(45000))
+        self.assertEqual(300000,niceInterval(120001))
+        self.assertEqual(3600000,niceInterval(3600000))
+        self.assertEqual(40*86400000,niceInterval(39.5*86400000))
+
+    def test_resolveTime(self):
+        self.assertEqual(1356998400000,resolveTime(1356998400))
+        self.assertEqual(1356998400123,resolveTime(1356998400123))
+        self.assertEqual(1356998400000,resolveTime("1356998400"))
+        self.assertEqual(1000000-3600000,resolveTime("1h-ago",1000000))
+        self.assertEqual(resolveTime("2016/01/01-12:00:00"),resolveTime("2016/01/01 12:00"))
+        self.assertEqual(resolveTime("2016/01/01-00:00:00"),resolveTime("2016/01/01"))
+        self.assertRaises(ValueError,resolveTime,"yesterday")
+        self.assertRaises(TypeError,resolveTime,[])
+
+
 class TestOpenTSDBQuery(TestCase):
     """test the OpenTSDBQuery class standalone"""
 
@@ -140,6 +192,61 @@ class TestOpenTSDBQuery(TestCase):
         self.assertEqual(expected,q.getMap())
 
 
+    def test_fit(self):
+        now = 1356998400000
+        subqueries = [OpenTSDBMetricSubQuery("sum","sys.cpu.user"),
+                      OpenTSDBMetricSubQuery("sum","sys.cpu.nice",downsample="1m-max-nan"),
+                      OpenTSDBMetricSubQuery("sum","sys.cpu.idle",downsample="1h-max"),
+                      OpenTSDBtsuidSubQuery("sum",["000001000002000042"])]
+        q = OpenTSDBQuery(subqueries,"1d-ago")
+        # 86400s on 800 pixels: 108s per point, snapped to 2m
+        fitted = q.fit(800, now=now)
+        self.assertEqual(["2m-avg","2m-max-nan","1h-max","2m-avg"],[s.downsample for s in fitted.subqueries])
+        self.assertEqual(None,q.subqueries[0].downsample)
+        self.assertEqual("1m-max-nan",q.subqueries[1].downsample)
+        self.assertEqual("2m-sum-zero",q.fit(800, "sum", "zero", now=now).subqueries[0].downsample)
+        unchanged = q.fit(86400, now=now)
+        self.assertFalse(unchanged is q)
+        self.assertEqual(q.getMap(),unchanged.getMap())
+        unchanged.subqueries[0].downsample = "1m-avg"
+        self.assertEqual(None,q.subqueries[0].downsample)
+        self.assertEqual("1d-avg",OpenTSDBQuery(subqueries[:1],now//1000-86400*365,now//1000).fit(365, now=now).subqueries[0].downsample)
+        self.assertRaises(ValueError,q.fit,0)
+
+
+class TestOpenTSDBPreparedQuery(TestCase):
+    """test the OpenTSDBPreparedQuery class standalone"""
+
+    def test_check(self):
+        mq = OpenTSDBMetricSubQuery("sum","sys.cpu.0",rate=True,filters=[OpenTSDBFilter("wildcard","host","*"),OpenTSDBFilter("literal_or","dc","lga")])
+        q = OpenTSDBQuery([mq],start=1356998400)
+        p = q.prepare()
+        p.check()
+        p.bind("1h-ago")
+        p.bind(1356998400,1356998460)
+        self.assertRaises(TypeError,p.bind,[])
+        self.assertRaises(TypeError,p.bind,1356998400,[])
+        # invalid queries cannot be prepared
+        q = OpenTSDBQuery([],self.getUniqueInteger())
+        self.assertRaises(ValueError,q.prepare)
+
+    def test_json(self):
+        mq = OpenTSDBMetricSubQuery("sum","sys.cpu.0",rate=True,filters=[OpenTSDBFilter("wildcard","host","*"),OpenTSDBFilter("literal_or","dc","lga")])
+        tq = OpenTSDBtsuidSubQuery("sum",["000001000002000042","000001000002000043"])
+        q = OpenTSDBQuery([mq,tq],start=1356998400,end=1356998460,showQuery=True)
+        p = q.prepare()
+        self.assertEqual(json.dumps(q.getMap(),sort_keys=True),p.json())
+        self.assertEqual(q.getMap(),p.getMap())
+        # bind only changes the time range
+        b = p.bind("1h-ago")
+        q.start = "1h-ago"
+        q.end = None
+        self.assertEqual(json.dumps(q.getMap(),sort_keys=True),b.json())
+        # the prepared query is not affected by later changes of the original query
+        q.showQuery = False
+        self.assertEqual(True,p.getMap()["showQuery"])
+
+
 class TestOpenTSDBExpQuery(TestCase):
 
     def test_check(self):
@@ -0,0 +1,131 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery, OpenTSDBFilter, OpenTSDBQueryLast
+from opentsdbobjects import OpenTSDBMeasurement, OpenTSDBTimeSeries
+from opentsdbrecent import OpenTSDBRecentWrites
+import json
+import requests
+import time
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class TestOpenTSDBRecentWrites(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBRecentWrites, self).setUp()
+        self.now = int(time.time())
+        self.calls = []
+        self.answer = []
+        def my_post(url,data):
+            self.calls.append(url)
+            if "/api/put" in url:
+                return FakeResponse(204,"")
+            return FakeResponse(200,json.dumps(self.answer))
+        self.patch(requests, 'post', my_post)
+        self.buffer = OpenTSDBRecentWrites()
+        self.client = RESTOpenTSDBClient("localhost",4242,"2.2.0",recentWrites=self.buffer)
+        web01 = OpenTSDBTimeSeries("sys.cpu.user",{"host":"web01"})
+        web02 = OpenTSDBTimeSeries("sys.cpu.user",{"host":"web02"})
+        self.client.put_measurements([OpenTSDBMeasurement(web01,self.now-10,1),OpenTSDBMeasurement(web01,self.now-5,2),
+                                      OpenTSDBMeasurement(web02,self.now-5,3)])
+
+    def test_query(self):
+        self.assertEqual(3,len(self.buffer))
+        # the TSD only knows the first point
+        self.answer = [{"metric":"sys.cpu.user","tags":{"host":"web01"},"aggregateTags":[],"dps":{str(self.now-10):1}}]
+        q = OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("literal_or","host","web01",True)])],"1m-ago")
+        r = self.client.query(q)
+        self.assertEqual(1,len(r))
+        self.assertEqual({str(self.now-10):1,str(self.now-5):2},r[0]["dps"])
+        self.assertEqual({str(self.now-10):1},self.answer[0]["dps"])
+        # a series not yet known by the TSD is added
+        q = OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("wildcard","host","*",True)])],"1m-ago",msResolution=True)
+        r = self.client.query(q)
+        self.assertEqual([{"host":"web01"},{"host":"web02"}],[s["tags"] for s in r])
+        self.assertEqual({str((self.now-5)*1000):3},r[1]["dps"])
+        # aggregated groups are left untouched
+        self.answer = [{"metric":"sys.cpu.user","tags":{},"aggregateTags":["host"],"dps":{str(self.now-10):1}}]
+        r = self.client.query(OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user")],"1m-ago"))
+        self.assertEqual(self.answer,r)
+        # out of the time range
+        self.answer = []
+        r = self.client.query(OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user")],"1h-ago","2m-ago"))
+        self.assertEqual([],r)
+
+    def test_aggregated(self):
+        """buffered series of a group missing from the TSD answer are aggregated as the TSD would do"""
+        if np is None:
+            self.skipTest("numpy is not available")
+        self.answer = []
+        r = self.client.query(OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user")],"1m-ago"))
+        self.assertEqual(1,len(r))
+        self.assertEqual({},r[0]["tags"])
+        self.assertEqual(["host"],r[0]["aggregateTags"])
+        self.assertEqual({str(self.now-10):1,str(self.now-5):5},r[0]["dps"])
+        # a lone series counts as 1
+        q = OpenTSDBQuery([OpenTSDBMetricSubQuery("count","sys.cpu.user",filters=[OpenTSDBFilter("literal_or","host","web02",True)])],"1m-ago")
+        self.assertEqual({str(self.now-5):1},self.client.query(q)[0]["dps"])
+
+    def test_batch(self):
+        """added series carry the query echo, so that batches can be demultiplexed"""
+        self.answer = [{"metric":"sys.mem.free","tags":{},"aggregateTags":[],"dps":{str(self.now-10):7},
+                        "query":{"aggregator":"sum","metric":"sys.mem.free","index":1}}]
+        with self.client.batch() as batch:
+            cpu = batch.add(OpenTSDBMetricSubQuery("sum","sys.cpu.user",filters=[OpenTSDBFilter("wildcard","host","*",True)]),"1m-ago")
+            mem = batch.add(OpenTSDBMetricSubQuery("sum","sys.mem.free"),"1m-ago")
+        self.assertEqual([{"host":"web01"},{"host":"web02"}],[s["tags"] for s in cpu.result()])
+        self.assertEqual(0,cpu.result()[0]["query"]["index"])
+        self.assertEqual(self.answer,mem.result())
+
+    def test_last(self):
+        self.answer = [{"metric":"sys.cpu.user","tags":{"host":"web01"},"timestamp":(self.now-10)*1000,"value":"1","tsuid":"000001000001000001"}]
+        r = self.client.query(OpenTSDBQueryLast([OpenTSDBQueryLast.metric("sys.cpu.user",{"host":"web01"})],[],True))
+        self.assertEqual([{"metric":"sys.cpu.user","tags":{"host":"web01"},"timestamp":(self.now-5)*1000,"value":"2","tsuid":"000001000001000001"}],r)
+        r = self.client.query(OpenTSDBQueryLast([OpenTSDBQueryLast.metric("sys.cpu.user",{})],[],False))
+        self.assertEqual(self.answer,r)
+
+    def test_authoritative(self):
+        if np is None:
+            self.skipTest("numpy is not available")
+        buffer = OpenTSDBRecentWrites(authoritative=True)
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0",recentWrites=buffer)
+        now = int(time.time())+2
+        web01 = OpenTSDBTimeSeries("sys.cpu.user",{"host":"web01"})
+        client.put_measurements([OpenTSDBMeasurement(web01,now,1),OpenTSDBMeasurement(web01,now+1,3)])
+        calls = len(self.calls)
+        r = client.query(OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user")],now,now+1))
+        self.assertEqual(calls,len(self.calls))
+        self.assertEqual({str(now):1.,str(now+1):3.},r[0]["dps"])
+        # older data must come from the TSD
+        client.query(OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user")],"1h-ago"))
+        self.assertEqual(calls+1,len(self.calls))
+
+    def test_eviction(self):
+        buffer = OpenTSDBRecentWrites(window=60, maxPoints=2)
+        ts = OpenTSDBTimeSeries("sys.cpu.user",{"host":"web01"})
+        buffer.record([OpenTSDBMeasurement(ts,self.now-120,1),OpenTSDBMeasurement(ts,self.now-30,2)])
+        self.assertEqual(1,len(buffer))
+        buffer.record([OpenTSDBMeasurement(ts,self.now-20,3),OpenTSDBMeasurement(ts,self.now-10,4)])
+        self.assertEqual(2,len(buffer))
+        self.assertTrue(buffer.horizon>(self.now-30)*1000)
+        self.assertEqual([str((self.now-20)*1000),str((self.now-10)*1000)],list(buffer.series("sys.cpu.user")[0]["dps"]))
@@ -0,0 +1,78 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+import json
+import requests
+import time
+
+
+class TestSearchIterator(TestCase):
+
+    def setUp(self):
+        super(TestSearchIterator, self).setUp()
+        self.calls = []
+        self.delay = 0
+        self.total = 1000
+        def my_post(url,data):
+            query = json.loads(data)
+            self.calls.append((url,query))
+            time.sleep(self.delay)
+            results = [{"uid":"%06X"%i} for i in range(self.total)][query["startindex"]:query["startindex"]+query["limit"]]
+            return FakeResponse(200,json.dumps({"type":"UIDMETA","totalResults":self.total,"results":results}))
+        def my_get(url,params):
+            self.calls.append((url,params))
+            return FakeResponse(200,json.dumps({"type":"LOOKUP","totalResults":2,"results":[{"tsuid":"01"},{"tsuid":"02"}]}))
+        self.patch(requests, 'post', my_post)
+        self.patch(requests, 'get', my_get)
+        self.client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+
+    def test_pages(self):
+        results = list(self.client.search_iter("UIDMETA", query="name:*", pageSize=50))
+        self.assertEqual(["%06X"%i for i in range(1000)],[r["uid"] for r in results])
+        # fast answers: the page size doubles, up to maxPageSize
+        self.assertEqual([(0,50),(50,100),(150,200),(350,400),(750,800)],[(q["startindex"],q["limit"]) for url,q in self.calls])
+        self.assertEqual("name:*",self.calls[0][1]["query"])
+        self.calls[:] = []
+        list(self.client.search_iter("UIDMETA", pageSize=100, maxPageSize=300))
+        self.assertEqual([100,200,300,300,300],[q["limit"] for url,q in self.calls])
+        # slow answers: the page size stays at pageSize
+        self.calls[:] = []
+        self.delay = 0.02
+        self.total = 30
+        list(self.client.search_iter("TSMETA", pageSize=10, targetTime=0.01))
+        self.assertEqual([10,10,10],[q["limit"] for url,q in self.calls])
+        self.assertRaises(ValueError,lambda: list(self.client.search_iter("TSMETA", pageSize=0)))
+
+    def test_prefetch(self):
+        # the next page is requested while the current one is consumed
+        iterator = self.client.search_iter("UIDMETA", pageSize=100)
+        next(iterator)
+        for i in range(100):
+            if len(self.calls)==2: break
+            time.sleep(0.01)
+        self.assertEqual(2,len(self.calls))
+        # stopping early does not fetch the other pages
+        iterator.close()
+        self.assertEqual(2,len(self.calls))
+
+    def test_lookup(self):
+        results = list(self.client.search_iter("LOOKUP", metric="sys.cpu.user", tags={"host":"*"}))
+        self.assertEqual([{"tsuid":"01"},{"tsuid":"02"}],results)
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual("sys.cpu.user{host=*}",self.calls[0][1]["m"])
@@ -0,0 +1,100 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBQuery, OpenTSDBMetricSubQuery
+from opentsdbshm import OpenTSDBSharedMemoryCache
+import json
+import multiprocessing
+import os
+import requests
+
+
+def worker(name, key, value):
+    OpenTSDBSharedMemoryCache(name).put(key, value)
+
+
+class TestOpenTSDBSharedMemoryCache(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBSharedMemoryCache, self).setUp()
+        self.name = "otsdbtest%d"%os.getpid()
+        self.cache = OpenTSDBSharedMemoryCache(self.name, maxBytes=4096, maxEntries=3)
+        self.addCleanup(self.cache.unlink)
+
+    def test_get_put(self):
+        self.assertEqual(None,self.cache.get("a"))
+        self.cache.put("a",[{"metric":"sys.cpu.user","dps":{"1":2}}])
+        self.assertEqual([{"metric":"sys.cpu.user","dps":{"1":2}}],self.cache.get("a"))
+        self.cache.put("a",[])
+        self.assertEqual([],self.cache.get("a"))
+        self.assertEqual(1,len(self.cache))
+
+    def test_lru(self):
+        for key in ["a","b","c"]:
+            self.cache.put(key,key)
+        self.cache.get("a")
+        self.cache.put("d","d")
+        self.assertEqual(None,self.cache.get("b"))
+        self.assertEqual(["a","c","d"],[self.cache.get(k) for k in ["a","c","d"]])
+        # size limit
+        self.assertFalse(self.cache.put("big",os.urandom(8192).hex()))
+        self.cache.put("e",os.urandom(2500).hex())
+        self.cache.put("f",os.urandom(2500).hex())
+        self.assertEqual(None,self.cache.get("e"))
+        self.assertEqual(5000,len(self.cache.get("f")))
+        self.cache.clear()
+        self.assertEqual(0,len(self.cache))
+
+    def test_indexSize(self):
+        # too small for any entry, then for the index itself
+        for size in [64,16]:
+            cache = OpenTSDBSharedMemoryCache("%s_%d"%(self.name,size), indexSize=size)
+            self.addCleanup(cache.unlink)
+            self.assertFalse(cache.put("a","a"))
+            self.assertEqual(None,cache.get("a"))
+            self.assertEqual(0,len(cache))
+
+    def test_ttl(self):
+        cache = OpenTSDBSharedMemoryCache(self.name, ttl=-1)
+        cache.put("a","a")
+        self.assertEqual(None,cache.get("a"))
+
+    def test_processes(self):
+        process = multiprocessing.get_context("fork").Process(target=worker, args=(self.name,"shared",{"from":"child"}))
+        process.start()
+        process.join()
+        self.assertEqual(0,process.exitcode)
+        self.assertEqual({"from":"child"},self.cache.get("shared"))
+
+    def test_client(self):
+        calls = []
+        def my_post(url,data):
+            calls.append(data)
+            return FakeResponse(200,json.dumps([{"metric":"sys.cpu.user","tags":{},"aggregateTags":[],"dps":{"1":1}}]))
+        self.patch(requests, 'post', my_post)
+        first = RESTOpenTSDBClient("localhost",4242,"2.2.0",cache=self.cache)
+        second = RESTOpenTSDBClient("localhost",4242,"2.2.0",cache=OpenTSDBSharedMemoryCache(self.name))
+        query = OpenTSDBQuery([OpenTSDBMetricSubQuery("sum","sys.cpu.user")],"1h-ago")
+        self.assertEqual(first.query(query),second.query(query))
+        self.assertEqual(1,len(calls))
+        # deletions are never cached
+        query.delete = True
+        first.query(query)
+        first.query(query)
+        self.assertEqual(3,len(calls))
@@ -0,0 +1,162 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbquery import OpenTSDBQuery, OpenTSDBtsuidSubQuery
+from opentsdbsingleflight import OpenTSDBSingleFlight
+from opentsdberrors import OpenTSDBError
+import json
+import requests
+import sys
+import threading
+import time
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+
+class TestOpenTSDBSingleFlight(TestCase):
+
+    def test_do(self):
+        """concurrent identical calls share a single execution"""
+        flight = OpenTSDBSingleFlight()
+        release = threading.Event()
+        calls = []
+        def slow(x):
+            calls.append(x)
+            release.wait(5)
+            return [x]
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do("key",slow,42))) for i in range(10)]
+        for t in threads: t.start()
+        time.sleep(0.1)
+        self.assertEqual(1,flight.inflight())
+        release.set()
+        for t in threads: t.join()
+        self.assertEqual([42],calls)
+        self.assertEqual([[42]]*10,results)
+        self.assertEqual(0,flight.inflight())
+        # once completed, a new call starts a new flight
+        flight.do("key",slow,43)
+        self.assertEqual([42,43],calls)
+
+    def test_error(self):
+        """the error is propagated to every caller"""
+        flight = OpenTSDBSingleFlight()
+        def fail(): raise ValueError("boom")
+        self.assertRaises(ValueError,flight.do,"key",fail)
+        self.assertEqual(0,flight.inflight())
+
+
+class TestClientCoalescing(TestCase):
+
+    def setUp(self):
+        super(TestClientCoalescing, self).setUp()
+        self.release = threading.Event()
+        self.calls = []
+        def my_post(url,data):
+            self.calls.append(data)
+            self.release.wait(5)
+            return FakeResponse(200,json.dumps([{"metric":"sys.cpu.nice","tags":{},"dps":{"1":1}}]))
+        self.patch(requests, 'post', my_post)
+        self.query = OpenTSDBQuery([OpenTSDBtsuidSubQuery("sum",["000001000002000042"])],start=1356998400,end=1356998460)
+
+    def test_threads(self):
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0",coalesce=True)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.query(self.query))) for i in range(8)]
+        for t in threads: t.start()
+        time.sleep(0.1)
+        self.release.set()
+        for t in threads: t.join()
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual(8,len(results))
+        self.assertEqual({"1":1},results[0][0]["dps"])
+
+    def loop(self):
+        """a new event loop (the asyncio entry points require python 3.5)"""
+        if asyncio is None or sys.version_info<(3,5):
+            self.skipTest("async_query requires python 3.5 or higher")
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(loop.close)
+        return loop
+
+    def test_asyncio(self):
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0",coalesce=True)
+        loop = self.loop()
+        tasks = [loop.create_task(client.async_query(self.query)) for i in range(8)]
+        loop.call_later(0.1,self.release.set)
+        results = loop.run_until_complete(asyncio.gather(*tasks))
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual(8,len(results))
+
+    def test_mixed(self):
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0",coalesce=True)
+        loop = self.loop()
+        thread = threading.Thread(target=client.query, args=(self.query,))
+        thread.start()
+        time.sleep(0.1)
+        loop.call_later(0.1,self.release.set)
+        result = loop.run_until_complete(client.async_query(self.query))
+        thread.join()
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual({"1":1},result[0]["dps"])
+
+    def test_prepared(self):
+        """a prepared query is serialized like the original one and shares its flight"""
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0",coalesce=True)
+        prepared = self.query.prepare().bind(1356998400,1356998460)
+        threads = [threading.Thread(target=client.query, args=(q,)) for q in [self.query,prepared]]
+        for t in threads: t.start()
+        time.sleep(0.1)
+        self.release.set()
+        for t in threads: t.join()
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual(prepared.json(),self.calls[0])
+
+    def test_disabled(self):
+        self.release.set()
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+        client.query(self.query)
+        client.query(self.query)
+        self.assertEqual(2,len(self.calls))
+
+    def test_error(self):
+        def my_post(url,data):
+            self.calls.append(data)
+            self.release.wait(5)
+            return FakeResponse(400,json.dumps({"error":{"code":400,"message":"No such name for 'metrics'"}}))
+        self.patch(requests, 'post', my_post)
+        client = RESTOpenTSDBClient("localhost",4242,"2.2.0",coalesce=True)
+        errors = []
+        def run():
+            try:
+                client.query(self.query)
+            except OpenTSDBError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads: t.start()
+        time.sleep(0.1)
+        self.release.set()
+        for t in threads: t.join()
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual(4,len(errors))
+        self.assertEqual(400,errors[0].code)
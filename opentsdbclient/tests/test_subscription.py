@@ -0,0 +1,119 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbsubscription import OpenTSDBLastValueSubscriptions
+from opentsdberrors import OpenTSDBError
+import json
+import requests
+import threading
+
+
+class TestOpenTSDBLastValueSubscriptions(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBLastValueSubscriptions, self).setUp()
+        # tsuid -> (metric, tags, timestamp, value)
+        self.store = { "000001000001000001":("sys.cpu.user",{"host":"web01"},1000,"1"),
+                       "000001000001000002":("sys.cpu.user",{"host":"web02"},1000,"2"),
+                       "000002000001000001":("sys.mem.free",{"host":"web01"},1000,"3") }
+        self.calls = []
+        self.lock = threading.Lock()
+        def my_post(url,data):
+            query = json.loads(data)
+            with self.lock:
+                self.calls.append(query)
+            results = []
+            for tsuid,(metric,tags,timestamp,value) in sorted(self.store.items()):
+                for q in query["queries"]:
+                    if ("tsuids" in q and tsuid in q["tsuids"]) or \
+                       (q.get("metric")==metric and all(tags.get(k)==v for k,v in q["tags"].items())):
+                        series = {"tsuid":tsuid,"timestamp":timestamp,"value":value}
+                        if query["resolveNames"]:
+                            series.update({"metric":metric,"tags":tags})
+                        results.append(series)
+            return FakeResponse(200,json.dumps(results))
+        self.patch(requests, 'post', my_post)
+        self.client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+
+    def test_changes(self):
+        seen = []
+        subscriptions = OpenTSDBLastValueSubscriptions(self.client, interval=10, backScan=6)
+        subscriptions.subscribe(seen.append, metric="sys.cpu.user")
+        handle = subscriptions.subscribe(seen.append, tsuid="000002000001000001")
+        self.assertEqual(3,subscriptions.poll(now=0))
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual(6,self.calls[0]["backScan"])
+        self.assertEqual(True,self.calls[0]["resolveNames"])
+        # nothing due yet
+        self.assertEqual(0,subscriptions.poll(now=5))
+        self.assertEqual(1,len(self.calls))
+        # only changed series are reported
+        self.store["000001000001000002"] = ("sys.cpu.user",{"host":"web02"},2000,"2")
+        self.assertEqual(1,subscriptions.poll(now=10))
+        self.assertEqual("000001000001000002",seen[-1]["tsuid"])
+        self.assertEqual(2000,seen[-1]["timestamp"])
+        self.assertEqual(0,subscriptions.poll(now=20))
+        subscriptions.unsubscribe(handle)
+        self.assertEqual([0],list(subscriptions.values()))
+        self.assertRaises(ValueError,subscriptions.subscribe,seen.append)
+        self.assertRaises(ValueError,subscriptions.subscribe,seen.append,metric="a",tsuid="01")
+
+    def test_spread(self):
+        subscriptions = OpenTSDBLastValueSubscriptions(self.client, interval=10, batchSize=1, workers=2)
+        for tsuid in sorted(self.store):
+            subscriptions.subscribe(lambda s: None, tsuid=tsuid)
+        # three batches, due at 0, 3.33 and 6.66
+        subscriptions.poll(now=0)
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual({"tsuids":["000001000001000001"]},self.calls[0]["queries"][0])
+        subscriptions.poll(now=7)
+        self.assertEqual(3,len(self.calls))
+        self.assertEqual(False,self.calls[1]["resolveNames"])
+        subscriptions.poll(now=8,force=True)
+        self.assertEqual(6,len(self.calls))
+
+    def test_error(self):
+        """a failing batch does not prevent the changes of the others from being reported"""
+        post = requests.post
+        def my_post(url,data):
+            if "000001000001000002" in data:
+                return FakeResponse(500,json.dumps({"error":{"code":500,"message":"boom"}}))
+            return post(url,data)
+        self.patch(requests, 'post', my_post)
+        seen = []
+        subscriptions = OpenTSDBLastValueSubscriptions(self.client, interval=10, batchSize=1, workers=2)
+        subscriptions.subscribe(seen.append, tsuid="000001000001000001")
+        handle = subscriptions.subscribe(seen.append, tsuid="000001000001000002")
+        self.assertRaises(OpenTSDBError,subscriptions.poll,now=0,force=True)
+        self.assertEqual(["000001000001000001"],[s["tsuid"] for s in seen])
+        # a failing callback does not hide the other changes either
+        def fail(series): raise ValueError("boom")
+        subscriptions.unsubscribe(handle)
+        subscriptions.subscribe(fail, tsuid="000002000001000001")
+        self.store["000001000001000001"] = ("sys.cpu.user",{"host":"web01"},2000,"1")
+        self.assertRaises(ValueError,subscriptions.poll,now=20,force=True)
+        self.assertEqual(2,len(seen))
+
+    def test_thread(self):
+        event = threading.Event()
+        subscriptions = OpenTSDBLastValueSubscriptions(self.client, interval=0.01)
+        subscriptions.subscribe(lambda s: event.set(), tsuid="000001000001000001")
+        subscriptions.start()
+        self.assertTrue(event.wait(5))
+        subscriptions.stop()
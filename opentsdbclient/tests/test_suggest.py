@@ -0,0 +1,106 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbcatalog import OpenTSDBCatalog
+from opentsdbsuggest import OpenTSDBPrefixTrie, OpenTSDBSuggestCache
+import json
+import requests
+import time
+
+
+class TestOpenTSDBPrefixTrie(TestCase):
+
+    def test_trie(self):
+        trie = OpenTSDBPrefixTrie()
+        words = ["sys.cpu.user", "sys.cpu.nice", "sys.cpu", "sys.mem.free", "proc.loadavg.1m", "s"]
+        for w in words:
+            self.assertTrue(trie.add(w))
+        self.assertFalse(trie.add("sys.cpu"))
+        self.assertEqual(6,len(trie))
+        self.assertEqual(sorted(words),trie.prefix(""))
+        self.assertEqual(["sys.cpu","sys.cpu.nice","sys.cpu.user"],trie.prefix("sys.c"))
+        self.assertEqual(["sys.cpu.nice","sys.cpu.user"],trie.prefix("sys.cpu."))
+        self.assertEqual(["s","sys.cpu"],trie.prefix("s",2))
+        self.assertEqual([],trie.prefix("sys.d"))
+        self.assertEqual([],trie.prefix("sys.cpu.user2"))
+        self.assertIn("sys.cpu",trie)
+        self.assertNotIn("sys.cp",trie)
+        self.assertNotIn("sys.cpu.system",trie)
+
+
+class TestOpenTSDBSuggestCache(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBSuggestCache, self).setUp()
+        self.names = { "metrics":["sys.cpu.user","sys.cpu.nice","sys.mem.free","proc.loadavg.1m"],
+                       "tagk":["host","dc"], "tagv":["web%02d"%i for i in range(30)] }
+        self.calls = []
+        def my_post(url,data):
+            query = json.loads(data)
+            self.calls.append(query)
+            names = sorted(n for n in self.names[query["type"]] if n.startswith(query.get("q","")))[:query.get("max",25)]
+            return FakeResponse(200,json.dumps(names))
+        self.patch(requests, 'post', my_post)
+        self.client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+
+    def test_suggest(self):
+        cache = OpenTSDBSuggestCache(self.client, maxResults=12)
+        self.assertEqual(["sys.cpu.nice","sys.cpu.user","sys.mem.free"],cache.suggest("metrics","s"))
+        self.assertEqual(["sys.cpu.nice","sys.cpu.user"],cache.suggest("metrics","sys.c"))
+        self.assertEqual([],cache.suggest("metrics","sys.d"))
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual({"type":"metrics","q":"s","max":12},self.calls[0])
+        # the TSD returned maxResults names: the prefix is not complete and longer ones are asked
+        self.assertEqual(["web%02d"%i for i in range(5)],cache.suggest("tagv","w",5))
+        self.assertFalse(cache.known("tagv","w"))
+        self.assertEqual(["web10","web11"],cache.suggest("tagv","web1",2))
+        self.assertEqual(3,len(self.calls))
+        self.assertEqual(["web15"],cache.suggest("tagv","web15"))
+        self.assertEqual(3,len(self.calls))
+        self.assertRaises(ValueError,cache.suggest,"tags","w")
+
+    def test_refresh(self):
+        cache = OpenTSDBSuggestCache(self.client, interval=60)
+        cache.suggest("metrics","sys")
+        cache.suggest("metrics","sys.cpu")
+        cache.suggest("metrics","p")
+        self.assertEqual(2,len(self.calls))
+        self.names["metrics"].append("sys.disk.used")
+        self.assertEqual(0,cache.refresh())
+        # sys.cpu is covered by sys: two calls
+        self.assertEqual(2,cache.refresh(now=time.time()+60))
+        self.assertEqual(["sys.disk.used"],cache.suggest("metrics","sys.d"))
+        self.assertEqual(4,len(self.calls))
+        # a prefix that grows past maxResults is no longer answered locally
+        cache.maxResults = 3
+        self.assertEqual(2,cache.refresh(now=time.time()+120))
+        self.assertFalse(cache.known("metrics","sys.d"))
+        self.assertTrue(cache.known("metrics","p"))
+
+    def test_catalog(self):
+        catalog = OpenTSDBCatalog()
+        catalog.add("000001000001000001","sys.cpu.user",{"host":"web01","dc":"lga"})
+        catalog.add("000001000001000002","sys.cpu.user",{"host":"web02","dc":"lga"})
+        cache = OpenTSDBSuggestCache(self.client)
+        cache.addCatalog(catalog, complete=True)
+        self.assertEqual(6,len(cache))
+        self.assertEqual(["dc","host"],cache.suggest("tagk"))
+        self.assertEqual(["lga","web01","web02"],cache.suggest("tagv"))
+        self.assertEqual([],cache.suggest("metrics","proc"))
+        self.assertEqual(0,len(self.calls))
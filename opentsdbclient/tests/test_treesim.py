@@ -0,0 +1,89 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+
+from testtools import TestCase
+from opentsdbobjects import OpenTSDBTimeSeries, OpenTSDBTreeDefinition
+from opentsdbcatalog import OpenTSDBCatalog
+from opentsdbtreesim import OpenTSDBTreeSimulator
+
+
+def definition(rules, strictMatch=False):
+    levels = {}
+    for i,level in enumerate(rules):
+        levels[str(i)] = { str(j):dict(rule, treeId=1, level=i, order=j) for j,rule in enumerate(level) }
+    return OpenTSDBTreeDefinition("test", rules=levels, created=0, treeId=1, strictMatch=strictMatch)
+
+
+class TestOpenTSDBTreeSimulator(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBTreeSimulator, self).setUp()
+        self.catalog = OpenTSDBCatalog()
+        self.catalog.add("000001000001000001","sys.cpu.user",{"host":"web01.lga.example.com"})
+        self.catalog.add("000001000001000002","sys.cpu.user",{"host":"web02.sjc.example.com"})
+        self.catalog.add("000002000001000001","sys.mem.free",{"host":"web01.lga.example.com"})
+        self.catalog.add("000003000002000003","app.requests",{"service":"api"})
+
+    def test_rules(self):
+        # data center from the host name, then the host, then the metric split on dots
+        simulator = OpenTSDBTreeSimulator(definition([
+            [{"type":"TAGK", "field":"host", "regex":r"^[^.]+\.([^.]+)\.", "displayFormat":"DC {value}"}],
+            [{"type":"TAGK", "field":"host", "regex":r"^([^.]+)\.", "regexGroupIdx":0}],
+            [{"type":"METRIC", "separator":"\\."}] ]))
+        result = simulator.simulate(self.catalog.series())
+        self.assertEqual(["DC lga","web01","sys","cpu","user"],result["leaves"]["000001000001000001"])
+        self.assertEqual(["DC lga","web01","sys","mem","free"],result["leaves"]["000002000001000001"])
+        self.assertEqual(["app","requests"],result["leaves"]["000003000002000003"])
+        self.assertEqual({"DC lga":{"web01":{"sys":{"cpu":{},"mem":{}}}}, "DC sjc":{"web02":{"sys":{"cpu":{}}}}, "app":{}},result["branches"])
+        self.assertEqual({},result["collisions"])
+        self.assertEqual({},result["notMatched"])
+        # strict matching: the series without host fails
+        simulator.strictMatch = True
+        result = simulator.simulate(self.catalog.series())
+        self.assertEqual(["000003000002000003"],list(result["notMatched"]))
+        self.assertEqual(3,len(result["leaves"]))
+
+    def test_orders(self):
+        # first matching rule of a level wins; hosts collide once the data center is dropped
+        simulator = OpenTSDBTreeSimulator(definition([
+            [{"type":"TAGK", "field":"service"}, {"type":"TAGK", "field":"host", "regex":r"^web\d+\.(\w+)", "displayFormat":"{tag_name}={ovalue}/{value}"}],
+            [{"type":"METRIC"}] ]))
+        result = simulator.simulate(self.catalog.series())
+        self.assertEqual(["api","app.requests"],result["leaves"]["000003000002000003"])
+        self.assertEqual(["host=web01.lga.example.com/lga","sys.cpu.user"],result["leaves"]["000001000001000001"])
+        simulator = OpenTSDBTreeSimulator(definition([[{"type":"METRIC"}]]))
+        result = simulator.simulate(self.catalog.series("sys.cpu.user"))
+        self.assertEqual({"000001000001000002":"000001000001000001"},result["collisions"])
+        # no rule matches at all
+        simulator = OpenTSDBTreeSimulator(definition([[{"type":"TAGK", "field":"rack"}]]))
+        self.assertEqual(4,len(simulator.simulate(self.catalog.series())["notMatched"]))
+
+    def test_custom(self):
+        ts = OpenTSDBTimeSeries("sys.cpu.user",{"host":"web01"},"000001000001000001")
+        ts.metric_meta.custom = {"owner":"ops"}
+        ts.tagk_meta["host"].custom = {"kind":"machine"}
+        ts.tagv_meta["web01"].custom = {"rack":"r12"}
+        simulator = OpenTSDBTreeSimulator(definition([
+            [{"type":"METRIC_CUSTOM", "customField":"owner"}],
+            [{"type":"TAGK_CUSTOM", "field":"host", "customField":"kind"}],
+            [{"type":"TAGV_CUSTOM", "field":"host", "customField":"rack", "displayFormat":"{value} ({tsuid})"}],
+            [{"type":"METRIC_CUSTOM", "customField":"missing"}, {"type":"METRIC"}] ]))
+        path, message = simulator.evaluate(ts)
+        self.assertEqual(["ops","machine","r12 (000001000001000001)","sys.cpu.user"],path)
+        self.assertEqual(None,message)
+        # without meta data, custom rules do not match
+        self.assertEqual(["sys.cpu.user"],simulator.evaluate({"tsuid":"01","metric":"sys.cpu.user","tags":{"host":"web01"}})[0])
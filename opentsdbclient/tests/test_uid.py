@@ -0,0 +1,121 @@
+# Copyright 2016: C. Delaere
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from testtools import TestCase
+from . import FakeResponse
+from client import RESTOpenTSDBClient
+from opentsdbobjects import OpenTSDBTimeSeries
+from opentsdberrors import OpenTSDBError
+from opentsdbuid import OpenTSDBUIDCache
+import json
+import os
+import requests
+import tempfile
+
+
+def fake_server(calls, existing):
+    """assigns sequential UIDs and reports the names in existing as already assigned"""
+    assigned = {}
+    def my_post(url,data):
+        request = json.loads(data)
+        calls.append(request)
+        response = {}
+        status = 200
+        for t in ["metric","tagk","tagv"]:
+            response[t] = {}
+            for name in request.get(t) or []:
+                if "!" in name:
+                    response.setdefault("%s_errors"%t,{})[name] = "Invalid %s (%s): illegal character: !"%(t,name)
+                    status = 400
+                elif name in existing:
+                    response.setdefault("%s_errors"%t,{})[name] = "Name already exists with UID: %s"%existing[name]
+                    status = 400
+                else:
+                    assigned[(t,name)] = "%06X"%(len(assigned)+1)
+                    response[t][name] = assigned[(t,name)]
+        return FakeResponse(status,json.dumps(response))
+    return my_post
+
+
+class TestOpenTSDBUIDCache(TestCase):
+
+    def setUp(self):
+        super(TestOpenTSDBUIDCache, self).setUp()
+        self.calls = []
+        self.patch(requests, 'post', fake_server(self.calls, {"sys.cpu.user":"0000AA", "web00":"0000BB"}))
+        self.client = RESTOpenTSDBClient("localhost",4242,"2.2.0")
+
+    def test_cache(self):
+        cache = OpenTSDBUIDCache()
+        cache.put("METRIC","sys.cpu.user","0000aa")
+        self.assertEqual("0000AA",cache.uid("metric","sys.cpu.user"))
+        self.assertEqual("sys.cpu.user",cache.name("metric","0000aa"))
+        self.assertEqual(None,cache.uid("tagk","sys.cpu.user"))
+        self.assertRaises(ValueError,cache.put,"tag","host","000001")
+        self.assertRaises(ValueError,cache.put,"tagk","host","nothex")
+        self.assertEqual(1,len(cache))
+
+    def test_assign(self):
+        cache = OpenTSDBUIDCache()
+        series = [OpenTSDBTimeSeries(m,{"host":"web%02d"%i,"dc":"lga"}) for m in ["sys.cpu.user","sys.cpu.nice"] for i in range(50)]
+        cache.assign(self.client, series)
+        # a single call with every name once
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual(["sys.cpu.nice","sys.cpu.user"],self.calls[0]["metric"])
+        self.assertEqual(["dc","host"],self.calls[0]["tagk"])
+        self.assertEqual(51,len(self.calls[0]["tagv"]))
+        # existing names are recovered from the errors
+        self.assertEqual("0000AA",series[0].metric_meta.uid)
+        self.assertEqual("0000BB",series[0].tagv_meta["web00"].uid)
+        self.assertEqual(cache.uid("tagv","web01"),series[1].tagv_meta["web01"].uid)
+        self.assertEqual(cache.uid("tagk","dc"),series[99].tagk_meta["dc"].uid)
+        # everything is known: no more calls
+        cache.assign(self.client, [OpenTSDBTimeSeries("sys.cpu.user",{"host":"web07"})])
+        ts = OpenTSDBTimeSeries("sys.cpu.user",{"host":"web01"})
+        ts.assign_uid(self.client, cache)
+        self.assertEqual(1,len(self.calls))
+        self.assertEqual("0000AA",ts.metric_meta.uid)
+        # only the unknown names are sent, in batches
+        series = [OpenTSDBTimeSeries("sys.cpu.user",{"host":"web%02d"%i}) for i in range(50,60)]
+        cache.assign(self.client, series, batchSize=4)
+        self.assertEqual(4,len(self.calls))
+        self.assertEqual([None,None,["web50","web51","web52","web53"]],[self.calls[1][t] for t in ["metric","tagk","tagv"]])
+
+    def test_errors(self):
+        cache = OpenTSDBUIDCache()
+        series = [OpenTSDBTimeSeries("sys.cpu.user",{"host":"web01"})]
+        self.assertEqual({"metric":["sys.cpu.user"],"tagk":["host"],"tagv":["web01"]},cache.missing(series))
+        errors = cache.update({"metric":{}, "metric_errors":{"bad!name":"Invalid metric (bad!name): illegal character: !"},
+                               "tagk":{"host":"000001"}})
+        self.assertEqual({"metric":{"bad!name":"Invalid metric (bad!name): illegal character: !"}},errors)
+        self.assertEqual("000001",cache.uid("tagk","host"))
+        # other names are assigned even if some are invalid
+        self.patch(OpenTSDBTimeSeries,"check",lambda self: True)
+        series.append(OpenTSDBTimeSeries("sys!cpu",{"host":"web02"}))
+        self.assertRaises(OpenTSDBError,cache.assign,self.client,series)
+        self.assertEqual(cache.uid("tagv","web02"),series[1].tagv_meta["web02"].uid)
+        self.assertEqual(None,cache.uid("metric","sys!cpu"))
+
+    def test_persistence(self):
+        path = os.path.join(tempfile.mkdtemp(), "uids.json")
+        cache = OpenTSDBUIDCache(path)
+        cache.assign(self.client, [OpenTSDBTimeSeries("sys.cpu.user",{"host":"web01"})])
+        cache.save()
+        loaded = OpenTSDBUIDCache(path)
+        self.assertEqual(3,len(loaded))
+        self.assertEqual("0000AA",loaded.uid("metric","sys.cpu.user"))
+        self.assertEqual("host",loaded.name("tagk",cache.uid("tagk","host")))
+        self.assertRaises(ValueError,OpenTSDBUIDCache().save)